@@ -0,0 +1,776 @@
+# -*- coding:utf-8 -*-
+"""
+    bench_papyrus
+    ~~~~~~~~~~~~~
+
+    Benchmarks of papyrus, run ``python bench_papyrus.py [name ...]`` to
+    run the named benchmarks, or all of them if no name is given.
+
+    With ``--output FILE`` the results are saved as JSON with the commit
+    they were measured at, and ``--compare OLD NEW`` prints how the
+    operations changed between two such files.
+"""
+
+import os
+import sys
+import argparse
+import json
+import time
+import logging
+import random
+import shutil
+import resource
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from datetime import datetime, timedelta
+
+from papyrus import (AESHandler, KeyAgent, AgentClient, derive_key, read_rows,
+                     write_rows, VaultServer, VaultClient, make_cipher,
+                     CHUNK_SIZE, Record, RecordPacker, iter_unpack_records,
+                     rechunk, Papyrus, ShardedAESHandler)
+
+KEY = 'benchmark key'
+
+
+def synthetic_records(count, groups=100, seed=42):
+    """generate the records of a synthetic vault in the dict layout of the
+    JSON text.
+    """
+    rand = random.Random(seed)
+    start = datetime(2012, 10, 19)
+    records = []
+    for i in range(count):
+        gid = rand.randrange(groups)
+        created = start + timedelta(seconds=i * 37,
+                                    microseconds=rand.randrange(1000000))
+        # every other record was updated a while after it was created
+        updated = created + timedelta(days=i % 2 * rand.randrange(1, 300))
+        records.append({
+            'id': i,
+            'gid': gid,
+            'group': u'group-%d' % gid,
+            'itemname': u'item-%d' % rand.randrange(count),
+            'value': u'%032x' % rand.getrandbits(128),
+            'note': None if i % 3 else u'note of the record %d' % i,
+            'created': created.isoformat('_'),
+            'updated': updated.isoformat('_'),
+        })
+    return records
+
+
+def deep_sizeof(obj):
+    """the size of the object and everything it refers to, the objects
+    that are shared are counted once.
+    """
+    seen = set()
+    stack = [obj]
+    size = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif hasattr(obj, '__slots__'):
+            stack.extend(getattr(obj, key) for key in obj.__slots__)
+    return size
+
+
+def bench_record_memory(sizes=(1000, 10000, 100000)):
+    """compare the memory of the records loaded as dicts with the records
+    loaded as `Record` with interned strings.
+    """
+    print '* record memory (bytes per record)'
+    print '\t%8s %12s %12s %8s' % ('records', 'dict', 'Record', 'ratio')
+    for count in sizes:
+        jsontext = json.dumps({'records': synthetic_records(count)})
+        as_dict = json.loads(jsontext)['records']
+        handler = AESHandler()
+        as_record = [handler._make_record(r)
+                     for r in json.loads(jsontext)['records']]
+        dict_size = deep_sizeof(as_dict) / float(count)
+        record_size = deep_sizeof(as_record) / float(count)
+        print '\t%8d %12.1f %12.1f %8.2f' % (count, dict_size, record_size,
+                                              dict_size / record_size)
+
+
+def loaded_handler(count, groups=100):
+    """a handler holding a synthetic vault in memory, it has no file."""
+    handler = AESHandler()
+    handler._init_data()
+    handler.data['records'] = [handler._make_record(r)
+                               for r in synthetic_records(count, groups)]
+    handler.data['currentID'] = count
+    handler.data['currentGID'] = groups
+    handler._setup_structure()
+    return handler
+
+
+def bench_search(count=100000, repeat=100):
+    """the latency of the search queries on a large vault."""
+    handler = loaded_handler(count)
+    queries = [
+        ('item-4242', None, False),
+        ('item-42', 'itemname', True),
+        ('group-7', 'group', False),
+        ('record 99', 'note', False),
+        ('item-1234', 'itemname', True),
+    ]
+    # the index is built by the first search, outside of the timings
+    handler.search(u'item')
+    print '* search on %d records (ms per query)' % count
+    for text, field, prefix in queries:
+        start = time.time()
+        for i in range(repeat):
+            matched = handler.search(text, field, prefix)
+        elapsed = (time.time() - start) * 1000 / repeat
+        print '\t%-12s %-9s prefix=%-5s %6d matched %10.4f' % (
+            text, field, prefix, len(matched), elapsed)
+
+
+def write_vault(filepath, count, vault_format='indexed', kdf='sha256',
+                cipher_mode='cfb', compression='zlib',
+                record_encoding='compact', groups=100):
+    handler = loaded_handler(count, groups)
+    handler.filepath = filepath
+    handler.vault_format = vault_format
+    handler.compression = compression
+    handler.record_encoding = record_encoding
+    if kdf != 'sha256':
+        handler._kdf = handler._new_kdf(kdf)
+    handler._cipher_mode = handler._new_cipher_mode(cipher_mode)
+    handler.cipher = derive_key(KEY, handler._kdf)
+    handler.data['digest'] = handler._digest()
+    handler.write()
+    return handler
+
+
+def peak_memory():
+    """the peak resident memory of this process in KB."""
+    # ru_maxrss may be inherited from the parent of a fresh process, so
+    # prefer the high water mark of the process itself.
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def child_load(mode, filepath):
+    """load the vault in this process and print the time and the growth
+    of the peak memory in KB, it runs in a fresh process.
+    """
+    before = peak_memory()
+    start = time.time()
+    if mode == 'read':
+        # the load path before the vault was mapped: read the ciphertext,
+        # decrypt it and parse it, each as a whole.
+        handler = AESHandler()
+        handler.cipher = AESHandler.figure_32Byte_key(KEY)
+        with open(filepath, 'rb') as f:
+            ciphertext = f.read()
+        jsondata = AESHandler.decrypt(ciphertext, handler.cipher)
+        handler.data = json.loads(jsondata)
+        handler.data['records'] = [handler._make_record(r)
+                                   for r in handler.data['records']]
+        handler._setup_structure()
+    else:
+        handler = AESHandler()
+        assert handler.initialize(KEY, filepath)
+    elapsed = time.time() - start
+    peak = peak_memory() - before
+    print json.dumps({'seconds': elapsed, 'peak_kb': peak})
+
+
+def bench_load(sizes=(10000, 100000)):
+    """compare the time and the peak memory of loading a vault by reading
+    it whole with loading it from a map chunk by chunk.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print '* load (seconds, peak memory growth in MB)'
+        print '\t%8s %-26s %8s %8s' % ('records', 'path', 'seconds', 'MB')
+        for count in sizes:
+            legacy = os.path.join(tmpdir, 'legacy-%d.dat' % count)
+            indexed = os.path.join(tmpdir, 'indexed-%d.dat' % count)
+            gcm = os.path.join(tmpdir, 'gcm-%d.dat' % count)
+            write_vault(legacy, count, 'legacy')
+            write_vault(indexed, count, 'indexed')
+            write_vault(gcm, count, 'indexed', cipher_mode='gcm')
+            for name, mode, filepath in (
+                    ('read whole, legacy', 'read', legacy),
+                    ('mapped, legacy', 'map', legacy),
+                    ('mapped, indexed', 'map', indexed),
+                    ('mapped, indexed, gcm', 'map', gcm)):
+                output = subprocess.check_output(
+                    [sys.executable, __file__, '--child', 'load', mode,
+                     filepath])
+                result = json.loads(output)
+                print '\t%8d %-26s %8.3f %8.1f' % (
+                    count, name, result['seconds'], result['peak_kb'] / 1024.0)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_fsync(count=10000, writes=20, appends=200):
+    """the cost of the fsync policies for the snapshot writes of a vault
+    and for the journal appends.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print '* fsync policies (ms per operation)'
+        print '\t%-8s %18s %18s' % ('policy', 'write %d records' % count,
+                                     'journal append')
+        for policy in ('always', 'batched', 'never'):
+            filepath = os.path.join(tmpdir, 'vault-%s.dat' % policy)
+            write_vault(filepath, count)
+            handler = AESHandler(journal=True, compact_threshold=appends + 1,
+                                 fsync=policy)
+            assert handler.initialize(KEY, filepath)
+            start = time.time()
+            for i in range(writes):
+                handler.write()
+            write_ms = (time.time() - start) * 1000 / writes
+            start = time.time()
+            for i in range(appends):
+                handler.update_record(i, u'value %d' % i)
+            handler.sync()
+            append_ms = (time.time() - start) * 1000 / appends
+            print '\t%-8s %18.3f %18.3f' % (policy, write_ms, append_ms)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_unlock(count=1000, repeat=5):
+    """the latency of unlocking a vault by deriving its key from the
+    passphrase, and by taking the key from the agent.
+    """
+    tmpdir = tempfile.mkdtemp()
+    agent = KeyAgent(os.path.join(tmpdir, 'agent.sock'))
+    thread = threading.Thread(target=agent.serve)
+    thread.start()
+    client = AgentClient(agent.path)
+    try:
+        print '* unlock a vault of %d records (ms)' % count
+        print '\t%-8s %12s %12s' % ('kdf', 'passphrase', 'agent')
+        for kdf in ('sha256', 'pbkdf2', 'scrypt'):
+            filepath = os.path.join(tmpdir, 'vault-%s.dat' % kdf)
+            write_vault(filepath, count, kdf=kdf)
+            timings = []
+            for cipher in (KEY, None):
+                start = time.time()
+                for i in range(repeat):
+                    handler = AESHandler(agent=client)
+                    assert handler.initialize(cipher, filepath)
+                timings.append((time.time() - start) * 1000 / repeat)
+            print '\t%-8s %12.2f %12.2f' % (kdf, timings[0], timings[1])
+    finally:
+        client.stop()
+        thread.join()
+        shutil.rmtree(tmpdir)
+
+
+def bench_import(count=100000):
+    """the throughput of importing and exporting the records in both
+    formats.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print '* import and export %d records (seconds)' % count
+        print '\t%-6s %10s %10s' % ('format', 'import', 'export')
+        for fmt in ('csv', 'jsonl'):
+            source = os.path.join(tmpdir, 'records.' + fmt)
+            with open(source, 'wb') as f:
+                write_rows(f, synthetic_records(count), fmt)
+            handler = AESHandler()
+            assert handler.initialize(KEY, os.path.join(tmpdir, fmt + '.dat'))
+            start = time.time()
+            with open(source, 'rb') as f:
+                handler.add_records(read_rows(f, fmt))
+            import_seconds = time.time() - start
+            start = time.time()
+            with open(os.path.join(tmpdir, 'export.' + fmt), 'wb') as f:
+                write_rows(f, handler.export_records(), fmt)
+            export_seconds = time.time() - start
+            print '\t%-6s %10.3f %10.3f' % (fmt, import_seconds,
+                                              export_seconds)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_cipher(sizes=(1, 16, 64), count=100000):
+    """the throughput of the ciphers in MB/s, for the streams of the
+    given sizes in MB and for the values of a vault of `count` records.
+    """
+    key = derive_key(KEY, {'name': 'sha256'})
+    chunk = os.urandom(CHUNK_SIZE)
+    print '* cipher throughput (MB/s)'
+    print '\t%-4s %-16s %10s %10s' % ('mode', 'data', 'encrypt', 'decrypt')
+    for mode in ('cfb', 'gcm'):
+        cipher = make_cipher(key, {'name': mode})
+        for size in sizes:
+            chunks = size * 1024 * 1024 // CHUNK_SIZE
+            start = time.time()
+            stream = ''.join(cipher.iter_encrypt([chunk] * chunks))
+            encrypt_seconds = time.time() - start
+            start = time.time()
+            for piece in cipher.iter_decrypt(stream):
+                pass
+            decrypt_seconds = time.time() - start
+            del stream
+            print '\t%-4s %-16s %10.1f %10.1f' % (
+                mode, '%d MB stream' % size, size / encrypt_seconds,
+                size / decrypt_seconds)
+
+        values = [json.dumps(r['value']) for r in synthetic_records(count)]
+        size = sum(len(value) for value in values) / (1024.0 * 1024)
+        ids = range(len(values))
+        start = time.time()
+        blobs = cipher.encrypt_values(ids, values)
+        encrypt_seconds = time.time() - start
+        start = time.time()
+        for rid, blob in zip(ids, blobs):
+            cipher.decrypt_value(blob, rid)
+        decrypt_seconds = time.time() - start
+        print '\t%-4s %-16s %10.1f %10.1f' % (
+            mode, '%d values' % count, size / encrypt_seconds,
+            size / decrypt_seconds)
+
+
+def bench_compression(count=100000, repeat=3):
+    """compare the size of a vault and the time to save and to load it
+    for the encodings and the codecs of the index.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print '* compression of %d records (MB, seconds)' % count
+        print '\t%-8s %-5s %8s %8s %8s' % ('encoding', 'codec', 'MB', 'save',
+                                           'load')
+        for encoding, codec in (('json', None), ('compact', None),
+                                ('binary', None), ('json', 'zlib'),
+                                ('compact', 'zlib'), ('binary', 'zlib'),
+                                ('binary', 'bz2')):
+            filepath = os.path.join(tmpdir, '%s-%s.dat' % (encoding, codec))
+            handler = write_vault(filepath, count, cipher_mode='gcm',
+                                  compression=codec, record_encoding=encoding)
+            # the values are copied as they are, so the save is mostly the
+            # index.
+            start = time.time()
+            for i in range(repeat):
+                handler.write()
+            save_seconds = (time.time() - start) / repeat
+            start = time.time()
+            for i in range(repeat):
+                assert AESHandler().initialize(KEY, filepath)
+            load_seconds = (time.time() - start) / repeat
+            size = os.path.getsize(filepath) / (1024.0 * 1024)
+            print '\t%-8s %-5s %8.2f %8.3f %8.3f' % (
+                encoding, codec, size, save_seconds, load_seconds)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_serialization(count=100000):
+    """the time to encode and to decode the records of the index in each
+    encoding, without the cipher and the codec.
+    """
+    handler = loaded_handler(count)
+    records = handler.data['records']
+    encode = json.JSONEncoder().encode
+    packer = RecordPacker()
+
+    def fields(record, i):
+        return [record.id, record.gid, record.group, record.itemname,
+                record.note, record.created, record.updated, i * 64, 64,
+                record.mask()]
+
+    def decode_json(text):
+        for line in text.split('\n'):
+            fields = json.loads(line)
+            offset, length = fields['value']
+            handler._make_record(fields)
+
+    def decode_compact(text):
+        for line in text.split('\n'):
+            row = json.loads(line)
+            Record(row[0], row[1], handler._intern(row[2]),
+                   handler._intern(row[3]), None, row[4], row[5], row[6])
+
+    def encode_binary():
+        blocks = []
+        for i, record in enumerate(records):
+            if packer.add(*fields(record, i)):
+                blocks.append(packer.pack())
+        blocks.append(packer.pack())
+        return ''.join(blocks)
+
+    def decode_binary(text):
+        for row in iter_unpack_records(rechunk([text])):
+            Record(row[0], row[1], handler._intern(row[2]),
+                   handler._intern(row[3]), None, row[4], row[5], row[6])
+
+    encodings = (
+        ('json', lambda: '\n'.join(
+            encode(dict(zip(('id', 'gid', 'group', 'itemname', 'note',
+                             'created', 'updated'), fields(r, i)[:7]),
+                        value=(i * 64, 64), mask=r.mask()))
+            for i, r in enumerate(records)), decode_json),
+        ('compact', lambda: '\n'.join(
+            encode(fields(r, i)) for i, r in enumerate(records)),
+         decode_compact),
+        ('binary', encode_binary, decode_binary),
+    )
+    print '* serialize the index of %d records (MB, seconds)' % count
+    print '\t%-8s %8s %8s %8s' % ('encoding', 'MB', 'encode', 'decode')
+    for name, encoder, decoder in encodings:
+        start = time.time()
+        text = encoder()
+        encode_seconds = time.time() - start
+        start = time.time()
+        decoder(text)
+        decode_seconds = time.time() - start
+        print '\t%-8s %8.2f %8.3f %8.3f' % (
+            name, len(text) / (1024.0 * 1024), encode_seconds, decode_seconds)
+
+
+def bench_sharded(count=100000, shards=16, repeat=3, updates=10):
+    """compare the time to load a vault and to write a changed record for
+    a single file and for a sharded vault loaded by pools of processes.
+    """
+    rows = [dict((key, record[key]) for key in ('group', 'itemname', 'value',
+                                                'note', 'created', 'updated'))
+            for record in synthetic_records(count)]
+    options = {'kdf': 'pbkdf2', 'kdf_params': {'iterations': 1},
+               'cipher_mode': 'gcm'}
+    tmpdir = tempfile.mkdtemp()
+    results = {}
+    try:
+        print '* sharded vault of %d records in %d shards (%d CPUs, ' \
+              'seconds)' % (count, shards, multiprocessing.cpu_count())
+        print '\t%-10s %9s %8s %8s' % ('layout', 'processes', 'load',
+                                       'update')
+        filepath = os.path.join(tmpdir, 'records.dat')
+        dirpath = os.path.join(tmpdir, 'records.d')
+        layouts = [('file', 1, lambda: AESHandler(**options), filepath)]
+        for processes in (1, 2, 4):
+            layouts.append(('sharded', processes,
+                            lambda processes=processes: ShardedAESHandler(
+                                shards=shards, processes=processes,
+                                **options), dirpath))
+        for layout, processes, new_handler, path in layouts:
+            handler = new_handler()
+            assert handler.initialize(KEY, path)
+            if not handler.data['records']:
+                handler.add_records(rows)
+            samples = []
+            for i in range(repeat):
+                start = time.time()
+                assert new_handler().initialize(KEY, path)
+                samples.append(time.time() - start)
+            load_seconds = sorted(samples)[len(samples) // 2]
+            start = time.time()
+            for i in range(updates):
+                assert handler.update_record(i * 7919 % count, u'changed')
+            update_seconds = (time.time() - start) / updates
+            print '\t%-10s %9d %8.3f %8.3f' % (layout, processes,
+                                               load_seconds, update_seconds)
+            results['%s-%d' % (layout, processes)] = {
+                'load': load_seconds, 'update': update_seconds}
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def server_client(args):
+    """the requests of one client process, every `write_every`th request
+    is an update and the others are record lookups.
+    """
+    path, count, requests, write_every, seed = args
+    client = VaultClient(path, size=1)
+    rand = random.Random(seed)
+    for i in range(requests):
+        rid = rand.randrange(count)
+        if write_every and i % write_every == 0:
+            client.update_record(rid, u'value %d' % i)
+        else:
+            client.record(rid)
+    client.close()
+
+
+def bench_server(count=10000, requests=4000, clients=(1, 4, 16)):
+    """the throughput of `papyrus serve` for concurrent client processes,
+    with reads only and with one update in ten requests.
+    """
+    tmpdir = tempfile.mkdtemp()
+    filepath = os.path.join(tmpdir, 'vault.dat')
+    write_vault(filepath, count)
+    handler = AESHandler(journal=True, compact_threshold=requests + 1,
+                         fsync='batched')
+    assert handler.initialize(KEY, filepath)
+    server = VaultServer(handler, os.path.join(tmpdir, 'server.sock'))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        print '* serve %d records to client processes (requests per second)' \
+            % count
+        print '\t%8s %12s %12s' % ('clients', 'reads', '10% writes')
+        for n in clients:
+            rates = []
+            for write_every in (0, 10):
+                pool = multiprocessing.Pool(n)
+                jobs = [(server.path, count, requests // n, write_every, i)
+                        for i in range(n)]
+                start = time.time()
+                pool.map(server_client, jobs)
+                rates.append(requests / (time.time() - start))
+                pool.close()
+                pool.join()
+            print '\t%8d %12.0f %12.0f' % (n, rates[0], rates[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+        handler.close()
+        shutil.rmtree(tmpdir)
+
+
+def percentiles(samples):
+    """the latency percentiles of the samples in ms."""
+    samples = sorted(samples)
+
+    def at(fraction):
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+    return {
+        'n': len(samples),
+        'mean_ms': sum(samples) / len(samples) * 1000,
+        'p50_ms': at(0.5) * 1000,
+        'p90_ms': at(0.9) * 1000,
+        'p99_ms': at(0.99) * 1000,
+        'max_ms': samples[-1] * 1000,
+    }
+
+
+def time_calls(call, repeat, budget):
+    """time `call` up to `repeat` times, but stop once `budget` seconds
+    were spent after three calls, so the slow operations of the large
+    vaults finish.
+    """
+    samples = []
+    spent = 0
+    while len(samples) < repeat and (len(samples) < 3 or spent < budget):
+        start = time.time()
+        call()
+        elapsed = time.time() - start
+        samples.append(elapsed)
+        spent += elapsed
+    return percentiles(samples)
+
+
+def child_operations(count, mode, filepath, repeat, budget):
+    """time the operations of the handler and of the shell on the vault,
+    print the results as JSON. It runs in a fresh process, so the peak
+    memory is the one of this vault.
+    """
+    count, repeat, budget = int(count), int(repeat), float(budget)
+    # moving a record over another one logs a warning
+    logging.getLogger('papyrus').addHandler(logging.NullHandler())
+    rand = random.Random(count)
+    before = peak_memory()
+    start = time.time()
+    handler = AESHandler(journal=mode == 'journal')
+    assert handler.initialize(KEY, filepath)
+    result = {
+        'records': count,
+        'mode': mode,
+        'initialize_s': time.time() - start,
+        'load_mb': (peak_memory() - before) / 1024.0,
+    }
+    ids = list(handler.records['_rid'])
+    gids = list(handler.records['_gid'])
+    shell = Papyrus(stdout=open(os.devnull, 'w'))
+    shell.handler = handler
+
+    def add():
+        handler.add_record(u'group-%d' % rand.choice(gids),
+                           u'new-%d' % rand.getrandbits(32),
+                           u'%032x' % rand.getrandbits(128))
+        ids.append(handler.data['currentID'] - 1)
+
+    def delete():
+        handler.delete_record(ids.pop(rand.randrange(len(ids))))
+
+    operations = [
+        ('add_record', add),
+        ('update_record', lambda: handler.update_record(
+            rand.choice(ids), u'%032x' % rand.getrandbits(128))),
+        ('move_record', lambda: handler.move_record(rand.choice(ids),
+                                                    rand.choice(gids))),
+        ('delete_record', delete),
+        ('write', handler.write),
+        ('ls groups', lambda: shell.onecmd('ls groups')),
+        ('ls group_id', lambda: shell.onecmd('ls %d' % rand.choice(gids))),
+        ('ls records', lambda: shell.onecmd('ls records')),
+        ('ls records page', lambda: shell.onecmd(
+            'ls records --sort updated --limit 50 --offset 100')),
+        ('info', lambda: shell.onecmd('info %d' % rand.choice(ids))),
+    ]
+    result['operations'] = {}
+    stdout = sys.stdout
+    for name, call in operations:
+        # the shell prints to the standard output
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            result['operations'][name] = time_calls(call, repeat, budget)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+    handler.close()
+    result['peak_mb'] = peak_memory() / 1024.0
+    print json.dumps(result)
+
+
+def bench_operations(sizes=(1000, 10000, 100000, 1000000), repeat=200,
+                     budget=10.0, modes=('snapshot', 'journal')):
+    """the latency percentiles of the operations of the handler and of the
+    shell commands, and the peak memory, on vaults of the given sizes.
+    Every vault is measured by a fresh process.
+
+    :return: the results, which `--output` saves.
+    """
+    tmpdir = tempfile.mkdtemp()
+    results = []
+    try:
+        print '* operations (ms: p50 p90 p99, memory in MB)'
+        for count in sizes:
+            filepath = os.path.join(tmpdir, 'vault-%d.dat' % count)
+            write_vault(filepath, count, groups=max(10, count // 100))
+            for mode in modes:
+                shutil.copy(filepath, filepath + '.' + mode)
+                output = subprocess.check_output(
+                    [sys.executable, __file__, '--child', 'operations',
+                     str(count), mode, filepath + '.' + mode, str(repeat),
+                     str(budget)])
+                result = json.loads(output)
+                results.append(result)
+                print '\t%d records, %s: initialize %.3fs, load %.1f MB, ' \
+                    'peak %.1f MB' % (count, mode, result['initialize_s'],
+                                      result['load_mb'], result['peak_mb'])
+                for name, stats in sorted(result['operations'].items()):
+                    print '\t\t%-14s %10.3f %10.3f %10.3f  (n=%d)' % (
+                        name, stats['p50_ms'], stats['p90_ms'],
+                        stats['p99_ms'], stats['n'])
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def compare_results(old, new, threshold=0.2):
+    """print the operations whose median latency changed by more than
+    `threshold` between two result files of `--output`.
+    """
+    print '* compare %s (%s) with %s (%s)' % (
+        old.get('commit'), old.get('time'), new.get('commit'), new.get('time'))
+    baseline = {}
+    for result in old['results'].get('operations', []):
+        for name, stats in result['operations'].items():
+            baseline[result['records'], result['mode'], name] = stats
+    for result in new['results'].get('operations', []):
+        for name, stats in sorted(result['operations'].items()):
+            before = baseline.get((result['records'], result['mode'], name))
+            if before is None:
+                continue
+            ratio = stats['p50_ms'] / max(before['p50_ms'], 1e-6)
+            flag = ''
+            if ratio > 1 + threshold:
+                flag = 'slower'
+            elif ratio < 1 - threshold:
+                flag = 'faster'
+            print '\t%8d %-8s %-14s %10.3f -> %10.3f ms %6.2fx %s' % (
+                result['records'], result['mode'], name, before['p50_ms'],
+                stats['p50_ms'], ratio, flag)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+BENCHMARKS = {
+    'cipher': bench_cipher,
+    'compression': bench_compression,
+    'fsync': bench_fsync,
+    'import': bench_import,
+    'load': bench_load,
+    'operations': bench_operations,
+    'record_memory': bench_record_memory,
+    'search': bench_search,
+    'serialization': bench_serialization,
+    'server': bench_server,
+    'sharded': bench_sharded,
+    'unlock': bench_unlock,
+}
+
+
+CHILDREN = {
+    'load': child_load,
+    'operations': child_operations,
+}
+
+
+def main(argv):
+    if argv[:1] == ['--child']:
+        CHILDREN[argv[1]](*argv[2:])
+        return 0
+    parser = argparse.ArgumentParser(description='Run the benchmarks.')
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help='the benchmarks to run: %s'
+                        % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--records', default=None,
+                        help='the comma separated vault sizes of the '
+                        'operations benchmark')
+    parser.add_argument('--output', help='save the results to a JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files instead of running')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        compare_results(old, new)
+        return 0
+    results = {}
+    for name in args.names or sorted(BENCHMARKS):
+        if name == 'operations' and args.records:
+            sizes = [int(size) for size in args.records.split(',')]
+            result = bench_operations(sizes)
+        else:
+            result = BENCHMARKS[name]()
+        if result is not None:
+            results[name] = result
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'commit': git_commit(), 'python': sys.version,
+                       'time': datetime.now().isoformat(),
+                       'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -11,264 +11,3733 @@
 """
 
 import os
+import re
 import sys
+import csv
+import glob
+import bz2
+import bisect
 import json
+import errno
+import mmap
+import marshal
+import shlex
+import socket
+import struct
+import subprocess
+import signal
+import zlib
+import argparse
+import SocketServer
 import cmd
+import time
 import logging
+import threading
+import multiprocessing
+import hmac
+import heapq
+import itertools
 import hashlib
+import shutil
 import getpass
-from datetime import datetime
-from collections import defaultdict
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from collections import defaultdict, OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    # there are no advisory locks on Windows, a vault that several
+    # processes open is not safe there.
+    fcntl = None
 
 from Crypto.Cipher import AES
 from Crypto import Random
+try:
+    from Crypto.Protocol.KDF import scrypt
+except ImportError:
+    # scrypt comes with pycryptodome, but not with pycrypto
+    scrypt = None
 
 
-class AESHandler(object):
-    """Handler that control and manage the infomations of user, use 
-    AES to encrypt/decrypt user infomations
+# the leading bytes of the vault in the indexed format, a vault without
+# them is in the legacy single-blob format.
+VAULT_MAGIC = 'PAPYRUS\n'
+# the size of the pieces that a vault is encrypted and decrypted in
+CHUNK_SIZE = 64 * 1024
+# the room reserved for the plain header of a vault in the indexed format
+HEADER_SIZE = 512
+# the size of the nonce and of the tag of an AES-GCM ciphertext
+GCM_NONCE_SIZE = 12
+GCM_TAG_SIZE = 16
+# the codecs that the index of a vault may be compressed with before it is
+# encrypted, each as the (compressor, decompressor) factories.
+CODECS = {
+    'zlib': (zlib.compressobj, zlib.decompressobj),
+    'bz2': (bz2.BZ2Compressor, bz2.BZ2Decompressor),
+}
+# the fields of a record in the compact and the binary encodings of the
+# index, in order
+INDEX_FIELDS = ('id', 'gid', 'group', 'itemname', 'note', 'created',
+                'updated', 'offset', 'length', 'mask')
+# the default costs of the key derivation functions for the new vaults
+KDF_PARAMS = {
+    'pbkdf2': {'iterations': 200000},
+    'scrypt': {'n': 2 ** 15, 'r': 8, 'p': 1},
+}
+
+
+def derive_key(passphrase, kdf):
+    """derive the 32 bytes key of a vault from the passphrase.
+
+    :param kdf: the dict that the vault header keeps, its ``name`` is
+                ``'sha256'`` (the single hash pass of the vaults written
+                before the KDF was stored), ``'pbkdf2'`` or ``'scrypt'``,
+                the others are the hex salt and the costs.
+    """
+    name = kdf['name']
+    if name == 'sha256':
+        return AESHandler.figure_32Byte_key(passphrase)
+    salt = kdf['salt'].decode('hex')
+    if name == 'pbkdf2':
+        return hashlib.pbkdf2_hmac('sha256', passphrase, salt,
+                                   kdf['iterations'], 32)
+    if name == 'scrypt':
+        if scrypt is None:
+            raise ValueError('scrypt needs the pycryptodome package')
+        return scrypt(passphrase, salt, 32, N=kdf['n'], r=kdf['r'],
+                      p=kdf['p'])
+    raise ValueError('unknown key derivation function %r' % name)
+
+
+def read_header(mapping):
+    """return the plain header of a vault in the indexed format and the
+    offset where its index starts.
+    """
+    start = len(VAULT_MAGIC)
+    length, = struct.unpack('>I', mapping[start:start+4])
+    header = json.loads(mapping[start+4:start+4+length])
+    if header['version'] != 2:
+        raise ValueError('unknown vault version %r' % header['version'])
+    return header, start + 4 + length
+
+
+def read_generation(filepath):
+    """the generation counter in the header of a vault, or None if the
+    vault does not exist or has no header.
+    """
+    try:
+        with open(filepath, 'rb') as f:
+            head = f.read(len(VAULT_MAGIC) + 4 + HEADER_SIZE)
+    except IOError:
+        return None
+    if not head.startswith(VAULT_MAGIC):
+        return None
+    return read_header(head)[0].get('generation', 0)
+
+
+class FileLock(object):
+    """An exclusive advisory lock (flock) that keeps the other processes
+    away from a vault while it is read, changed and written.
+
+    The lock is reentrant, and the lock file only exists while the lock is
+    held: the holder removes it before the release, so a waiter that got
+    the lock on a removed file tries again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.depth = 0
+        self._fd = None
+
+    def acquire(self):
+        if self.depth == 0 and fcntl is not None:
+            while True:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                        break
+                except OSError:
+                    pass
+                os.close(fd)
+            self._fd = fd
+        self.depth += 1
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0 and self._fd is not None:
+            os.remove(self.path)
+            os.close(self._fd)
+            self._fd = None
+
+
+def map_file(filepath):
+    """map the whole file into memory read-only."""
+    with open(filepath, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def fsync_dir(filepath):
+    """flush the entries of the directory that holds `filepath`."""
+    fd = os.open(os.path.dirname(os.path.abspath(filepath)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def rotate_backups(filepath, count):
+    """keep the `count` latest generations of the file as `filepath.1`
+    (the newest) to `filepath.<count>` (the oldest).
+    """
+    if not count or not os.path.exists(filepath):
+        return
+    for i in range(count - 1, 0, -1):
+        older = '%s.%d' % (filepath, i)
+        if os.path.exists(older):
+            os.rename(older, '%s.%d' % (filepath, i + 1))
+    backup = filepath + '.1'
+    if os.path.exists(backup):
+        os.remove(backup)
+    # the file is always replaced instead of changed, so a hard link is a
+    # copy that costs nothing.
+    try:
+        os.link(filepath, backup)
+    except OSError:
+        shutil.copy2(filepath, backup)
+
+
+def remove_backups(filepath):
+    """remove every generation that `rotate_backups` kept of the file."""
+    for path in glob.glob(filepath + '.[0-9]*'):
+        if path[len(filepath) + 1:].isdigit():
+            os.remove(path)
+
+
+@contextmanager
+def replacing_file(filepath, sync=True, sync_dir=True, backups=0):
+    """open a temporary file for writing and rename it to `filepath` when
+    the block succeeds, so the file is never left half written, and the
+    maps of the replaced file stay valid.
+
+    Before the rename a marker file records that the temporary file is
+    complete, so `recover_file` can finish a replacement that a crash
+    interrupted.
+
+    :param sync: fsync the temporary file and the marker, so they are on
+                 the disk before the rename.
+    :param sync_dir: fsync the directory around the rename as well.
+    :param backups: the number of the former generations to keep, see
+                    `rotate_backups`.
+    """
+    tmppath, marker = filepath + '.tmp', filepath + '.pending'
+    try:
+        with open(tmppath, 'wb') as f:
+            yield f
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+    except:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+    with open(marker, 'wb') as f:
+        if sync:
+            os.fsync(f.fileno())
+    if sync_dir:
+        fsync_dir(filepath)
+    rotate_backups(filepath, backups)
+    os.rename(tmppath, filepath)
+    if sync_dir:
+        fsync_dir(filepath)
+    os.remove(marker)
+
+
+def recover_file(filepath):
+    """finish or discard the replacement of the file that a crash
+    interrupted, see `replacing_file`.
+
+    :return: True if a complete replacement was finished.
+    """
+    tmppath, marker = filepath + '.tmp', filepath + '.pending'
+    if os.path.exists(marker):
+        recovered = os.path.exists(tmppath)
+        if recovered:
+            os.rename(tmppath, filepath)
+        os.remove(marker)
+        return recovered
+    if os.path.exists(tmppath):
+        # the crash happened before the temporary file was complete
+        os.remove(tmppath)
+    return False
+
+
+def rechunk(pieces, size=CHUNK_SIZE):
+    """join the small pieces of text into chunks of about `size` bytes."""
+    buf, length = [], 0
+    for piece in pieces:
+        buf.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(buf)
+            buf, length = [], 0
+    if buf:
+        yield ''.join(buf)
+
+
+def iter_compress(chunks, codec):
+    """compress the chunks as one stream, they are passed on as they are
+    if `codec` is None.
+    """
+    if codec is None:
+        for chunk in chunks:
+            yield chunk
+        return
+    compressor = CODECS[codec][0]()
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def iter_decompress(chunks, codec):
+    """decompress the chunks of a stream that `iter_compress` made."""
+    if codec is None:
+        for chunk in chunks:
+            yield chunk
+        return
+    decompressor = CODECS[codec][1]()
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    if codec == 'zlib':
+        yield decompressor.flush()
+
+
+def iter_lines(chunks):
+    """split the text of the chunks into lines."""
+    tail = ''
+    for chunk in chunks:
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line
+    yield tail
+
+
+class JSONStream(object):
+    """An incremental reader of the JSON text that arrives in chunks, it
+    decodes one value at a time and keeps only the undecoded tail.
+    """
+
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = ''
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """the next character that is not a whitespace, or '' at the end."""
+        while True:
+            self.pos = self.WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        """consume the next character, which should be one of `chars`."""
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('Expecting one of %r at the end of %r'
+                             % (chars, self.buf[max(self.pos - 20, 0):self.pos]))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """decode the next value."""
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a value at the end of the buffer may be cut, e.g. a number
+                if end < len(self.buf):
+                    self.pos = end
+                    return obj
+            except ValueError:
+                pass
+            if not self._fill():
+                obj, self.pos = self.decoder.raw_decode(self.buf, self.pos)
+                return obj
+
+
+def iter_json_records(chunks, meta):
+    """decode the JSON object of a legacy vault incrementally, the records
+    are yielded one at a time as soon as they are decoded, and the other
+    members of the object are stored into `meta`.
+    """
+    stream = JSONStream(chunks)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        if key != 'records':
+            meta[key] = stream.value()
+        else:
+            stream.expect('[')
+            if stream.peek() == ']':
+                stream.expect(']')
+            else:
+                while True:
+                    yield stream.value()
+                    if stream.expect(',]') == ']':
+                        break
+        if stream.expect(',}') == '}':
+            break
+
+
+# the head of a block of records in the binary encoding: the number of
+# the records and the length of the JSON text of their strings.
+BLOCK_HEAD = struct.Struct('>II')
+# the number of the records in a full block
+BLOCK_RECORDS = 1024
+# the gid of the records of an invalid group name, which is NaN
+NAN_GID = -1
+# the timestamps that are not microseconds since the epoch
+STAMP_TEXT = -2 ** 63
+STAMP_SAME = -2 ** 63 + 1
+EPOCH = datetime(1970, 1, 1)
+DATE_RE = re.compile(r'\d{4}-\d\d-\d\d$')
+# the layouts of the timestamps that `time_micros` reads
+TIME_FORMATS = ('%Y-%m-%d_%H:%M:%S.%f', '%Y-%m-%d_%H:%M:%S',
+                '%Y-%m-%d_%H:%M', '%Y-%m-%d')
+
+
+def parse_stamp(text, cache=None):
+    """the microseconds since the epoch of a timestamp written by
+    ``datetime.isoformat('_')``, or None if the text would not read back
+    the same.
+
+    :param cache: a dict of the days since the epoch of the dates seen so
+                  far.
+    """
+    if cache is None:
+        cache = {}
+    if not isinstance(text, basestring):
+        return None
+    if len(text) == 26 and text[19] == '.':
+        micro = text[20:]
+        if not micro.isdigit() or micro == '000000':
+            return None
+        micro = int(micro)
+    elif len(text) == 19:
+        micro = 0
+    else:
+        return None
+    if text[10] != '_' or text[13] != ':' or text[16] != ':':
+        return None
+    clock = text[11:13] + text[14:16] + text[17:19]
+    if not clock.isdigit():
+        return None
+    minutes, second = divmod(int(clock), 100)
+    hour, minute = divmod(minutes, 100)
+    if hour > 23 or minute > 59 or second > 59:
+        return None
+    date = text[:10]
+    days = cache.get(date)
+    if days is None:
+        if DATE_RE.match(date) is None:
+            return None
+        try:
+            days = (datetime.strptime(date, '%Y-%m-%d') - EPOCH).days
+        except ValueError:
+            return None
+        cache[date] = days
+    return (((days * 24 + hour) * 60 + minute) * 60 + second) * 1000000 \
+        + micro
+
+
+def time_micros(value, cache=None):
+    """the microseconds since the epoch of a `datetime` or of a timestamp
+    text such as ``2012-10-19_08:30:00`` or ``2012-10-19``, or None if it
+    is not a time.
+
+    :param cache: see `parse_stamp`.
+    """
+    if not isinstance(value, datetime):
+        stamp = parse_stamp(value, cache)
+        if stamp is not None or not isinstance(value, basestring):
+            return stamp
+        text = value.strip().replace('T', '_').replace(' ', '_')
+        for fmt in TIME_FORMATS:
+            try:
+                value = datetime.strptime(text, fmt)
+                break
+            except ValueError:
+                pass
+        else:
+            return None
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _column_format(count):
+    # the id, the gid, the offset and the length of the value blob, the
+    # created and the updated timestamps
+    return '>%dI%di%dQ%dI%dq%dq' % ((count,) * 6)
+
+
+class RecordPacker(object):
+    """Packs the records of the index in the binary encoding.
+
+    The records are packed in blocks of up to `BLOCK_RECORDS`, every
+    block is the `BLOCK_HEAD`, the integer fields of its records packed
+    column by column, and a JSON array of their group names, item names,
+    notes and masks. So a block is decoded with one `struct` call and one
+    JSON parse, instead of a parse per record.
+
+    The timestamps are the microseconds since the epoch when they were
+    written by ``datetime.isoformat('_')``, which is what the handler
+    writes, the others (say, from an import) follow the strings of the
+    block as they are, so that they read back the same. An updated
+    timestamp that equals the created one is not repeated.
     """
 
     def __init__(self):
-        # Initialize Log
-        self.log = logging.getLogger('papyrus')
-        # Initialize the attributes of class
-        self.initialized = False
-        self.filepath = ''
-        self.cipher = ''
-        self.data = None
-        # self._records is a proxy structure mapping to the records of 
-        # self.data and is use for better retrieve records.
-        self._records = defaultdict(dict)
+        # the days since the epoch of the dates seen so far
+        self._days = {}
+        self._rows = []
 
-    def initialize(self, cipher, filepath='records.dat'):
+    def stamp(self, text):
+        """the microseconds of the timestamp, or None if the text would
+        not read back the same.
         """
-        validate the cipher and load the data from outside file.
+        return parse_stamp(text, self._days)
 
-        :return: True if successfully initialize, else will be False
+    def add(self, id, gid, group, itemname, note, created, updated,
+            offset, length, mask):
+        """add a record, return True when the block is full."""
+        self._rows.append((id, gid, group, itemname, note, created, updated,
+                           offset, length, mask))
+        return len(self._rows) >= BLOCK_RECORDS
+
+    def pack(self):
+        """pack the records added since the last block into a block, or
+        return an empty string if there are none.
         """
-        self.filepath = filepath
-        self.cipher = self.figure_32Byte_key(cipher)
+        rows, self._rows = self._rows, []
+        count = len(rows)
+        if not count:
+            return ''
+        columns = [[], [], [], [], [], []]
+        ids, gids, offsets, lengths, created_col, updated_col = columns
+        strings, created_texts, updated_texts = [], [], []
+        for (id, gid, group, itemname, note, created, updated,
+             offset, length, mask) in rows:
+            ids.append(id)
+            gids.append(NAN_GID if gid != gid else gid)
+            offsets.append(offset)
+            lengths.append(length)
+            strings.extend((group, itemname, note, mask))
+            stamp = self.stamp(created)
+            if stamp is None:
+                stamp = STAMP_TEXT
+                created_texts.append(created)
+            created_col.append(stamp)
+            if updated == created:
+                stamp = STAMP_SAME
+            else:
+                stamp = self.stamp(updated)
+                if stamp is None:
+                    stamp = STAMP_TEXT
+                    updated_texts.append(updated)
+            updated_col.append(stamp)
+        text = json.dumps(strings + created_texts + updated_texts)
+        values = ids + gids + offsets + lengths + created_col + updated_col
+        return (BLOCK_HEAD.pack(count, len(text)) +
+                struct.pack(_column_format(count), *values) + text)
 
-        # first initial the program
-        if not os.path.exists(self.filepath) or \
-                               not os.path.getsize(self.filepath):
-            # initiali the empty self.data and self._records
-            self._init_data()
-            self.initialized = True
-            return self.initialized
 
-        # validate the cipher and load the data
-        with open(filepath, 'rb') as f:
-            ciphertext = f.read()
-            jsondata = self.decrypt(ciphertext, self.cipher)
+def iter_unpack_records(chunks):
+    """unpack the records that `RecordPacker` packed from the chunks of
+    the index, each as a tuple of the `INDEX_FIELDS`.
+    """
+    stamps = {}
 
-        try:
-            self.data = json.loads(jsondata)
-            if self.data['digest'] == self.cipher:
-                self.initialized = True
-            # initiali the self._records
-            self._setup_structure()
-        except ValueError:
-            self.log.error('Error occur when load the JSON text.')
-        except Exception, err:
-            self.log.error('Error occur in AESHandler initialized - %s', err)
+    def iter_stamps(column, texts, created=None):
+        for i, stamp in enumerate(column):
+            if stamp == STAMP_TEXT:
+                yield next(texts)
+                continue
+            if stamp == STAMP_SAME:
+                yield created[i]
+                continue
+            text = stamps.get(stamp)
+            if text is None:
+                text = (EPOCH + timedelta(microseconds=stamp)).isoformat('_')
+                stamps[stamp] = text
+            yield text
 
-        return self.initialized
+    buf, pos = '', 0
+    for chunk in chunks:
+        buf = buf[pos:] + chunk
+        pos = 0
+        while len(buf) - pos >= BLOCK_HEAD.size:
+            count, text_length = BLOCK_HEAD.unpack_from(buf, pos)
+            column_format = _column_format(count)
+            start = pos + BLOCK_HEAD.size
+            end = start + struct.calcsize(column_format) + text_length
+            if end > len(buf):
+                break
+            values = struct.unpack_from(column_format, buf, start)
+            strings = json.loads(buf[end-text_length:end])
+            pos = end
 
-    def write(self):
-        """encrypt the infomations and dump into outside file.
+            # the block is taken apart column by column
+            ids, gids, offsets, lengths, created, updated = \
+                [values[i*count:(i+1)*count] for i in range(6)]
+            if NAN_GID in gids:
+                gids = [float('nan') if gid == NAN_GID else gid
+                        for gid in gids]
+            texts = iter(strings[4*count:])
+            created = list(iter_stamps(created, texts))
+            updated = list(iter_stamps(updated, texts, created))
+            for row in itertools.izip(ids, gids, strings[0:4*count:4],
+                                      strings[1:4*count:4],
+                                      strings[2:4*count:4], created, updated,
+                                      offsets, lengths, strings[3:4*count:4]):
+                yield row
+    if pos != len(buf):
+        raise ValueError('the index is truncated')
+
+
+def split_line(chunks):
+    """split the first line off the chunks, return it with the chunks of
+    the rest.
+    """
+    chunks = iter(chunks)
+    buf = ''
+    for chunk in chunks:
+        buf += chunk
+        if '\n' in buf:
+            line, rest = buf.split('\n', 1)
+            return line, itertools.chain([rest], chunks)
+    return buf, iter(())
+
+
+class CFBCipher(object):
+    """AES in CFB mode, the cipher of the legacy vaults and of the indexed
+    vaults written before the cipher was kept in the header. A ciphertext
+    is the random IV and the encrypted text, it is not authenticated.
+    """
+
+    name = 'cfb'
+
+    def __init__(self, key, spec=None):
+        self.key = key
+
+    @classmethod
+    def new_spec(cls):
+        return {'name': cls.name}
+
+    def encrypt(self, plaintext):
+        return AESHandler.encrypt(plaintext, self.key)
+
+    def decrypt(self, ciphertext):
+        return AESHandler.decrypt(ciphertext, self.key)
+
+    def encrypt_values(self, ids, plaintexts):
+        """encrypt the values like `AESHandler.value_encrypter`, with a
+        single call of the cipher for all of them, so the callers hand
+        over a bounded block of values at a time. The ids of the records
+        are not used, the values are not authenticated.
         """
-        jsontext = json.dumps(self.data)
-        with open(self.filepath, 'w') as f:
-            ciphertext = self.encrypt(jsontext, self.cipher)
-            f.write(ciphertext)
+        iv = Random.new().read(AES.block_size)
+        cipher = AES.new(self.key, AES.MODE_CFB, iv)
+        stream = iv + cipher.encrypt(''.join(plaintexts))
+        blobs, offset = [], 0
+        for text in plaintexts:
+            blobs.append(stream[offset:offset + AES.block_size + len(text)])
+            offset += len(text)
+        return blobs
 
-    def add_record(self, group, item, value, note=None):
+    def decrypt_value(self, blob, rid):
+        return self.decrypt(blob)
+
+    def iter_encrypt(self, chunks):
+        return AESHandler.iter_encrypt(chunks, self.key)
+
+    def iter_decrypt(self, buf, start=0, length=None):
+        return AESHandler.iter_decrypt(buf, self.key, start, length)
+
+
+class GCMCipher(object):
+    """AES in GCM mode, every ciphertext is authenticated, so a wrong key
+    or a damaged vault fails with a ValueError instead of decrypting to
+    garbage. pycryptodome runs it on AES-NI and CLMUL where the CPU has
+    them.
+
+    A single text (a journal entry) is sealed as the random nonce, the
+    encrypted text and the tag. A stream (the index of a vault) is sealed
+    in chunks of `chunk` bytes that are checked one by one as they are
+    decrypted, so the memory stays bounded. The stream begins with a
+    random prefix, the nonce of a chunk is the prefix and the number of
+    the chunk, and the last chunk is marked as the final one in its
+    associated data, so the chunks can neither be reordered nor cut off.
+
+    Setting up GCM costs about as much as sealing a few KB, which would
+    dominate the small values. So the values are encrypted as one AES-CTR
+    stream instead, each beginning at a block of the stream so that it
+    decrypts on its own, then authenticated with a truncated HMAC-SHA256
+    of the record id and the encrypted value, so the blobs of two records
+    can not be swapped either. Both keys are derived from the key of the
+    vault. The vaults written before the id was authenticated lack
+    `value_mac` in their spec, they keep the former MAC until a rekey.
+
+    :param spec: the dict that the vault header keeps.
+    """
+
+    name = 'gcm'
+    PREFIX_SIZE = GCM_NONCE_SIZE - 4
+
+    def __init__(self, key, spec=None):
+        self.key = key
+        self.chunk = (spec or {}).get('chunk', CHUNK_SIZE)
+        self.bind_ids = (spec or {}).get('value_mac') == 'id'
+        self.value_key = hmac.new(key, 'value cipher', hashlib.sha256).digest()
+        self.mac_key = hmac.new(key, 'value mac', hashlib.sha256).digest()
+        # the keyed state is copied for every value instead of set up again
+        self._hmac = hmac.new(self.mac_key, digestmod=hashlib.sha256)
+
+    @classmethod
+    def new_spec(cls):
+        return {'name': cls.name, 'chunk': CHUNK_SIZE, 'value_mac': 'id'}
+
+    def _new(self, nonce):
+        return AES.new(self.key, AES.MODE_GCM, nonce=nonce,
+                       mac_len=GCM_TAG_SIZE)
+
+    def encrypt(self, plaintext):
+        nonce = os.urandom(GCM_NONCE_SIZE)
+        ciphertext, tag = self._new(nonce).encrypt_and_digest(plaintext)
+        return nonce + ciphertext + tag
+
+    def decrypt(self, ciphertext):
+        if len(ciphertext) < GCM_NONCE_SIZE + GCM_TAG_SIZE:
+            raise ValueError('the ciphertext is truncated')
+        cipher = self._new(ciphertext[:GCM_NONCE_SIZE])
+        return cipher.decrypt_and_verify(ciphertext[GCM_NONCE_SIZE:-GCM_TAG_SIZE],
+                                         ciphertext[-GCM_TAG_SIZE:])
+
+    def _mac(self, body, rid):
+        mac = self._hmac.copy()
+        if self.bind_ids:
+            mac.update(struct.pack('>q', rid))
+        mac.update(body)
+        return mac.digest()[:16]
+
+    def encrypt_values(self, ids, plaintexts):
+        """seal the values of the records with the `ids` as one stream,
+        every value is the counter block it begins at, the encrypted text
+        and the MAC. The stream is encrypted with a single call of the
+        cipher, so the callers hand over a bounded block of values at a
+        time.
+        """
+        # the leading zero byte keeps the counter from wrapping around
+        block = '\x00' + os.urandom(AES.block_size - 1)
+        counter = long(block.encode('hex'), 16)
+        heads, padded = [], []
+        for text in plaintexts:
+            heads.append(('%032x' % counter).decode('hex'))
+            pad = -len(text) % AES.block_size
+            padded.append(text + '\x00' * pad)
+            counter += (len(text) + pad) // AES.block_size
+        cipher = AES.new(self.value_key, AES.MODE_CTR, nonce='',
+                         initial_value=block)
+        stream = cipher.encrypt(''.join(padded))
+        blobs, offset = [], 0
+        for rid, head, text in itertools.izip(ids, heads, plaintexts):
+            body = head + stream[offset:offset + len(text)]
+            offset += len(text) + -len(text) % AES.block_size
+            blobs.append(body + self._mac(body, rid))
+        return blobs
+
+    def decrypt_value(self, blob, rid):
+        body, mac = blob[:-16], blob[-16:]
+        if len(body) < AES.block_size or \
+                not hmac.compare_digest(self._mac(body, rid), mac):
+            raise ValueError('the value was damaged')
+        cipher = AES.new(self.value_key, AES.MODE_CTR, nonce='',
+                         initial_value=body[:AES.block_size])
+        return cipher.decrypt(body[AES.block_size:])
+
+    def _seal_chunk(self, prefix, number, text, final):
+        cipher = self._new(prefix + struct.pack('>I', number))
+        cipher.update('\x01' if final else '\x00')
+        ciphertext, tag = cipher.encrypt_and_digest(text)
+        return ciphertext + tag
+
+    def iter_encrypt(self, chunks):
+        """seal the plaintext chunks as one stream, the prefix comes first."""
+        prefix = os.urandom(self.PREFIX_SIZE)
+        yield prefix
+        number, buf = 0, ''
+        for piece in chunks:
+            buf += piece
+            # a full chunk is held back until it is known not to be the last
+            while len(buf) > self.chunk:
+                yield self._seal_chunk(prefix, number, buf[:self.chunk], False)
+                buf = buf[self.chunk:]
+                number += 1
+        yield self._seal_chunk(prefix, number, buf, True)
+
+    def iter_decrypt(self, buf, start=0, length=None):
+        """open the stream at `buf[start:start+length]` chunk by chunk.
+
+        :param buf: a string or a map that holds the stream.
+        """
+        end = len(buf) if length is None else start + length
+        prefix = buf[start:start+self.PREFIX_SIZE]
+        pos = start + self.PREFIX_SIZE
+        number = 0
+        while True:
+            stop = min(pos + self.chunk + GCM_TAG_SIZE, end)
+            if stop - pos < GCM_TAG_SIZE:
+                raise ValueError('the stream is truncated')
+            cipher = self._new(prefix + struct.pack('>I', number))
+            cipher.update('\x01' if stop == end else '\x00')
+            yield cipher.decrypt_and_verify(buf[pos:stop-GCM_TAG_SIZE],
+                                            buf[stop-GCM_TAG_SIZE:stop])
+            if stop == end:
+                break
+            pos = stop
+            number += 1
+
+
+CIPHERS = {
+    'cfb': CFBCipher,
+    'gcm': GCMCipher,
+}
+
+
+def _cipher_class(name):
+    if name not in CIPHERS:
+        raise ValueError('unknown cipher %r' % name)
+    if name == 'gcm' and not hasattr(AES, 'MODE_GCM'):
+        raise ValueError('AES-GCM needs the pycryptodome package')
+    return CIPHERS[name]
+
+
+def make_cipher(key, spec):
+    """the cipher of a vault from the dict that its header keeps."""
+    return _cipher_class(spec['name'])(key, spec)
+
+
+def new_cipher_spec(name):
+    """the dict that the header of a new vault keeps for the cipher."""
+    return _cipher_class(name).new_spec()
+
+
+class VaultFile(object):
+    """The value blobs of a vault in the indexed format, they are read
+    from a map of the file.
+
+    :param mapping: the map of the vault.
+    :param cipher: the cipher that the blobs were encrypted with.
+    :param offset: the offset of the first blob in the file.
+    :param instruments: the `Instruments` that count the bytes read.
+    """
+
+    def __init__(self, mapping, cipher, offset, instruments=None):
+        self.mapping = mapping
+        self.cipher = cipher
+        self.offset = offset
+        self.instruments = instruments
+
+    def raw(self, offset, length):
+        """the blob at `offset` without decrypting it."""
+        start = self.offset + offset
+        return self.mapping[start:start+length]
+
+    def read(self, offset, length, rid):
+        """decrypt the blob at `offset` of the record `rid`."""
+        ciphertext = self.raw(offset, length)
+        if self.instruments is not None:
+            self.instruments.count('bytes_read', length)
+        return json.loads(self.cipher.decrypt_value(ciphertext, rid))
+
+
+def read_index(mapping, key, instruments=None):
+    """decrypt and parse the index of a vault in the indexed format, see
+    `AESHandler._load_indexed`.
+
+    :param mapping: the map of the vault.
+    :param key: the key of the vault.
+    :param instruments: the `Instruments` that time the decryption, the
+                        decompression and the parsing.
+    :return: the header, the meta dict of the first line, an iterator of
+             the `INDEX_FIELDS` tuples of the records and the offset of
+             the first value blob.
+    """
+    header, start = read_header(mapping)
+    crypto = make_cipher(key, header.get('cipher', {'name': 'cfb'}))
+    chunks = crypto.iter_decrypt(mapping, start, header['index'])
+    if instruments is not None:
+        instruments.count('bytes_read', header['index'])
+        chunks = instruments.timed('decrypt', chunks)
+    chunks = iter_decompress(chunks, header.get('compression'))
+    if instruments is not None:
+        chunks = instruments.timed('decompress', chunks)
+    encoding = header.get('encoding', 'json')
+    if encoding == 'binary':
+        meta, chunks = split_line(chunks)
+        rows = iter_unpack_records(chunks)
+    else:
+        lines = iter_lines(chunks)
+        meta = next(lines)
+        rows = (json.loads(line) for line in lines)
+        if encoding == 'json':
+            rows = ((fields['id'], fields['gid'], fields['group'],
+                     fields['itemname'], fields['note'], fields['created'],
+                     fields['updated'], fields['value'][0],
+                     fields['value'][1], fields['mask']) for fields in rows)
+    if instruments is not None:
+        rows = instruments.timed('parse', rows, BLOCK_RECORDS)
+    return header, json.loads(meta), rows, start + header['index']
+
+
+class LazyValue(object):
+    """The value of a record that is still encrypted in the vault, it is
+    decrypted the first time the value is read.
+    """
+
+    __slots__ = ('vault', 'offset', 'length', 'mask')
+
+    def __init__(self, vault, offset, length, mask):
+        self.vault = vault
+        self.offset = offset
+        self.length = length
+        self.mask = mask
+
+    def load(self, rid):
+        return self.vault.read(self.offset, self.length, rid)
+
+
+class Record(object):
+    """A record of the vault.
+
+    The fields live in slots instead of a per-record dict, which cuts the
+    memory of large vaults. The item access of the former dict layout
+    (``record['value']``) is kept, so a record still reads like a dict.
+    The value may be a `LazyValue` until it is read.
+    """
+
+    FIELDS = ('id', 'gid', 'group', 'itemname', 'value', 'note',
+              'created', 'updated')
+    __slots__ = ('id', 'gid', 'group', 'itemname', '_value', 'note',
+                 'created', 'updated')
+
+    def __init__(self, id, gid, group, itemname, value, note=None,
+                 created=None, updated=None):
+        self.id = id
+        self.gid = gid
+        self.group = group
+        self.itemname = itemname
+        self.value = value
+        self.note = note
+        self.created = created
+        self.updated = updated
+
+    @property
+    def value(self):
+        value = self._value
+        if isinstance(value, LazyValue):
+            value = self._value = value.load(self.id)
+        return value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+
+    @property
+    def loaded(self):
+        """whether the value was decrypted already."""
+        return not isinstance(self._value, LazyValue)
+
+    def mask(self):
+        """the value with all but its first and last character hidden,
+        it does not decrypt a lazy value.
+        """
+        value = self._value
+        if isinstance(value, LazyValue):
+            return value.mask
+        if not value:
+            return u''
+        return u'****'.join((value[0], value[-1]))
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Record(%r)' % self.to_dict()
+
+    def keys(self):
+        return list(self.FIELDS)
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.FIELDS]
+
+    def get(self, key, default=None):
         try:
-            record = self._compose_record(group, item, value, note)
-            self.write()
-            self._adjust_structure(record)
-            return True
-        except Exception, err:
-            self.log.error('Error occur in adding record - %s', err)
-            return False
+            return self[key]
+        except KeyError:
+            return default
+
+    def copy(self):
+        # copy the slots, so that a lazy value stays encrypted
+        record = Record.__new__(Record)
+        for key in self.__slots__:
+            setattr(record, key, getattr(self, key))
+        return record
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+class GroupMembers(object):
+    """The records of a group in the order they joined it, the value of
+    ``records['_gid'][gid]``. It reads like the list it used to be, but a
+    record is added or removed in constant time.
+    """
+
+    __slots__ = ('_records',)
+
+    def __init__(self, records=()):
+        self._records = OrderedDict((record.id, record) for record in records)
+
+    def add(self, record):
+        self._records[record.id] = record
+
+    def remove(self, record):
+        del self._records[record.id]
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return self._records.itervalues()
+
+    def __contains__(self, record):
+        return self._records.get(getattr(record, 'id', None)) is record
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += len(self._records)
+        if not 0 <= index < len(self._records):
+            raise IndexError('group index out of range')
+        return next(itertools.islice(self._records.itervalues(), index, None))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'GroupMembers(%r)' % list(self)
+
+
+class SearchIndex(object):
+    """An in-memory trigram index over the item names, group names and
+    notes of the records.
+
+    Every field is lowercased and prefixed with a start marker before it is
+    split into trigrams, so a prefix query is answered by the trigrams that
+    contain the marker. The group names are few and shared by many
+    records, so they are indexed by name instead of by record.
+    """
+
+    FIELDS = ('itemname', 'group', 'note')
+    START = u'\x02'
+
+    def __init__(self):
+        # maps a trigram tagged with the first letter of its field to the
+        # set of the ids of the records containing it
+        self._grams = defaultdict(set)
+        # maps a trigram to the set of the group names containing it
+        self._group_grams = defaultdict(set)
+        # maps a group name to the set of the ids of its records
+        self._groups = defaultdict(set)
+
+    @classmethod
+    def _split(cls, text, tag=u''):
+        """the trigrams of `text`, the first one or two characters also
+        make a gram with the start marker so that short prefixes can be
+        looked up.
+        """
+        text = cls.START + text.lower()
+        grams = set(tag + text[i:i+3] for i in range(len(text) - 2))
+        grams.add(tag + text[:2])
+        return grams
+
+    @classmethod
+    def _query(cls, text, prefix, tag=u''):
+        """the trigrams to look up for `text`, and whether a record that
+        has all of them surely matches.
+        """
+        if prefix:
+            if len(text) == 1:
+                return set([tag + cls.START + text]), True
+            grams = set(tag + (cls.START + text)[i:i+3]
+                        for i in range(len(text) - 1))
+            return grams, len(text) == 2
+        elif len(text) >= 3:
+            grams = set(tag + text[i:i+3] for i in range(len(text) - 2))
+            return grams, len(text) == 3
+        return None, False
+
+    @staticmethod
+    def _intersect(index, grams):
+        # intersect from the rarest gram, so the sets stay small
+        sets = sorted((index.get(gram, ()) for gram in grams), key=len)
+        result = set(sets[0])
+        for items in sets[1:]:
+            if not result:
+                break
+            result.intersection_update(items)
+        return result
+
+    def add(self, record):
+        for field in ('itemname', 'note'):
+            text = getattr(record, field)
+            if text:
+                for gram in self._split(text, field[0]):
+                    self._grams[gram].add(record.id)
+
+        rids = self._groups[record.group]
+        rids.add(record.id)
+        if len(rids) == 1:
+            for gram in self._split(record.group):
+                self._group_grams[gram].add(record.group)
+
+    def remove(self, record):
+        """remove the record, it should be called before the indexed
+        fields of the record change.
+        """
+        for field in ('itemname', 'note'):
+            text = getattr(record, field)
+            if text:
+                for gram in self._split(text, field[0]):
+                    self._discard(self._grams, gram, record.id)
+
+        rids = self._groups[record.group]
+        rids.discard(record.id)
+        if not rids:
+            del self._groups[record.group]
+            for gram in self._split(record.group):
+                self._discard(self._group_grams, gram, record.group)
+
+    @staticmethod
+    def _discard(index, gram, item):
+        items = index.get(gram)
+        if items is not None:
+            items.discard(item)
+            if not items:
+                del index[gram]
+
+    @staticmethod
+    def _match(value, text, prefix):
+        if not value:
+            return False
+        value = value.lower()
+        return value.startswith(text) if prefix else text in value
+
+    def search(self, records, text, field=None, prefix=False):
+        """find the records that contain `text`, or start with it if
+        `prefix` is True, case insensitively.
+
+        :param records: the mapping of record id to record.
+        :param field: only look in this field, one of `FIELDS`. All of
+                      them are looked in by default.
+        :return: the list of matched records ordered by id.
+        """
+        text = text.lower()
+        matched = {}
+        for name in ((field,) if field else self.FIELDS):
+            if name == 'group':
+                grams, exact = self._query(text, prefix)
+                if grams is None:
+                    groups = self._groups.iterkeys()
+                else:
+                    groups = self._intersect(self._group_grams, grams)
+                for group in groups:
+                    if exact or self._match(group, text, prefix):
+                        for rid in self._groups[group]:
+                            matched[rid] = records[rid]
+                continue
+
+            grams, exact = self._query(text, prefix, name[0])
+            if grams is None:
+                rids = records.iterkeys()
+            else:
+                rids = self._intersect(self._grams, grams)
+            for rid in rids:
+                if rid in matched:
+                    continue
+                record = records[rid]
+                if exact or self._match(getattr(record, name), text, prefix):
+                    matched[rid] = record
+        return [matched[rid] for rid in sorted(matched)]
+
+
+class CompletionIndex(object):
+    """Sorted lists of the record ids, group ids, group names and item names
+    for the completion of the shell, a prefix is found by bisection.
+
+    The group ids, group names and item names are shared by many records,
+    so every word keeps the number of the records that have it, and leaves
+    the list with the last of them.
+    """
+
+    FIELDS = ('id', 'gid', 'group', 'itemname')
+
+    def __init__(self, records=()):
+        counts = dict((name, defaultdict(int)) for name in self.FIELDS)
+        for record in records:
+            for name, word in self._words(record):
+                counts[name][word] += 1
+        self._counts = counts
+        self._sorted = dict((name, sorted(counts[name]))
+                            for name in self.FIELDS)
+
+    @staticmethod
+    def _words(record):
+        yield 'id', unicode(record.id)
+        # the Invalid Group Name has no gid
+        if record.gid == record.gid:
+            yield 'gid', unicode(record.gid)
+        yield 'group', record.group
+        yield 'itemname', record.itemname
+
+    def add(self, record):
+        for name, word in self._words(record):
+            counts = self._counts[name]
+            if not counts[word]:
+                bisect.insort(self._sorted[name], word)
+            counts[word] += 1
+
+    def remove(self, record):
+        for name, word in self._words(record):
+            counts = self._counts[name]
+            counts[word] -= 1
+            if not counts[word]:
+                del counts[word]
+                words = self._sorted[name]
+                del words[bisect.bisect_left(words, word)]
+
+    def complete(self, field, prefix, limit=None):
+        """the words of `field` that start with `prefix` in order, at
+        most `limit` of them.
+        """
+        words = self._sorted[field]
+        matched = []
+        for i in xrange(bisect.bisect_left(words, prefix), len(words)):
+            if not words[i].startswith(prefix) or len(matched) == limit:
+                break
+            matched.append(words[i])
+        return matched
+
+
+class TimeIndex(object):
+    """Sorted lists of the created and the updated timestamps of the
+    records, as microseconds since the epoch, so the records of a range of
+    time are found by bisection. A timestamp that is not a time is left
+    out. A field is only indexed once it is built, the changes of the other
+    field are ignored.
+    """
+
+    FIELDS = ('created', 'updated')
+
+    def __init__(self):
+        # the days since the epoch of the dates seen so far
+        self._days = {}
+        # the timestamps by the record id, so the entry of a record is
+        # found after the record changed
+        self._stamps = {}
+        # the (timestamp, id) pairs in order
+        self._entries = {}
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def build(self, name, records):
+        """index the `name` field of the records."""
+        stamps, entries = {}, []
+        for record in records:
+            stamp = time_micros(getattr(record, name), self._days)
+            if stamp is not None:
+                stamps[record.id] = stamp
+                entries.append((stamp, record.id))
+        entries.sort()
+        self._stamps[name], self._entries[name] = stamps, entries
+
+    def _discard(self, name, rid, stamp):
+        entries = self._entries[name]
+        del entries[bisect.bisect_left(entries, (stamp, rid))]
+
+    def add(self, record):
+        """index the record, or index it again after it changed."""
+        for name, stamps in self._stamps.iteritems():
+            stamp = time_micros(getattr(record, name), self._days)
+            old = stamps.get(record.id)
+            if stamp == old:
+                continue
+            if old is not None:
+                self._discard(name, record.id, old)
+                del stamps[record.id]
+            if stamp is not None:
+                stamps[record.id] = stamp
+                bisect.insort(self._entries[name], (stamp, record.id))
+
+    def remove(self, record):
+        for name, stamps in self._stamps.iteritems():
+            old = stamps.pop(record.id, None)
+            if old is not None:
+                self._discard(name, record.id, old)
+
+    def range(self, field, start=None, end=None, reverse=False, offset=0,
+              limit=None):
+        """the ids of the records whose `field` is from `start` until
+        `end` (excluded), the oldest first unless `reverse`.
+
+        :param start: the microseconds since the epoch, or None.
+        :param end: the microseconds since the epoch, or None.
+        :param offset: the number of the records to skip.
+        :param limit: the most ids to return.
+        """
+        entries = self._entries[field]
+        lo = 0 if start is None else bisect.bisect_left(entries, (start,))
+        hi = len(entries) if end is None else \
+            bisect.bisect_left(entries, (end,))
+        if reverse:
+            hi -= offset
+            if limit is not None:
+                lo = max(lo, hi - limit)
+            selected = entries[lo:max(lo, hi)]
+            selected.reverse()
+        else:
+            lo += offset
+            if limit is not None:
+                hi = min(hi, lo + limit)
+            selected = entries[lo:hi]
+        return [rid for stamp, rid in selected]
+
+
+# the sort keys of the orders of `AESHandler.cursor`, the id breaks the ties
+CURSOR_ORDERS = {
+    'id': lambda record: record.id,
+    'name': lambda record: (record.itemname.lower(), record.id),
+    'updated': lambda record: (record.updated, record.id),
+}
+
+# the fields of the records that `export` writes and `import` reads
+EXPORT_FIELDS = ('group', 'itemname', 'value', 'note', 'created', 'updated')
+
+
+def guess_format(filepath):
+    """the format of an import or export file by its extension."""
+    return 'csv' if filepath.lower().endswith('.csv') else 'jsonl'
+
+
+def read_rows(f, fmt):
+    """read the records of an export file one by one.
+
+    :param fmt: ``'csv'`` for a CSV file with a header row of the
+                `EXPORT_FIELDS`, ``'jsonl'`` for a JSON object per line.
+    """
+    if fmt == 'csv':
+        reader = csv.reader(f)
+        header = next(reader, [])
+        # the columns of the fields, a plain reader saves building a dict
+        # that is thrown away for every row
+        columns = [(key, header.index(key)) for key in EXPORT_FIELDS
+                   if key in header]
+        for row in reader:
+            if not row:
+                continue
+            fields = dict([(key, unicode(row[i], 'utf-8'))
+                           for key, i in columns])
+            for key in ('note', 'created', 'updated'):
+                fields[key] = fields.get(key) or None
+            yield fields
+    else:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_rows(f, rows, fmt):
+    """write the records one by one in the format of `read_rows`."""
+    if fmt == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(EXPORT_FIELDS)
+        for row in rows:
+            writer.writerow([unicode(row[key]).encode('utf-8')
+                             if row[key] is not None else ''
+                             for key in EXPORT_FIELDS])
+    else:
+        for row in rows:
+            f.write(json.dumps(row, default=_json_default) + '\n')
+
+
+def synchronized(method):
+    """run the method of the handler with the write side of its lock
+    held, no other thread reads or changes the records meanwhile.
+    """
+    def wrapper(self, *args, **kwargs):
+        with self._lock.write():
+            return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+def shared(method):
+    """run the method of the handler with the read side of its lock
+    held, along with the other readers.
+    """
+    def wrapper(self, *args, **kwargs):
+        with self._lock.read():
+            return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class RWLock(object):
+    """A lock that lets in many readers at once or a single writer. A
+    waiting writer keeps the new readers out, so it is not starved.
+
+    Both sides may be taken again by the thread that holds them, and the
+    writer may read as well, but a reader may not upgrade to a writer.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._waiting = 0
+        self._writer = None
+        self._depth = 0
+        # how many times the current thread holds the read side
+        self._local = threading.local()
+
+    def acquire_read(self):
+        local = self._local
+        if getattr(local, 'depth', 0):
+            local.depth += 1
+            return
+        with self._cond:
+            if self._writer == threading.current_thread():
+                self._depth += 1
+                return
+            while self._writer is not None or self._waiting:
+                self._cond.wait()
+            self._readers += 1
+        local.depth = 1
+
+    def release_read(self):
+        local = self._local
+        if getattr(local, 'depth', 0):
+            local.depth -= 1
+            if local.depth:
+                return
+        with self._cond:
+            if self._writer == threading.current_thread():
+                self._depth -= 1
+                return
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.current_thread()
+        with self._cond:
+            if self._writer == me:
+                self._depth += 1
+                return
+            self._waiting += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._waiting -= 1
+            self._writer = me
+            self._depth = 1
+
+    def release_write(self):
+        with self._cond:
+            self._depth -= 1
+            if not self._depth:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+def exclusive(method):
+    """run the method of the handler with its lock and the lock of the
+    vault file held, after loading what the other processes wrote.
+    """
+    def wrapper(self, *args, **kwargs):
+        with self._lock.write():
+            with self._exclusive():
+                return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class Instruments(object):
+    """The timing spans and the counters of the work of a handler.
+
+    A span measures a block, its time is kept in total and without the
+    spans nested in it, so the self times of the spans add up to the time
+    that was measured. Every finished span and every increment of a
+    counter is handed to the sinks as ``sink(kind, name, value)``, where
+    `kind` is ``'span'`` (the value is the seconds) or ``'count'``.
+
+    :param sinks: the callables, `LogSink` and `StatsFile` are such sinks.
+    """
+
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+        self._lock = threading.Lock()
+        # the stack of the open spans of every thread, with the time spent
+        # in their nested spans
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # the count, total, self and max seconds by the span name
+            self.spans = {}
+            self.counters = defaultdict(int)
+
+    @contextmanager
+    def span(self, name):
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(0.0)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self._add_span(name, elapsed, elapsed - nested)
+
+    def timed(self, name, iterable, batch=1):
+        """iterate over `iterable`, producing every `batch` items is a
+        span, a batch keeps the spans of small items from costing more
+        than the items.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.span(name):
+                items = list(itertools.islice(iterator, batch))
+            if not items:
+                return
+            for item in items:
+                yield item
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+        for sink in self.sinks:
+            sink('count', name, n)
+
+    def _add_span(self, name, elapsed, own):
+        with self._lock:
+            stat = self.spans.get(name)
+            if stat is None:
+                stat = self.spans[name] = [0, 0.0, 0.0, 0.0]
+            stat[0] += 1
+            stat[1] += elapsed
+            stat[2] += own
+            stat[3] = max(stat[3], elapsed)
+        for sink in self.sinks:
+            sink('span', name, elapsed)
+
+    def report(self):
+        """the cumulative spans and counters as a dict."""
+        with self._lock:
+            spans = dict((name, dict(zip(('count', 'total', 'self', 'max'),
+                                         stat)))
+                         for name, stat in self.spans.iteritems())
+            return {'spans': spans, 'counters': dict(self.counters)}
+
+
+class NullSpan(object):
+    """the span of a handler without instruments, it measures nothing."""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_SPAN = NullSpan()
+
+
+class LogSink(object):
+    """a sink that logs every span and count."""
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger('papyrus')
+        self.level = level
+
+    def __call__(self, kind, name, value):
+        self.logger.log(self.level, '%s %s %s', kind, name, value)
+
+
+class StatsFile(object):
+    """a sink that appends every span and count to a file as a line of
+    JSON.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def __call__(self, kind, name, value):
+        line = json.dumps({'time': time.time(), 'kind': kind, 'name': name,
+                           'value': value})
+        with self._lock:
+            self.file.write(line + '\n')
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+
+
+def _json_default(obj):
+    """let the `json` module serialize the records."""
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    raise TypeError('%r is not JSON serializable' % obj)
+
+
+class AESHandler(object):
+    """Handler that control and manage the infomations of user, use 
+    AES to encrypt/decrypt user infomations
+    """
+
+    def __init__(self, journal=False, compact_threshold=1000,
+                 vault_format='indexed', write_behind=False, flush_delay=0.5,
+                 fsync='always', fsync_interval=1.0, backups=1,
+                 kdf=None, kdf_params=None, cipher_mode=None,
+                 compression='zlib', record_encoding='compact', agent=None,
+                 instruments=None):
+        """
+        :param journal: if True, every mutation is appended to the journal
+                        file as a separately encrypted entry instead of
+                        rewriting the whole vault.
+        :param compact_threshold: the number of journal entries that
+                                  trigger folding the journal back into a
+                                  new snapshot.
+        :param vault_format: the format that `write` uses, ``'indexed'``
+                             keeps an encrypted index of the records and
+                             encrypts every value separately, so a value
+                             is only decrypted when it is read.
+                             ``'legacy'`` encrypts the whole vault as one
+                             JSON text. Both formats can be read, so a
+                             legacy vault migrates on its next write.
+        :param write_behind: if True, the mutations are persisted by a
+                             background thread, which waits `flush_delay`
+                             seconds after a mutation so that a burst of
+                             mutations is persisted at once. `sync` and
+                             `close` wait until everything is persisted.
+        :param fsync: when the writes are flushed to the disk. With
+                      ``'always'`` every write is durable once it returns.
+                      With ``'batched'`` the vault is still replaced
+                      atomically, but the directory is not synced and the
+                      journal is synced at most every `fsync_interval`
+                      seconds and by `sync`. With ``'never'`` the disk
+                      is never synced.
+        :param backups: the number of the former generations of the vault
+                        kept as `filepath.1` ... `filepath.<backups>`.
+        :param kdf: the key derivation function of the new vaults,
+                    ``'scrypt'`` (the default when it is available) or
+                    ``'pbkdf2'``. A vault keeps the function and the costs
+                    it was created with in its header, the legacy format
+                    has no header and always uses a single SHA-256 pass.
+        :param kdf_params: the costs that override `KDF_PARAMS`.
+        :param cipher_mode: the cipher of the new vaults, ``'gcm'`` (the
+                            default when the AES module has it) or
+                            ``'cfb'``. Like the key derivation function
+                            it is kept in the header, and a vault moves
+                            to another cipher by `rekey`. The legacy
+                            format always uses ``'cfb'``.
+        :param compression: the codec that `write` compresses the index
+                            with, ``'zlib'``, ``'bz2'`` or None.
+        :param record_encoding: how `write` encodes the records of the
+                                index, ``'compact'`` writes a JSON array
+                                of `INDEX_FIELDS` for each record,
+                                ``'json'`` a JSON object with the keys,
+                                and ``'binary'`` packs them with
+                                `RecordPacker`, which is smaller before
+                                the index is compressed.
+                                The header keeps both choices, so every
+                                vault can be read whatever the handler
+                                writes.
+        :param agent: an `AgentClient`, the keys are taken from the agent
+                      when `initialize` is given no passphrase and handed
+                      to it after a successful unlock.
+        :param instruments: the `Instruments` that time the key
+                            derivation, the decryption, the parsing, the
+                            encryption and the writes, and count the
+                            bytes and the records. Nothing is measured
+                            without them.
+        """
+        if fsync not in ('always', 'batched', 'never'):
+            raise ValueError('unknown fsync policy %r' % fsync)
+        if kdf is None:
+            kdf = 'pbkdf2' if scrypt is None else 'scrypt'
+        if kdf not in KDF_PARAMS:
+            raise ValueError('unknown key derivation function %r' % kdf)
+        if cipher_mode is None:
+            cipher_mode = 'gcm' if hasattr(AES, 'MODE_GCM') else 'cfb'
+        new_cipher_spec(cipher_mode)
+        if compression is not None and compression not in CODECS:
+            raise ValueError('unknown compression %r' % compression)
+        if record_encoding not in ('binary', 'compact', 'json'):
+            raise ValueError('unknown record encoding %r' % record_encoding)
+        # Initialize Log
+        self.log = logging.getLogger('papyrus')
+        # Initialize the attributes of class
+        self.initialized = False
+        self.filepath = ''
+        self.cipher = ''
+        self.data = None
+        self.journal = journal
+        self.compact_threshold = compact_threshold
+        self.vault_format = vault_format
+        # the value blobs of the loaded vault in the indexed format
+        self._vault = None
+        self._journal_entries = 0
+        # the state saved by `begin` and the mutations deferred until
+        # `commit`, both are None when there is no open batch.
+        self._snapshot = None
+        self._pending = None
+        # the mutations waiting for the writer thread in write-behind mode
+        self.write_behind = write_behind
+        self.flush_delay = flush_delay
+        self._queued = OrderedDict()
+        self._writer = None
+        self._closing = False
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.backups = backups
+        self.kdf = kdf
+        self.kdf_params = kdf_params or {}
+        self.cipher_mode = cipher_mode
+        self.compression = compression
+        self.record_encoding = record_encoding
+        self.agent = agent
+        self.instruments = instruments
+        # the key derivation function and the cipher of the loaded vault
+        self._kdf = {'name': 'sha256'}
+        self._cipher_mode = {'name': 'cfb'}
+        # the lock of the vault file, and what the vault and its journal
+        # looked like when this handler last read or wrote them.
+        self._file_lock = None
+        self._stamp = None
+        self._generation = 0
+        self._journal_offset = 0
+        # when the journal was synced last, and whether it was written since
+        self._journal_synced = 0
+        self._journal_dirty = False
+        # the lock lets many threads read the records at once, while the
+        # changes are made by one thread at a time.
+        self._lock = RWLock()
+        # wakes up the writer thread when there are queued mutations
+        self._wakeup = threading.Condition(threading.Lock())
+        # guards building the search index by the first search
+        self._index_lock = threading.Lock()
+        # self._records is a proxy structure mapping to the records of 
+        # self.data and is use for better retrieve records.
+        self._records = defaultdict(dict)
+        self._positions = {}
+        # the search index is built by the first search
+        self._index = None
+        # the completion index is built by the first completion
+        self._completion = None
+        # the index of the timestamps is built by the first range query
+        self._times = None
+        # the table of interned group names and item names
+        self._strings = {}
+
+    @property
+    def journal_path(self):
+        return self.filepath + '.journal'
+
+    def initialize(self, cipher, filepath='records.dat'):
+        """
+        validate the cipher and load the data from outside file.
+
+        :param cipher: the passphrase, or None to take the key from the
+                       agent.
+        :return: True if successfully initialize, else will be False
+        """
+        self.filepath = filepath
+        self.initialized = False
+        self._file_lock = FileLock(filepath + '.lock')
+
+        try:
+            with self._exclusive(refresh=False):
+                self._initialize(cipher)
+                # replay the mutations logged after the snapshot
+                if self.initialized:
+                    self._replay_journal()
+                    if cipher is not None and self.agent is not None:
+                        self.agent.put(self._agent_id(), self.cipher)
+        except ValueError:
+            self.initialized = False
+            self.log.error('Error occur when load the JSON text.')
+        except Exception, err:
+            self.initialized = False
+            self.log.error('Error occur in AESHandler initialized - %s', err)
+
+        return self.initialized
+
+    def _initialize(self, cipher):
+        # finish the write that a crash interrupted
+        if recover_file(self.filepath):
+            self.log.warning('Recover the interrupted write of `%s`.',
+                             self.filepath)
+        # first initial the program
+        if not os.path.exists(self.filepath) or \
+                               not os.path.getsize(self.filepath):
+            mapping = None
+            self._kdf = self._new_kdf()
+            self._cipher_mode = self._new_cipher_mode()
+        else:
+            mapping = map_file(self.filepath)
+            if mapping[:len(VAULT_MAGIC)] == VAULT_MAGIC:
+                header = read_header(mapping)[0]
+                self._kdf = header.get('kdf', {'name': 'sha256'})
+                self._cipher_mode = header.get('cipher', {'name': 'cfb'})
+            else:
+                self._kdf = {'name': 'sha256'}
+                self._cipher_mode = {'name': 'cfb'}
+        self.cipher = self._unlock(cipher)
+        if self.cipher is None:
+            return
+        # initiali the empty self.data and self._records, the records
+        # are added to them one by one while they are loaded.
+        self._init_data()
+        self._setup_structure()
+        self._generation = 0
+        if mapping is None:
+            self.initialized = True
+            # the new vault is written at once, its header keeps the salt
+            # of the key that the journal entries and the other processes
+            # that open the vault need.
+            if 'salt' in self._kdf:
+                self.write()
+        else:
+            # validate the cipher and load the data
+            if mapping[:len(VAULT_MAGIC)] == VAULT_MAGIC:
+                self._load_indexed(mapping)
+            else:
+                self._load_legacy(mapping)
+            if self.data['digest'] == self._digest():
+                self.initialized = True
+
+    def _reload(self):
+        """load the vault and its journal again with the current key."""
+        self._init_data()
+        self._setup_structure()
+        self._generation = 0
+        if os.path.exists(self.filepath) and os.path.getsize(self.filepath):
+            mapping = map_file(self.filepath)
+            if mapping[:len(VAULT_MAGIC)] == VAULT_MAGIC:
+                self._load_indexed(mapping)
+            else:
+                self._load_legacy(mapping)
+            if self.data['digest'] != self._digest():
+                raise ValueError('the vault was encrypted with another key')
+        self._replay_journal()
+
+    def _current_stamp(self):
+        """what tells that the vault or its journal were written: the
+        inode, size and mtime of both files and the generation of the
+        vault, all of them are read without decrypting anything.
+        """
+        stamp = []
+        for path in (self.filepath, self.journal_path):
+            try:
+                st = os.stat(path)
+                stamp.append((st.st_ino, st.st_size, st.st_mtime))
+            except OSError:
+                stamp.append(None)
+        stamp.append(read_generation(self.filepath))
+        return tuple(stamp)
+
+    @synchronized
+    def refresh(self):
+        """load what the other processes wrote since this handler read or
+        wrote the vault. If only the journal grew, just its new entries are
+        replayed.
+
+        :return: True if anything was loaded.
+        """
+        # nobody else writes while this handler holds the lock
+        if self._file_lock is None or self._file_lock.depth:
+            return False
+        with self._exclusive(refresh=False):
+            return self._refresh()
+
+    def _refresh(self):
+        if not self.initialized:
+            return False
+        stamp = self._current_stamp()
+        if stamp == self._stamp:
+            return False
+        vault, journal, generation = stamp
+        old_vault, old_journal, old_generation = self._stamp
+        if (vault, generation) == (old_vault, old_generation) and \
+                journal and old_journal and journal[0] == old_journal[0] and \
+                journal[1] >= self._journal_offset:
+            self._replay_journal(self._journal_offset)
+        else:
+            self._reload()
+        self._stamp = stamp
+        return True
+
+    def _lock_file(self, refresh=True):
+        """take the lock of the vault file, the changes of the other
+        processes are loaded first if `refresh`.
+        """
+        lock = self._file_lock
+        if lock is None:
+            return
+        lock.acquire()
+        if refresh and lock.depth == 1:
+            try:
+                self._refresh()
+            except:
+                self._unlock_file()
+                raise
+
+    def _unlock_file(self):
+        lock = self._file_lock
+        if lock is None:
+            return
+        if lock.depth == 1:
+            # whatever the vault is now, it was written by this handler
+            self._stamp = self._current_stamp()
+        lock.release()
+
+    @contextmanager
+    def _exclusive(self, refresh=True):
+        """context that holds the lock of the vault file, see
+        `_lock_file`.
+        """
+        self._lock_file(refresh)
+        try:
+            yield
+        finally:
+            self._unlock_file()
+
+    def _new_kdf(self, kdf=None, params=None):
+        """the key derivation function of a new vault, with a new salt."""
+        if self.vault_format == 'legacy':
+            return {'name': 'sha256'}
+        name = kdf or self.kdf
+        spec = dict(KDF_PARAMS[name], name=name,
+                    salt=Random.new().read(16).encode('hex'))
+        spec.update(params if params is not None else self.kdf_params)
+        return spec
+
+    def _new_cipher_mode(self, mode=None):
+        """the cipher of a new vault."""
+        if self.vault_format == 'legacy':
+            return {'name': 'cfb'}
+        return new_cipher_spec(mode or self.cipher_mode)
+
+    def _crypto(self):
+        """the cipher of the loaded vault with its key."""
+        return make_cipher(self.cipher, self._cipher_mode)
+
+    def span(self, name):
+        """a span of the instruments, or one that measures nothing, so the
+        callers of the handler time their operations alongside its own.
+        """
+        if self.instruments is None:
+            return NULL_SPAN
+        return self.instruments.span(name)
+
+    def _timed(self, name, iterable, batch=1):
+        if self.instruments is None:
+            return iterable
+        return self.instruments.timed(name, iterable, batch)
+
+    def _count(self, name, n=1):
+        if self.instruments is not None:
+            self.instruments.count(name, n)
+
+    def _unlock(self, cipher):
+        """derive the key of the vault, or ask the agent for it."""
+        if cipher is not None:
+            with self.span('kdf'):
+                return derive_key(cipher, self._kdf)
+        if self.agent is not None:
+            return self.agent.get(self._agent_id())
+        return None
+
+    def _agent_id(self):
+        """the name of the key in the agent, the salt tells apart the
+        vaults that were created again at the same path.
+        """
+        return '%s:%s' % (os.path.realpath(self.filepath),
+                          self._kdf.get('salt', ''))
+
+    def _digest(self):
+        """the digest that the vault keeps to validate the key."""
+        if self._kdf['name'] == 'sha256':
+            return self.cipher
+        return hashlib.sha256(self.cipher).hexdigest()
+
+    @exclusive
+    def rekey(self, passphrase, kdf=None, cipher_mode=None, **params):
+        """encrypt the vault with the key derived from a new passphrase
+        and a new salt, it is also how a vault moves to another key
+        derivation function, to other costs or to another cipher.
+        """
+        if self._pending is not None:
+            raise ValueError('the batch must be committed first')
+        self.sync()
+        # the values are decrypted with the old key before it is dropped,
+        # so that the write encrypts them all with the new one.
+        for record in self.data['records']:
+            record._value = record.value
+        self._kdf = self._new_kdf(kdf, params)
+        self._cipher_mode = self._new_cipher_mode(cipher_mode)
+        with self.span('kdf'):
+            self.cipher = derive_key(passphrase, self._kdf)
+        self.data['digest'] = self._digest()
+        # the journal entries are encrypted with the old key as well
+        self.compact()
+        # the backups would still open with the old passphrase, which may
+        # be why it was changed
+        remove_backups(self.filepath)
+        if self.agent is not None:
+            self.agent.put(self._agent_id(), self.cipher)
+
+    def _load_legacy(self, mapping):
+        """load a vault in the legacy format, the JSON text is decoded as
+        it is decrypted.
+        """
+        self._count('bytes_read', len(mapping))
+        with self.span('load'):
+            chunks = self._timed('decrypt',
+                                 self.iter_decrypt(mapping, self.cipher))
+            rows = iter_json_records(chunks, self.data)
+            rows = self._timed('parse', rows, BLOCK_RECORDS)
+            for fields in rows:
+                self._load_record(self._make_record(fields))
+        self._count('records_loaded', len(self.data['records']))
+        mapping.close()
+        self._vault = None
+
+    def _load_indexed(self, mapping):
+        """load the index of a vault in the indexed format, which is laid
+        out as::
+
+            VAULT_MAGIC | header length | header | index | value blobs
+
+        The header is a plain JSON object with the format version, the
+        length of the index and how the index is compressed and encoded.
+        The index is an encrypted text whose first line holds the
+        counters, and each following line a record whose value is the
+        (offset, length) of its encrypted blob.
+
+        The index is decrypted, decompressed and parsed chunk by chunk
+        straight from the map, so neither the ciphertext nor the plaintext
+        is held whole.
+        """
+        header, meta, rows, base = read_index(mapping, self.cipher,
+                                              self.instruments)
+        self._generation = header.get('generation', 0)
+        self._cipher_mode = header.get('cipher', {'name': 'cfb'})
+        vault = VaultFile(mapping, self._crypto(), base, self.instruments)
+        self.data.update(meta)
+        self._load_rows(vault, rows)
+        self._vault = vault
+
+    def _load_rows(self, vault, rows):
+        """add the records of the index whose values are in `vault`.
+
+        :param rows: the `INDEX_FIELDS` tuples of the records.
+        """
+        intern = self._intern
+        loaded = len(self.data['records'])
+        with self.span('load'):
+            for (id, gid, group, itemname, note, created, updated,
+                 offset, length, mask) in rows:
+                value = LazyValue(vault, offset, length, mask)
+                self._load_record(Record(id, gid, intern(group),
+                                         intern(itemname), value, note,
+                                         created, updated))
+        self._count('records_loaded', len(self.data['records']) - loaded)
+
+    @synchronized
+    def write(self):
+        """encrypt the infomations and dump into outside file.
+        """
+        with self._exclusive(refresh=False), self.span('write'):
+            if self.vault_format == 'legacy':
+                self._write_legacy()
+            else:
+                self._write_indexed()
+            # the snapshot holds what the journal logged, replaying the
+            # journal on top of it would undo the later changes
+            self._truncate_journal()
+
+    def _truncate_journal(self):
+        if os.path.exists(self.journal_path):
+            open(self.journal_path, 'wb').close()
+        self._journal_entries = 0
+        self._journal_offset = 0
+        self._journal_dirty = False
+
+    def _write_legacy(self):
+        if self._kdf['name'] != 'sha256':
+            # the key could not be derived again without the salt
+            raise ValueError('the legacy format has no room for the salt '
+                             'of the key, rekey the vault first')
+        # the JSON text is encrypted piece by piece as it is generated
+        encoder = json.JSONEncoder(default=_json_default)
+        pieces = rechunk(encoder.iterencode(self.data))
+        pieces = self._timed('encode', pieces)
+        with self._replacing() as f:
+            chunks = self.iter_encrypt(pieces, self.cipher)
+            for chunk in self._timed('encrypt', chunks):
+                f.write(chunk)
+            self._count('bytes_written', f.tell())
+        self._count('records_written', len(self.data['records']))
+        self._vault = None
+
+    def _write_indexed(self):
+        records = self.data['records']
+        with self._replacing() as f:
+            blobs, base = self._dump_indexed(f, records)
+        self._vault = self._repoint(self.filepath, records, blobs, base)
+        self._generation += 1
+
+    def _dump_indexed(self, f, records, **meta):
+        """write `records` to `f` in the indexed format.
+
+        :param meta: more entries of the first line of the index.
+        :return: the blobs of the values that were encrypted, by the
+                 record id, and the offset of the first blob in `f`.
+        """
+        # the blobs of the values that were not changed are copied as they
+        # are, so only the changed values need to be encrypted. They are
+        # encrypted a block at a time, so no string holds all of them.
+        crypto = self._crypto()
+        changed = [record for record in records
+                   if not isinstance(record._value, LazyValue)]
+        blobs = {}
+        with self.span('encrypt'):
+            for start in xrange(0, len(changed), BLOCK_RECORDS):
+                block = changed[start:start + BLOCK_RECORDS]
+                ids = [record.id for record in block]
+                texts = [json.dumps(record._value) for record in block]
+                blobs.update(itertools.izip(ids, crypto.encrypt_values(ids,
+                                                                       texts)))
+        del changed
+        encode = json.JSONEncoder().encode
+        packer = RecordPacker()
+        encoding = self.record_encoding
+
+        def iter_index():
+            for key in ('digest', 'currentID', 'currentGID'):
+                meta[key] = self.data[key]
+            yield json.dumps(meta)
+            if encoding == 'binary':
+                yield '\n'
+            offset = 0
+            for record in records:
+                value = record._value
+                if isinstance(value, LazyValue):
+                    length = value.length
+                else:
+                    length = len(blobs[record.id])
+                if encoding == 'binary':
+                    if packer.add(record.id, record.gid, record.group,
+                                  record.itemname, record.note,
+                                  record.created, record.updated, offset,
+                                  length, record.mask()):
+                        yield packer.pack()
+                elif encoding == 'compact':
+                    yield '\n' + encode([record.id, record.gid, record.group,
+                                         record.itemname, record.note,
+                                         record.created, record.updated,
+                                         offset, length, record.mask()])
+                else:
+                    yield '\n' + encode({
+                        'id': record.id,
+                        'gid': record.gid,
+                        'group': record.group,
+                        'itemname': record.itemname,
+                        'note': record.note,
+                        'created': record.created,
+                        'updated': record.updated,
+                        'value': (offset, length),
+                        'mask': record.mask(),
+                    })
+                offset += length
+            if encoding == 'binary':
+                yield packer.pack()
+
+        def iter_blobs():
+            for record in records:
+                value = record._value
+                if isinstance(value, LazyValue):
+                    yield value.vault.raw(value.offset, value.length)
+                else:
+                    yield blobs[record.id]
+
+        # the header is written last, when the length of the index is
+        # known.
+        f.write(VAULT_MAGIC + struct.pack('>I', HEADER_SIZE))
+        f.write(' ' * HEADER_SIZE)
+        start = f.tell()
+        index = self._timed('encode', iter_index(), BLOCK_RECORDS)
+        index = iter_compress(rechunk(index), self.compression)
+        index = self._timed('compress', index)
+        for chunk in self._timed('encrypt', crypto.iter_encrypt(index)):
+            f.write(chunk)
+        index = f.tell() - start
+        for chunk in rechunk(iter_blobs()):
+            f.write(chunk)
+        end = f.tell()
+        f.seek(len(VAULT_MAGIC) + 4)
+        header = json.dumps({'version': 2, 'index': index,
+                             'kdf': self._kdf,
+                             'cipher': self._cipher_mode,
+                             'compression': self.compression,
+                             'encoding': self.record_encoding,
+                             'generation': self._generation + 1})
+        if len(header) > HEADER_SIZE:
+            raise ValueError('the header does not fit in %d bytes'
+                             % HEADER_SIZE)
+        f.write(header.ljust(HEADER_SIZE))
+        f.seek(end)
+        self._count('bytes_written', end)
+        self._count('records_written', len(records))
+        return blobs, start + index
+
+    def _repoint(self, filepath, records, blobs, base):
+        """map the file that `_dump_indexed` wrote and point the values of
+        `records` to their new blobs in it.
+
+        :return: the `VaultFile` of the blobs.
+        """
+        vault = VaultFile(map_file(filepath), self._crypto(), base,
+                          self.instruments)
+
+        # point every value to its new blob, so the plaintext values are
+        # dropped and the next write copies them as well.
+        offset = 0
+        for record in records:
+            value = record._value
+            if isinstance(value, LazyValue):
+                length, mask = value.length, value.mask
+            else:
+                length, mask = len(blobs[record.id]), record.mask()
+            record._value = LazyValue(vault, offset, length, mask)
+            offset += length
+        return vault
+
+    def _replacing(self):
+        return replacing_file(self.filepath, sync=self.fsync != 'never',
+                              sync_dir=self.fsync == 'always',
+                              backups=self.backups)
+
+    @exclusive
+    def compact(self):
+        """fold the journal back into a new snapshot of the vault, then
+        truncate the journal.
+        """
+        self.write()
+
+    def _persist(self, op, record):
+        """persist a single mutation.
+
+        In journal mode the mutation is appended to the journal, otherwise
+        the whole vault is rewritten.
+
+        :param op: ``'put'`` for a created or changed record, ``'del'`` for
+                   a deleted record.
+        :param record: the record that the mutation applies to.
+        """
+        self._count('records_touched')
+        if self._pending is not None:
+            # only the last mutation of a record matters at commit time
+            self._pending.pop(record.id, None)
+            self._pending[record.id] = (op, record)
+        else:
+            self._store([(op, record)])
+
+    def _store(self, mutations):
+        """persist the mutations, or hand them to the writer thread in
+        write-behind mode.
+
+        :param mutations: a list of (op, record) pairs.
+        """
+        if not self.write_behind:
+            self._flush_mutations(mutations)
+            return
+        if not self._queued:
+            # the vault stays locked until the queue is written, so that no
+            # other process writes in between.
+            self._lock_file(refresh=False)
+        for op, record in mutations:
+            # the records change in place, a copy keeps the queued state
+            # from a change that is rolled back before the flush
+            self._queued.pop(record.id, None)
+            self._queued[record.id] = (op, record.copy())
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_behind_loop,
+                                            name='papyrus-writer')
+            self._writer.daemon = True
+            self._writer.start()
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def _flush_mutations(self, mutations):
+        if self.journal:
+            self._append_journal(mutations)
+        else:
+            self.write()
+
+    def _write_behind_loop(self):
+        while True:
+            with self._wakeup:
+                while not self._queued and not self._closing:
+                    self._wakeup.wait()
+                if self._closing:
+                    return
+            # let the rest of the burst arrive before the flush
+            time.sleep(self.flush_delay)
+            try:
+                self.sync()
+            except Exception, err:
+                # the mutations stay queued, so they are retried with the
+                # next flush
+                self.log.error('Error occur in writing behind - %s', err)
+
+    @synchronized
+    def sync(self):
+        """persist the mutations that are waiting for the writer thread,
+        it returns when they are on the disk.
+        """
+        if self._queued:
+            self._flush_mutations(self._queued.values())
+            self._queued.clear()
+            self._unlock_file()
+        if self._journal_dirty:
+            with open(self.journal_path, 'ab') as f:
+                os.fsync(f.fileno())
+            self._journal_synced = time.time()
+            self._journal_dirty = False
+
+    def close(self):
+        """persist everything and stop the writer thread."""
+        with self._wakeup:
+            self._closing = True
+            self._wakeup.notify()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+        self.sync()
+        self._closing = False
+
+    def _append_journal(self, mutations):
+        """append the mutations to the journal with a single write.
+
+        :param mutations: a list of (op, record) pairs.
+        """
+        chunks = []
+        crypto = self._crypto()
+        for op, record in mutations:
+            entry = {
+                'op': op,
+                'record': record if op == 'put' else {'id': record.id},
+                'currentID': self.data['currentID'],
+                'currentGID': self.data['currentGID'],
+            }
+            with self.span('encode'):
+                jsontext = json.dumps(entry, default=_json_default)
+            with self.span('encrypt'):
+                ciphertext = crypto.encrypt(jsontext)
+            chunks.append(struct.pack('>I', len(ciphertext)) + ciphertext)
+        self._count('bytes_written', sum(len(chunk) for chunk in chunks))
+        with self.span('journal'), open(self.journal_path, 'ab') as f:
+            f.write(''.join(chunks))
+            f.flush()
+            if self.fsync == 'always' or (self.fsync == 'batched' and
+                    time.time() - self._journal_synced >= self.fsync_interval):
+                os.fsync(f.fileno())
+                self._journal_synced = time.time()
+                self._journal_dirty = False
+            else:
+                self._journal_dirty = self.fsync == 'batched'
+        self._journal_entries += len(chunks)
+        self._journal_offset += sum(len(chunk) for chunk in chunks)
+        if self._journal_entries >= self.compact_threshold:
+            self.compact()
+
+    @property
+    def in_batch(self):
+        return self._pending is not None
+
+    @synchronized
+    def begin(self):
+        """open a batch, the mutations after it are kept in memory until
+        `commit` writes them at once or `rollback` discards them.
+
+        :return: False if a batch is already open, else True.
+        """
+        if self.in_batch:
+            return False
+        # the other threads and processes wait until the batch ends
+        self._lock.acquire_write()
+        self._lock_file()
+        self._snapshot = dict(self.data)
+        self._snapshot['records'] = [r.copy() for r in self.data['records']]
+        self._pending = OrderedDict()
+        return True
+
+    @synchronized
+    def commit(self):
+        """persist the mutations of the open batch with a single write.
+
+        :return: False if there is no open batch, else True.
+        """
+        if not self.in_batch:
+            return False
+        mutations = self._pending.values()
+        if mutations:
+            self._store(mutations)
+        self._snapshot = self._pending = None
+        self._unlock_file()
+        self._lock.release_write()
+        return True
+
+    @synchronized
+    def rollback(self):
+        """discard the mutations of the open batch and restore `data` and
+        `_records` to the state of `begin`.
+
+        :return: False if there is no open batch, else True.
+        """
+        if not self.in_batch:
+            return False
+        self.data = self._snapshot
+        self._snapshot = self._pending = None
+        self._setup_structure()
+        self._unlock_file()
+        self._lock.release_write()
+        return True
+
+    @contextmanager
+    def batch(self):
+        """context that commits the mutations in its block with a single
+        write, or rolls all of them back if the block raises. A nested
+        batch joins the outer one.
+        """
+        if self.in_batch:
+            yield self
+            return
+        self.begin()
+        try:
+            yield self
+        except:
+            self.rollback()
+            raise
+        # a failed write leaves the batch open, so roll it back as well
+        try:
+            self.commit()
+        except:
+            self.rollback()
+            raise
+
+    def _replay_journal(self, start=0):
+        """apply the journal entries on top of the loaded snapshot.
+
+        The entries are idempotent (a `put` carries the whole record), so
+        replaying a journal that was already folded into the snapshot is
+        harmless.
+
+        :param start: the offset of the first entry to apply, the entries
+                      before it were applied already.
+        """
+        if not start:
+            self._journal_entries = 0
+        self._journal_offset = start
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'rb') as f:
+            f.seek(start)
+            journal = f.read()
+        self._count('bytes_read', len(journal))
+
+        crypto = self._crypto()
+        offset, size = 0, len(journal)
+        while offset + 4 <= size:
+            length, = struct.unpack('>I', journal[offset:offset+4])
+            if offset + 4 + length > size:
+                # a torn tail left by a crash during an append, it is cut
+                # off so the next entries are not appended behind it
+                self.log.warning('Drop the incomplete journal entry.')
+                with open(self.journal_path, 'r+b') as f:
+                    f.truncate(start + offset)
+                break
+            ciphertext = journal[offset+4:offset+4+length]
+            with self.span('decrypt'):
+                jsontext = crypto.decrypt(ciphertext)
+            with self.span('parse'):
+                entry = json.loads(jsontext)
+            offset += 4 + length
+
+            old = self._records['_rid'].get(entry['record']['id'])
+            if old is not None:
+                self._unindex_record(old)
+            if entry['op'] == 'put':
+                record = self._make_record(entry['record'])
+                if old is not None:
+                    self.data['records'][self._positions[record.id]] = record
+                    self._adjust_structure(record)
+                else:
+                    self._load_record(record)
+            elif old is not None:
+                self._remove_record(old)
+            self.data['currentID'] = entry['currentID']
+            self.data['currentGID'] = entry['currentGID']
+            self._journal_entries += 1
+            self._journal_offset = start + offset
+
+    @exclusive
+    def add_record(self, group, item, value, note=None):
+        try:
+            record = self._compose_record(group, item, value, note)
+            self._adjust_structure(record)
+            self._persist('put', record)
+            return True
+        except Exception, err:
+            self.log.error('Error occur in adding record - %s', err)
+            return False
+
+    @exclusive
+    def add_records(self, rows):
+        """add many records with a single write, `rows` is consumed one
+        by one so it may be a stream. If a row is invalid none of the
+        records is added.
+
+        :param rows: dicts of the `EXPORT_FIELDS`, the `note`, `created`
+                     and `updated` may be left out.
+        :return: the ids of the added records.
+        """
+        created = datetime.today().isoformat('_')
+        ids = []
+        # the search index is built again by the next search, and the
+        # other indexes by their next query, at once
+        self._index = None
+        self._completion = None
+        self._times = None
+        with self.batch():
+            for row in rows:
+                record = self._compose_record(row['group'], row['itemname'],
+                                              row['value'], row.get('note'),
+                                              row.get('created') or created)
+                record.updated = row.get('updated') or record.created
+                self._adjust_structure(record)
+                self._persist('put', record)
+                ids.append(record.id)
+        return ids
+
+    def export_records(self):
+        """iterate over the records as dicts of the `EXPORT_FIELDS`."""
+        with self.read():
+            # a deletion moves the last record into the hole, so they are
+            # sorted back into the order they were added
+            records = sorted(self.data['records'], key=lambda r: r.id)
+        for record in records:
+            value = record._value
+            # decrypt a lazy value without keeping the plaintext
+            if isinstance(value, LazyValue):
+                value = value.load(record.id)
+            yield {
+                'group': record.group,
+                'itemname': record.itemname,
+                'value': value,
+                'note': record.note,
+                'created': record.created,
+                'updated': record.updated,
+            }
+
+    @exclusive
+    def update_record(self, record_id, value, note=None):
+        record_id = int(record_id)
+        if self._records['_rid'].has_key(record_id):
+            try:
+                record = self._records['_rid'][record_id]
+                record.value = value
+                record.updated = datetime.today().isoformat('_')
+                if self._times is not None:
+                    self._times.add(record)
+                if note:
+                    if self._index is not None:
+                        self._index.remove(record)
+                    record.note = note
+                    if self._index is not None:
+                        self._index.add(record)
+                self._persist('put', record)
+                return True
+            except Exception, err:
+                self.log.error('Error occur in updating record - %s', err)
+                return False
+        else:
+            return False
+
+    @exclusive
+    def move_record(self, record_id, group_id):
+        record_id, group_id = int(record_id), int(group_id)
+        if record_id in self._records['_rid'] and group_id in self._records['_gid']:
+            try:
+                record = self._records['_rid'][record_id]
+                if record.gid == group_id:
+                    self.log.warning('The group_id already is the record '
+                                     'gid, no need to move.')
+                    return False
+
+                new_group = self.group_name(group_id)
+                # delete the old data
+                self._unindex_record(record)
+                record.gid = group_id
+                record.group = new_group
+                record.updated = datetime.today().isoformat('_')
+
+                self._adjust_structure(record)
+                self._persist('put', record)
+                return True
+            except Exception, err:
+                self.log.error('Error occur in updating record - %s', err)
+                return False
+        else:
+            return False
+
+    @exclusive
+    def delete_record(self, record_id):
+        record_id = int(record_id)
+        if self._records['_rid'].has_key(record_id):
+            try:
+                record = self._records['_rid'][record_id]
+                self._unindex_record(record)
+                self._remove_record(record)
+                self._persist('del', record)
+                return True
+            except Exception, err:
+                self.log.error('Error occur in deleting record - %s', err)
+                raise
+                return False
+        else:
+            return False
+
+    @property
+    def records(self):
+        """the records by id, by group id and by group name. The other
+        threads may change them, so hold `read` while using them::
+
+            with handler.read():
+                record = handler.records['_rid'][rid]
+        """
+        return self._records
+
+    def read(self):
+        """context that holds the read side of the lock of the handler,
+        the records are not changed by the other threads within it.
+        """
+        return self._lock.read()
+
+    def cursor(self, gid=None, order='id', reverse=False, offset=0,
+               limit=None):
+        """iterate over the records, or over those of the group `gid`, in
+        a stable order without copying them all.
+
+        In the order of the ids, the records are looked up one by one as
+        they are iterated, so a long iteration does not keep the lock and
+        sees the changes that are made meanwhile. In the other orders the
+        first `offset + limit` records are selected at once.
+
+        :param order: ``'id'``, ``'name'`` (the item name, case
+                      insensitively) or ``'updated'``.
+        :param offset: the number of the records to skip.
+        :param limit: the most records to iterate over.
+        """
+        if order not in CURSOR_ORDERS:
+            raise ValueError('unknown order %r' % order)
+        stop = None if limit is None else offset + limit
+        with self.read():
+            if order == 'id':
+                if gid is None:
+                    ids = xrange(self.data['currentID'])
+                else:
+                    ids = sorted(record.id for record in
+                                 self._records['_gid'].get(gid, ()))
+                if reverse:
+                    ids = reversed(ids)
+                lookup = self._records['_rid'].get
+                records = (lookup(rid) for rid in ids)
+                records = (record for record in records
+                           if record is not None and
+                           (gid is None or record.gid == gid))
+            else:
+                if gid is None:
+                    records = self._records['_rid'].itervalues()
+                else:
+                    records = iter(self._records['_gid'].get(gid, ()))
+                key = CURSOR_ORDERS[order]
+                if stop is None:
+                    records = sorted(records, key=key, reverse=reverse)
+                elif reverse:
+                    records = heapq.nlargest(stop, records, key)
+                else:
+                    records = heapq.nsmallest(stop, records, key)
+        return itertools.islice(records, offset, stop)
+
+    @shared
+    def get_record(self, record_id, default=None):
+        """return the record with the id, or `default`."""
+        return self._records['_rid'].get(int(record_id), default)
+
+    @shared
+    def search(self, text, field=None, prefix=False):
+        """find the records whose item name, group name or note contain
+        `text`, see `SearchIndex.search`.
+        """
+        with self._index_lock:
+            if self._index is None:
+                index = SearchIndex()
+                for record in self.data['records']:
+                    index.add(record)
+                self._index = index
+        return self._index.search(self._records['_rid'], text, field, prefix)
+
+    @shared
+    def complete(self, field, prefix, limit=None):
+        """the words of `field` that start with `prefix`, see
+        `CompletionIndex.complete`.
+
+        :param field: ``'id'``, ``'gid'``, ``'group'`` or ``'itemname'``.
+        """
+        with self._index_lock:
+            if self._completion is None:
+                self._completion = CompletionIndex(self.data['records'])
+        return self._completion.complete(field, prefix, limit)
+
+    @shared
+    def time_range(self, field, start=None, end=None, reverse=False,
+                   offset=0, limit=None):
+        """the records whose `field` is from `start` until `end` (excluded),
+        the oldest first unless `reverse`, see `TimeIndex.range`.
+
+        :param field: ``'created'`` or ``'updated'``.
+        :param start: a `datetime` or a timestamp text, None for no bound.
+        :param end: a `datetime` or a timestamp text, None for no bound.
+        """
+        if field not in TimeIndex.FIELDS:
+            raise ValueError('unknown time field %r' % field)
+        bounds = []
+        for value in (start, end):
+            stamp = None if value is None else time_micros(value)
+            if value is not None and stamp is None:
+                raise ValueError('%r is not a time' % (value,))
+            bounds.append(stamp)
+        with self._index_lock:
+            if self._times is None:
+                self._times = TimeIndex()
+            if field not in self._times:
+                self._times.build(field, self.data['records'])
+        ids = self._times.range(field, bounds[0], bounds[1], reverse,
+                                offset, limit)
+        records = self._records['_rid']
+        return [records[rid] for rid in ids]
+
+    def stale(self, days, reverse=False, offset=0, limit=None):
+        """the records that were not updated in the last `days` days, the
+        longest unchanged first unless `reverse`.
+
+        :raise ValueError: if `days` is not a number of days that a date
+                           can go back.
+        """
+        try:
+            end = datetime.today() - timedelta(days=days)
+        except OverflowError:
+            raise ValueError('%r days is out of range' % days)
+        return self.time_range('updated', None, end, reverse, offset, limit)
+
+    @shared
+    def group_name(self, gid):
+        """return the name of the group that `gid` refers to."""
+        return self._records['_gid'][gid][0]['group']
+
+    def _init_data(self):
+        structure = {
+            'digest': self._digest(),
+            'records': [],
+            'currentID': 0,
+            'currentGID': 0,
+        }
+        self.data = structure
+
+    def _setup_structure(self):
+        self._records = defaultdict(dict)
+        # self._positions maps the record id to its index in
+        # self.data['records'], so that a record is removed without a scan.
+        self._positions = {}
+        self._index = None
+        self._completion = None
+        self._times = None
+        with self.span('setup_structure'):
+            for i, record in enumerate(self.data['records']):
+                self._positions[record.id] = i
+                self._adjust_structure(record)
+
+    def _load_record(self, record):
+        """add a loaded record to self.data and self._records."""
+        self._positions[record.id] = len(self.data['records'])
+        self.data['records'].append(record)
+        self._adjust_structure(record)
+
+    def _remove_record(self, record):
+        """delete the record in the data['records'], the last record fills
+        the hole so that nothing has to be shifted. The records are then no
+        longer in the order of their ids, which `export_records` restores.
+        """
+        records = self.data['records']
+        i = self._positions.pop(record.id)
+        last = records.pop()
+        if i < len(records):
+            records[i] = last
+            self._positions[last.id] = i
+
+    def _adjust_structure(self, record):
+        rid, gid = record.id, record.gid
+        group = record.group
+        item = record.itemname
+        self._records['_rid'][rid] = record
+        members = self._records['_gid'].get(gid)
+        if members is None:
+            members = self._records['_gid'][gid] = GroupMembers()
+        members.add(record)
+        self._records[group][item] = record
+        if self._index is not None:
+            self._index.add(record)
+        if self._completion is not None:
+            self._completion.add(record)
+        if self._times is not None:
+            self._times.add(record)
+
+        # groupmap is a helper subdict contain (group, gid) pairs
+        if not self._records['_gidmap'].has_key(group):
+            self._records['_gidmap'][group] = record.gid
+
+    def _unindex_record(self, record):
+        """delete the record in the self._records, the emptied group is
+        deleted as well.
+
+        :param record: the record to be deleted.
+        """
+        rid, gid = record.id, record.gid
+        group, item = record.group, record.itemname
+        del self._records['_rid'][rid]
+        if self._index is not None:
+            self._index.remove(record)
+        if self._completion is not None:
+            self._completion.remove(record)
+        if self._times is not None:
+            self._times.remove(record)
+
+        members = self._records['_gid'][gid]
+        members.remove(record)
+        if not members:
+            del self._records['_gid'][gid]
+            del self._records[group]
+            self._records['_gidmap'].pop(group, None)
+            return
+
+        items = self._records[group]
+        if items.get(item) is record:
+            del items[item]
+            # a record of the group with the same item name was shadowed
+            # by this one, it takes its place
+            for other in members:
+                if other.itemname == item:
+                    items[item] = other
+                    break
+
+    def _intern(self, text):
+        """share one string object among the records that repeat it."""
+        return self._strings.setdefault(text, text)
+
+    def _make_record(self, fields):
+        """build a `Record` from the dict layout of the JSON text."""
+        return Record(fields['id'], fields['gid'],
+                      self._intern(fields['group']),
+                      self._intern(fields['itemname']), fields['value'],
+                      fields['note'], fields['created'], fields['updated'])
+
+    def _compose_record(self, group, item, value, note=None, created=None):
+        created = created or datetime.today().isoformat('_')
+        # handle some state about group id
+        if group in ('_rid', '_gid', '_gidmap'):
+            group = 'Invalid Group Name'
+            gid = float('nan')    # Not a number
+        elif self._records.has_key(group):
+            gid = self._records['_gidmap'][group]
+        else:
+            gid = self.data['currentGID']
+            self.data['currentGID'] += 1
+
+        # the `id` is increase use the currentID field
+        record = Record(self.data['currentID'], gid, self._intern(group),
+                        self._intern(item), value, note, created, created)
+        self.data['currentID'] += 1
+        self._positions[record.id] = len(self.data['records'])
+        self.data['records'].append(record)
+        return record
+
+    @classmethod
+    def figure_32Byte_key(cls, text):
+        sha = hashlib.sha256()
+        sha.update(text)
+        digest = sha.hexdigest()[::2]
+
+        if len(text) > 32:
+            return digest
+        else:
+            keystr = text + digest
+            return keystr[:32]
+
+    @classmethod
+    def encrypt(cls, plaintext, key):
+        iv = Random.new().read(AES.block_size)
+        cipher = AES.new(key, AES.MODE_CFB, iv)
+        msg = iv + cipher.encrypt(plaintext)
+        return msg
+
+    @classmethod
+    def value_encrypter(cls, key):
+        """return a function that encrypts many values like `encrypt`,
+        but as one stream with a single random IV. Each ciphertext begins
+        with the block of the stream before it, the IV that decrypts it on
+        its own, so setting up a cipher per value is saved.
+        """
+        cipher = AES.new(key, AES.MODE_CFB, Random.new().read(AES.block_size))
+        state = [cipher.IV]
+
+        def encrypt(plaintext):
+            msg = state[0] + cipher.encrypt(plaintext)
+            state[0] = msg[-AES.block_size:]
+            return msg
+        return encrypt
+
+    @classmethod
+    def iter_encrypt(cls, chunks, key):
+        """encrypt the plaintext chunks as one stream, the IV comes first."""
+        iv = Random.new().read(AES.block_size)
+        cipher = AES.new(key, AES.MODE_CFB, iv)
+        yield iv
+        for chunk in chunks:
+            yield cipher.encrypt(chunk)
+
+    @classmethod
+    def iter_decrypt(cls, buf, key, start=0, length=None,
+                     chunk_size=CHUNK_SIZE):
+        """decrypt the ciphertext at `buf[start:start+length]` piece by
+        piece, the IV is read from its first block.
+
+        :param buf: a string or a map that holds the ciphertext.
+        """
+        end = len(buf) if length is None else start + length
+        iv = buf[start:start+AES.block_size]
+        cipher = AES.new(key, AES.MODE_CFB, iv)
+        for pos in xrange(start + AES.block_size, end, chunk_size):
+            yield cipher.decrypt(buf[pos:min(pos + chunk_size, end)])
+
+    @classmethod
+    def decrypt(cls, ciphertext, key):
+        iv = ciphertext[:AES.block_size]
+        cipher = AES.new(key, AES.MODE_CFB, iv)
+        return cipher.decrypt(ciphertext[AES.block_size:])
+
+
+def load_shard(task):
+    """decrypt and parse the index of a shard, it runs in the processes of
+    the pool that `ShardedAESHandler` loads the shards with.
+
+    :param task: the path of the shard and the key of the vault.
+    :return: the `INDEX_FIELDS` tuples of the records and the offset of
+             the first value blob. The tuples are marshalled, which is
+             much faster than the pickling of the pool.
+    """
+    path, key = task
+    mapping = map_file(path)
+    try:
+        header, meta, rows, base = read_index(mapping, key)
+        return marshal.dumps(list(rows)), base
+    finally:
+        mapping.close()
+
+
+class ShardedAESHandler(AESHandler):
+    """A vault that is split into shards, a directory holds an encrypted
+    manifest and a file in the indexed format for every shard::
+
+        records.d/manifest
+        records.d/shard-000-<generation>.dat
+        ...
+
+    The records are spread over the shards by their group or by their id,
+    so a write rewrites just the shards whose records changed, and the
+    manifest that lists the shards and keeps the counters. The shards are
+    written under new names and the old ones are removed once the new
+    manifest is in place, so a crash leaves the former vault whole. The
+    former generations are not kept, `backups` does not apply.
+
+    The shards are decrypted and parsed in parallel by a pool of
+    processes, the records are then added to the indexes one shard after
+    another.
+    """
+
+    def __init__(self, shards=16, shard_by='group', processes=None,
+                 **kwargs):
+        """
+        :param shards: the number of shards of a new vault, a vault keeps
+                       the number it was created with.
+        :param shard_by: ``'group'`` keeps the records of a group in the
+                         same shard, ``'id'`` spreads them by their id.
+        :param processes: the size of the pool that loads the shards, the
+                          number of CPUs by default. With 1 the shards are
+                          loaded in this process.
+        The other parameters are those of `AESHandler`, but only the
+        indexed format is written.
+        """
+        if shard_by not in ('group', 'id'):
+            raise ValueError('unknown shard key %r' % shard_by)
+        super(ShardedAESHandler, self).__init__(**kwargs)
+        if self.vault_format != 'indexed':
+            raise ValueError('a sharded vault is always indexed')
+        self.shards = shards
+        self.shard_by = shard_by
+        self.processes = processes or multiprocessing.cpu_count()
+        self.backups = 0
+        # the file names of the shards, None for an empty shard
+        self._files = [None] * shards
+        self._shard_by = shard_by
+        # the shards whose records changed since they were written
+        self._dirty = set()
+        # the records are not marked while they are loaded
+        self._loading = False
+
+    @property
+    def directory(self):
+        return os.path.dirname(self.filepath)
+
+    def initialize(self, cipher, dirpath='records.d'):
+        """
+        validate the cipher and load the shards of the vault directory, it
+        is created if it is missing.
+        """
+        try:
+            if not os.path.isdir(dirpath):
+                os.makedirs(dirpath)
+        except OSError, err:
+            self.log.error('Error occur in creating `%s` - %s', dirpath, err)
+            return False
+        return super(ShardedAESHandler, self).initialize(
+            cipher, os.path.join(dirpath, 'manifest'))
+
+    def _shard(self, record):
+        """the shard that `record` belongs to."""
+        key = record.gid if self._shard_by == 'group' else record.id
+        if key != key:
+            # the Invalid Group Name has no gid
+            return 0
+        return int(key) % len(self._files)
+
+    def _mark(self, record):
+        if not self._loading:
+            self._dirty.add(self._shard(record))
+
+    def _init_data(self):
+        super(ShardedAESHandler, self)._init_data()
+        self._files = [None] * self.shards
+        self._shard_by = self.shard_by
+        self._dirty = set()
+
+    def _setup_structure(self):
+        self._loading = True
+        try:
+            super(ShardedAESHandler, self)._setup_structure()
+        finally:
+            self._loading = False
+
+    def _adjust_structure(self, record):
+        self._mark(record)
+        super(ShardedAESHandler, self)._adjust_structure(record)
+
+    def _unindex_record(self, record):
+        # the shard the record leaves, when it is moved or deleted
+        self._mark(record)
+        super(ShardedAESHandler, self)._unindex_record(record)
+
+    def _persist(self, op, record):
+        self._mark(record)
+        super(ShardedAESHandler, self)._persist(op, record)
+
+    @exclusive
+    def rekey(self, passphrase, kdf=None, cipher_mode=None, **params):
+        # every shard is encrypted with the new key, they are marked once
+        # the lock is held, since loading the changes of the other
+        # processes clears the marks
+        self._dirty.update(xrange(len(self._files)))
+        super(ShardedAESHandler, self).rekey(passphrase, kdf, cipher_mode,
+                                             **params)
+
+    def _load_indexed(self, mapping):
+        header, meta, rows, base = read_index(mapping, self.cipher,
+                                              self.instruments)
+        mapping.close()
+        if 'shards' not in meta:
+            raise ValueError('`%s` is not the manifest of a sharded vault'
+                             % self.filepath)
+        self._generation = header.get('generation', 0)
+        self._cipher_mode = header.get('cipher', {'name': 'cfb'})
+        self._files = meta.pop('shards')
+        self._shard_by = meta.pop('shard_by')
+        self._dirty = set()
+        self.data.update(meta)
+        paths = [os.path.join(self.directory, name)
+                 for name in self._files if name is not None]
+        crypto = self._crypto()
+        self._loading = True
+        try:
+            for mapping, rows, base in self._load_shards(paths):
+                vault = VaultFile(mapping, crypto, base, self.instruments)
+                self._load_rows(vault, rows)
+        finally:
+            self._loading = False
+
+    def _load_shards(self, paths):
+        """decrypt and parse the indexes of the shards.
+
+        :return: the map of every shard with the `INDEX_FIELDS` tuples of
+                 its records and the offset of its first value blob.
+        """
+        if self.processes < 2 or len(paths) < 2:
+            for path in paths:
+                mapping = map_file(path)
+                header, meta, rows, base = read_index(mapping, self.cipher,
+                                                      self.instruments)
+                yield mapping, rows, base
+            return
+        # the records of a shard are added while the pool still parses the
+        # next ones
+        pool = multiprocessing.Pool(min(self.processes, len(paths)))
+        try:
+            results = pool.imap(load_shard,
+                                [(path, self.cipher) for path in paths])
+            # the time spent waiting for the pool
+            results = self._timed('parse', results)
+            for path, (rows, base) in itertools.izip(paths, results):
+                yield map_file(path), marshal.loads(rows), base
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _write_indexed(self):
+        """write the changed shards under new names, then the manifest that
+        lists them.
+        """
+        generation = self._generation + 1
+        members = dict((n, []) for n in self._dirty)
+        for record in self.data['records']:
+            records = members.get(self._shard(record))
+            if records is not None:
+                records.append(record)
+        files = list(self._files)
+        written = []
+        for n, records in sorted(members.iteritems()):
+            if not records:
+                files[n] = None
+                continue
+            files[n] = 'shard-%03d-%d.dat' % (n, generation)
+            path = os.path.join(self.directory, files[n])
+            # nothing reads the new shard before the manifest lists it, so
+            # it is written in place, and the directory is synced with the
+            # manifest.
+            with open(path, 'wb') as f:
+                blobs, base = self._dump_indexed(f, records)
+                f.flush()
+                if self.fsync != 'never':
+                    os.fsync(f.fileno())
+            written.append((path, records, blobs, base))
+        with self._replacing() as f:
+            self._dump_indexed(f, [], shards=files, shard_by=self._shard_by)
+        for path, records, blobs, base in written:
+            self._repoint(path, records, blobs, base)
+        # the shards that the manifest no longer lists, and those left by
+        # a write that did not finish
+        current = set(name for name in files if name is not None)
+        for name in os.listdir(self.directory):
+            if name.startswith('shard-') and name not in current:
+                os.remove(os.path.join(self.directory, name))
+        self._files = files
+        self._dirty = set()
+        self._generation = generation
+
+
+class PapyrusException(Exception):
+    """Exception class for papyrus."""
+    pass
+
+
+def prepare_socket(path):
+    """make the directory of a Unix socket reachable by its owner only,
+    and remove the socket of a server that died.
+
+    :raise ValueError: if a server is listening on `path`.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, 0700)
+    if os.path.exists(path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except socket.error:
+            os.remove(path)
+        else:
+            raise ValueError('a server is running on `%s`' % path)
+        finally:
+            sock.close()
+
+
+def agent_path():
+    """the socket of the agent, `PAPYRUS_AGENT_SOCK` overrides it."""
+    return os.environ.get('PAPYRUS_AGENT_SOCK') or \
+        os.path.join(os.path.expanduser('~'), '.papyrus', 'agent.sock')
+
+
+class _AgentRequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            response = self.server.dispatch(json.loads(line))
+        except (ValueError, KeyError, TypeError), err:
+            response = {'error': str(err)}
+        self.wfile.write(json.dumps(response) + '\n')
+
+
+class KeyAgent(SocketServer.UnixStreamServer):
+    """The session agent that holds the derived keys of the unlocked
+    vaults, so the next `papyrus` does not derive them again.
+
+    The agent serves one JSON request per connection on a Unix socket that
+    only its owner can reach, and it exits (forgetting the keys) once no
+    request came for `timeout` seconds.
+    """
+
+    def __init__(self, path=None, timeout=900):
+        self.path = path or agent_path()
+        self.idle_timeout = timeout
+        self.keys = {}
+        self.expired = False
+        self._last = time.time()
+        prepare_socket(self.path)
+        mask = os.umask(0177)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, self.path,
+                                                   _AgentRequestHandler)
+        finally:
+            os.umask(mask)
+
+    def dispatch(self, request):
+        self._last = time.time()
+        op = request['op']
+        if op == 'get':
+            return {'key': self.keys.get(request['vault'])}
+        elif op == 'put':
+            self.keys[request['vault']] = request['key']
+        elif op == 'forget':
+            self.keys.clear()
+        elif op == 'stop':
+            self.expired = True
+        elif op != 'ping':
+            raise ValueError('unknown request %r' % op)
+        return {'ok': True}
+
+    def handle_timeout(self):
+        self.expired = True
+
+    def serve(self):
+        """serve the requests until the agent is idle or stopped."""
+        try:
+            while not self.expired:
+                self.timeout = max(self._last + self.idle_timeout - time.time(),
+                                   0)
+                self.handle_request()
+        finally:
+            self.keys.clear()
+            self.server_close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+class AgentClient(object):
+    """The client of the `KeyAgent`, every request fails quietly (with
+    None) when no agent is running.
+    """
+
+    def __init__(self, path=None, timeout=5):
+        self.path = path or agent_path()
+        self.timeout = timeout
+
+    def _request(self, **request):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+            sock.sendall(json.dumps(request) + '\n')
+            return json.loads(sock.makefile('rb').readline())
+        except (socket.error, ValueError):
+            return None
+        finally:
+            sock.close()
+
+    def ping(self):
+        return self._request(op='ping') is not None
+
+    def get(self, vault):
+        """the key of the vault, or None if the agent does not hold it."""
+        response = self._request(op='get', vault=vault)
+        if response and response.get('key'):
+            return response['key'].decode('hex')
+        return None
+
+    def put(self, vault, key):
+        return self._request(op='put', vault=vault, key=key.encode('hex'))
+
+    def forget(self):
+        return self._request(op='forget')
+
+    def stop(self):
+        return self._request(op='stop')
+
+
+class CommandRunner(object):
+    """Run the commands of a script against one handler, for `papyrus
+    exec`. A command is either a line like the shell command::
+
+        add web google answer42 'a note'
+
+    or a JSON object such as::
+
+        {"op": "add", "group": "web", "item": "google", "value": "answer42"}
+
+    The supported commands are `add`, `update`, `delete`, `mv`, `info` and
+    `search`, and every command gives a JSON result.
+    """
+
+    # the arguments of the commands in the order of the line syntax, the
+    # optional ones last.
+    ARGS = {
+        'add': (('group', 'item', 'value'), ('note',)),
+        'update': (('id', 'value'), ('note',)),
+        'delete': (('id',), ()),
+        'mv': (('id', 'gid'), ()),
+        'info': (('id',), ()),
+        'search': (('text',), ('field',)),
+    }
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def parse(self, line):
+        """turn a line of the script into a command dict."""
+        if line.lstrip().startswith('{'):
+            return json.loads(line)
+        args = [arg.decode('utf-8') for arg in shlex.split(line)]
+        if not args or args[0] not in self.ARGS:
+            raise ValueError(u'unknown command `%s`' % line.strip())
+        required, optional = self.ARGS[args[0]]
+        if not len(required) <= len(args) - 1 <= len(required) + len(optional):
+            raise ValueError(u'wrong number of arguments for `%s`' % args[0])
+        command = dict(zip(required + optional, args[1:]))
+        command['op'] = args[0]
+        if args[0] == 'search':
+            command['prefix'] = command['text'].endswith('*')
+            command['text'] = command['text'].rstrip('*')
+        return command
+
+    def execute(self, command):
+        """run a command dict and return its result."""
+        op = command.get('op')
+        if op not in self.ARGS:
+            raise ValueError(u'unknown command %r' % op)
+        required, optional = self.ARGS[op]
+        missing = [arg for arg in required if arg not in command]
+        if missing:
+            raise ValueError(u'missing %s for `%s`' % (', '.join(missing), op))
+        handler = self.handler
+        if op == 'add':
+            if not handler.add_record(command['group'], command['item'],
+                                      command['value'], command.get('note')):
+                raise ValueError(u'fail to add the record')
+            return {'id': handler.data['currentID'] - 1}
+        elif op == 'update':
+            if not handler.update_record(command['id'], command['value'],
+                                         command.get('note')):
+                raise ValueError(u'fail to update the record')
+        elif op == 'delete':
+            if not handler.delete_record(command['id']):
+                raise ValueError(u'fail to delete the record')
+        elif op == 'mv':
+            if not handler.move_record(command['id'], command['gid']):
+                raise ValueError(u'fail to move the record')
+        elif op == 'info':
+            record = handler.get_record(command['id'])
+            if record is None:
+                raise ValueError(u'record %s does not exist' % command['id'])
+            return {'record': record.to_dict()}
+        elif op == 'search':
+            if command.get('field') not in (None,) + SearchIndex.FIELDS:
+                raise ValueError(u'unknown field %r' % command['field'])
+            records = handler.search(command['text'], command.get('field'),
+                                     command.get('prefix', False))
+            return {'records': [{'id': r.id, 'group': r.group,
+                                 'itemname': r.itemname} for r in records]}
+        return {}
+
+    def run(self, lines, output):
+        """run the script in one batch, so the vault is written once at
+        the end, and write a JSON result line for every command.
+
+        :return: the number of the commands that failed.
+        """
+        failed = 0
+        # an unexpected error rolls the whole script back, instead of
+        # writing the commands that ran before it
+        with self.handler.batch():
+            for number, line in enumerate(lines, 1):
+                if not line.strip() or line.lstrip().startswith('#'):
+                    continue
+                try:
+                    result = self.execute(self.parse(line))
+                    result['ok'] = True
+                except (ValueError, TypeError, KeyError), err:
+                    result = {'ok': False, 'error': unicode(err)}
+                    failed += 1
+                result['line'] = number
+                output.write(json.dumps(result, default=_json_default) + '\n')
+        return failed
+
+
+def server_path():
+    """the socket of `papyrus serve`, `PAPYRUS_SERVER_SOCK` overrides it."""
+    return os.environ.get('PAPYRUS_SERVER_SOCK') or \
+        os.path.join(os.path.expanduser('~'), '.papyrus', 'server.sock')
+
+
+class _VaultRequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        # a connection carries one JSON request per line until the client
+        # closes it
+        for line in iter(self.rfile.readline, ''):
+            try:
+                request = json.loads(line)
+                result = self.server.call(request['op'],
+                                          request.get('args', []),
+                                          request.get('kwargs', {}))
+                response = {'result': result}
+            except Exception, err:
+                response = {'error': unicode(err),
+                            'type': type(err).__name__}
+            self.wfile.write(json.dumps(response, default=_json_default) +
+                             '\n')
+
+
+class VaultServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Serve one unlocked handler to the local clients, so the vault is
+    loaded and decrypted once instead of by every client.
+
+    Every connection has its own thread. The reads run at once under the
+    read side of the lock of the handler, the writes one by one.
+    """
+
+    daemon_threads = True
+    READS = ('record', 'group', 'gid_records', 'groups', 'search')
+    WRITES = ('add_record', 'add_records', 'update_record', 'move_record',
+              'delete_record', 'sync')
+
+    def __init__(self, handler, path=None):
+        self.handler = handler
+        self.path = path or server_path()
+        prepare_socket(self.path)
+        mask = os.umask(0177)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, self.path,
+                                                   _VaultRequestHandler)
+        finally:
+            os.umask(mask)
+
+    def call(self, op, args, kwargs):
+        if op in self.READS:
+            with self.handler.read():
+                return getattr(self, 'op_' + op)(*args, **kwargs)
+        if op in self.WRITES:
+            return getattr(self.handler, op)(*args, **kwargs)
+        raise ValueError('unknown operation %r' % op)
+
+    def op_record(self, rid):
+        return self.handler.records['_rid'][rid].to_dict()
+
+    def op_group(self, group):
+        items = self.handler.records.get(group)
+        if items is None or group in ('_rid', '_gid', '_gidmap'):
+            raise KeyError(group)
+        return dict((item, record.to_dict()) for item, record in
+                    items.iteritems())
+
+    def op_gid_records(self, gid):
+        return [record.to_dict() for record in
+                self.handler.records['_gid'][gid]]
+
+    def op_groups(self):
+        return dict(self.handler.records['_gidmap'])
+
+    def op_search(self, text, field=None, prefix=False):
+        return [record.to_dict() for record in
+                self.handler.search(text, field, prefix)]
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class VaultClient(object):
+    """The client of `papyrus serve`, with the operations of `AESHandler`.
+
+    The connections are pooled: a call takes an idle connection or opens
+    a new one, up to `size` of them, so many threads share a client.
+    The errors of the server are raised as `PapyrusException`, or as
+    `KeyError` for a missing record or group.
+    """
+
+    def __init__(self, path=None, size=8, timeout=None):
+        self.path = path or server_path()
+        self.timeout = timeout
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        return sock, sock.makefile('rb')
+
+    def call(self, op, *args, **kwargs):
+        request = json.dumps({'op': op, 'args': args, 'kwargs': kwargs},
+                             default=_json_default) + '\n'
+        with self._slots:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                conn = self._connect()
+            try:
+                conn[0].sendall(request)
+                line = conn[1].readline()
+                if not line:
+                    raise socket.error('the server closed the connection')
+            except:
+                conn[0].close()
+                raise
+            with self._lock:
+                self._idle.append(conn)
+        response = json.loads(line)
+        if 'error' in response:
+            if response['type'] == 'KeyError':
+                raise KeyError(response['error'])
+            raise PapyrusException(response['error'])
+        return response['result']
+
+    def close(self):
+        with self._lock:
+            for sock, reader in self._idle:
+                sock.close()
+            self._idle = []
+
+    def add_record(self, group, item, value, note=None):
+        return self.call('add_record', group, item, value, note)
+
+    def add_records(self, rows):
+        return self.call('add_records', list(rows))
 
     def update_record(self, record_id, value, note=None):
-        record_id = int(record_id)
-        if self._records['_rid'].has_key(record_id):
-            try:
-                record = self._records['_rid'][record_id]
-                record['value'] = value
-                record['updated'] = datetime.today().isoformat('_')
-                if note:
-                    record['note'] = note
-                self.write()
-                return True
-            except Exception, err:
-                self.log.error('Error occur in updating record - %s', err)
-                return False
-        else:
-            return False
+        return self.call('update_record', record_id, value, note)
 
     def move_record(self, record_id, group_id):
-        record_id, group_id = int(record_id), int(group_id)
-        if record_id in self._records['_rid'] and group_id in self._records['_gid']:
-            try:
-                record = self._records['_rid'][record_id]
-                if record['gid'] == group_id:
-                    print 'The group_id already is the record gid, no need to move.'
-                    return False
-                if len(self._records['_gid'][group_id]) == 0:
-                    return False
+        return self.call('move_record', record_id, group_id)
 
-                old_gid = record['gid']
-                old_group = record['group']
-                new_group = self._records['_gid'][group_id][0]['group']
-                record['gid'] = group_id
-                record['group'] = new_group
-                record['updated'] = datetime.today().isoformat('_')
+    def delete_record(self, record_id):
+        return self.call('delete_record', record_id)
 
-                # delete the old data
-                self._del_record_in_gid(record_id, old_gid)
-                item = record['itemname']
-                del self._records[old_group][item]
+    def sync(self):
+        return self.call('sync')
 
-                self._adjust_structure(record)
-                self.write()
-                return True
-            except Exception, err:
-                self.log.error('Error occur in updating record - %s', err)
-                return False
-        else:
-            return False
+    def record(self, rid):
+        return Record(**self.call('record', rid))
 
-    def delete_record(self, record_id):
-        record_id = int(record_id)
-        if self._records['_rid'].has_key(record_id):
-            try:
-                record = self._records['_rid'][record_id]
-                rid, gid = record['id'], record['gid']
-                group, item = record['group'], record['itemname']
-                del self._records['_rid'][rid]
-                del self._records[group][item]
-                if len(self._records['_gid'][gid]) == 1:
-                    del self._records['_gid'][gid]
-                    del self._records[group]
-                else:
-                    self._del_record_in_gid(rid, gid)
+    def group(self, group):
+        return dict((item, Record(**fields)) for item, fields in
+                    self.call('group', group).iteritems())
 
-                # delete the record in the data['records']
-                for i in range(len(self.data['records'])):
-                    if self.data['records'][i]['id'] == rid:
-                        del self.data['records'][i]
-                        break
-                self.write()
-                return True
-            except Exception, err:
-                self.log.error('Error occur in deleting record - %s', err)
-                raise
-                return False
-        else:
-            return False
+    def gid_records(self, gid):
+        return [Record(**fields) for fields in self.call('gid_records', gid)]
+
+    def groups(self):
+        return self.call('groups')
+
+    def search(self, text, field=None, prefix=False):
+        return [Record(**fields) for fields in
+                self.call('search', text, field, prefix)]
 
     @property
     def records(self):
-        return self._records
-
-    def _init_data(self):
-        structure = {
-            'digest': self.cipher,
-            'records': [],
-            'currentID': 0,
-            'currentGID': 0,
-        }
-        self.data = structure
-        self._setup_structure()
+        return RemoteRecords(self)
 
-    def _setup_structure(self):
-        for record in self.data['records']:
-            self._adjust_structure(record)
 
-    def _adjust_structure(self, record):
-        rid, gid = record['id'], record['gid']
-        group = record['group']
-        item = record['itemname']
-        self._records['_rid'][rid] = record
-        self._records['_gid'].setdefault(gid, []).append(record)
-        self._records[group][item] = record
+class RemoteRecords(object):
+    """The `records` of the handler behind a server, every lookup is a
+    request::
 
-        # groupmap is a helper subdict contain (group, gid) pairs
-        if not self._records['_gidmap'].has_key(group):
-            self._records['_gidmap'][group] = record['gid']
+        client.records['_rid'][rid]     # a Record
+        client.records['_gid'][gid]     # [Record, ...]
+        client.records['_gidmap']       # {group: gid}
+        client.records[group]           # {item: Record}
+    """
 
-    def _del_record_in_gid(self, rid, gid):
-        """delete the record in the _records['_gid'].
+    def __init__(self, client):
+        self.client = client
 
-        :param rid: the id of the record.
-        :param gid: the id of the group.
-        """
-        for i in range(len(self._records['_gid'][gid])):
-            if self._records['_gid'][gid][i]['id'] == rid:
-                del self._records['_gid'][gid][i]
-                break
+    def __getitem__(self, key):
+        if key == '_rid':
+            return _RemoteIndex(self.client.record)
+        if key == '_gid':
+            return _RemoteIndex(self.client.gid_records)
+        if key == '_gidmap':
+            return self.client.groups()
+        return self.client.group(key)
 
-    def _compose_record(self, group, item, value, note=None):
-        created = datetime.today().isoformat('_')
-        # handle some state about group id
-        if group in ('_rid', '_gid', '_gidmap'):
-            group = 'Invalid Group Name'
-            gid = float('nan')    # Not a number
-        elif self._records.has_key(group):
-            gid = self._records['_gidmap'][group]
-        else:
-            gid = self.data['currentGID']
-            self.data['currentGID'] += 1
+    def __contains__(self, key):
+        return key in ('_rid', '_gid', '_gidmap') or \
+            key in self.client.groups()
 
-        record = {
-            # the `id` is increase use the currentID field
-            'id': self.data['currentID'],
-            'gid': gid,
-            'group': group,
-            'itemname': item,
-            'value': value,
-            'note': note,
-            'created': created,
-            'updated': created,
-        }
-        self.data['currentID'] += 1
-        self.data['records'].append(record)
-        return record
+    has_key = __contains__
 
-    @classmethod
-    def figure_32Byte_key(cls, text):
-        sha = hashlib.sha256()
-        sha.update(text)
-        digest = sha.hexdigest()[::2]
 
-        if len(text) > 32:
-            return digest
-        else:
-            keystr = text + digest
-            return keystr[:32]
+class _RemoteIndex(object):
 
-    @classmethod
-    def encrypt(cls, plaintext, key):
-        iv = Random.new().read(AES.block_size)
-        cipher = AES.new(key, AES.MODE_CFB, iv)
-        msg = iv + cipher.encrypt(plaintext)
-        return msg
+    def __init__(self, lookup):
+        self.lookup = lookup
 
-    @classmethod
-    def decrypt(cls, ciphertext, key):
-        iv = Random.new().read(AES.block_size)
-        cipher = AES.new(key, AES.MODE_CFB, iv)
-        return cipher.decrypt(ciphertext)[AES.block_size:]
+    def __getitem__(self, key):
+        return self.lookup(key)
 
+    def __contains__(self, key):
+        return self.get(key) is not None
 
-class PapyrusException(Exception):
-    """Exception class for papyrus."""
-    pass
+    def get(self, key, default=None):
+        try:
+            return self.lookup(key)
+        except KeyError:
+            return default
 
 
 class Papyrus(cmd.Cmd):
@@ -277,6 +3746,10 @@ class Papyrus(cmd.Cmd):
     """
 
     prompt = u'(papyrus) >>> '
+    # the most words that the completion of a field offers
+    complete_limit = 200
+    # the rows that a listing writes at once
+    list_block = 1000
     introduction = ("Papyrus: A simple cmd program that manage the infomation of "
              "passwords.\n")
 
@@ -284,7 +3757,8 @@ class Papyrus(cmd.Cmd):
         """Overriding the onecmd method in base class for initialize the 
         program. This operation should be launched before other operations.
         """
-        self.handler = AESHandler()
+        # Write behind if the Env variable ask for it
+        write_behind = os.environ.get('PAPYRUS_WRITE_BEHIND') == '1'
         try:
             self.stdout.write(str(self.introduction)+"\n")
             # First check the Env variable
@@ -298,6 +3772,17 @@ class Papyrus(cmd.Cmd):
                 filepath = self.stdin.readline().strip()
                 if not filepath:
                     filepath = 'records.dat'
+            # the spans and counts are appended to the stats file as well
+            # if the Env variable names one
+            sinks = []
+            if os.environ.get('PAPYRUS_STATS_FILE'):
+                sinks.append(StatsFile(os.environ['PAPYRUS_STATS_FILE']))
+            self.handler = handler_class(filepath)(
+                write_behind=write_behind, agent=AgentClient(),
+                instruments=Instruments(sinks))
+            # the agent holds the key if the vault was unlocked lately
+            if self.handler.initialize(None, filepath):
+                return
             pw = getpass.getpass(u'Please Enter The Initiali Cipher: ')
             if not self.handler.initialize(pw, filepath):
                 sys.exit('ERROR: invalid cipher or unknown exception.')
@@ -305,12 +3790,28 @@ class Papyrus(cmd.Cmd):
             print 'ERROR:', err
             sys.exit(1)
 
+    def precmd(self, line):
+        """load the changes that the other processes wrote before the
+        command runs.
+        """
+        try:
+            self.handler.refresh()
+        except Exception, err:
+            print 'ERROR: fail to load the changes of the records -', err
+        return line
+
     def onecmd(self, line):
         """overriding the onecmd method in base class that change default
         behavior.
         """
+        name = self.parseline(line)[0]
         try:
-            return cmd.Cmd.onecmd(self, line)
+            # the latency of every command is a span of its own, an empty
+            # line runs no command
+            if name is None:
+                return cmd.Cmd.onecmd(self, line)
+            with self.handler.span('command.%s' % name):
+                return cmd.Cmd.onecmd(self, line)
         except PapyrusException, err:
             # There is use the PapyrusException to transmit failed infomation.
             # Then print the papyrus info's message to the STDOUT.
@@ -337,39 +3838,131 @@ class Papyrus(cmd.Cmd):
 
         return args
 
-    def _ls_case_groups(self, target):
-        print u"* List all (group_id, group) pairs:"
-        for group in self.handler.records:
-            if group not in ('_rid', '_gid', '_gidmap'):
-                gid = self.handler.records['_gidmap'][group]
-                print u"\t({0}, {1})".format(gid, group)
-
-    def _ls_case_records(self, target):
-        print u"* List all (record_id, record) pairs:"
-        for record in self.handler.records['_rid'].values():
-            print u"\t({0}, {1})".format(record['id'], record['itemname'])
-
-    def _ls_case_group_id(self, target):
-        groupname = self.handler.records['_gid'][target][0]['group']
-        print (u"* List all infomation of the records in Group - `{0}`:\n"
-               u"\t(record_id, group, itemname, value)").format(groupname)
-        for record in self.handler.records['_gid'][target]:
-            enc_value = '****'.join((record['value'][0], record['value'][-1]))
-            print u"\t({0}, {1}, {2})".format(record['id'], record['itemname'],
-                                              enc_value)
-
-    def _ls_case_group_name(self, target):
-        print (u"* List all infomation of the records in Group - `{0}`:\n"
-               u"\t(record_id, group, itemname, value)").format(target)
-        for itemname in self.handler.records[target].keys():
-            record = self.handler.records[target][itemname]
-            enc_value = '****'.join((record['value'][0], record['value'][-1]))
-            print u"\t({0}, {1}, {2})".format(record['id'], record['itemname'],
-                                              enc_value)
+    def _ls_case_groups(self, target, options):
+        with self.handler.read():
+            pairs = self.handler.records['_gidmap'].items()
+        if options['sort'] == 'name':
+            pairs.sort(key=lambda (group, gid): (group.lower(), gid))
+        else:
+            pairs.sort(key=lambda (group, gid): gid)
+        if options['reverse']:
+            pairs.reverse()
+        pairs = itertools.islice(pairs, options['offset'],
+                                 self._stop(options))
+        rows = (u"\t({0}, {1})\n".format(gid, group) for group, gid in pairs)
+        self._list(u"* List all (group_id, group) pairs:\n", rows, options)
+
+    def _ls_case_records(self, target, options):
+        records = self.handler.cursor(None, options['sort'],
+                                      options['reverse'], options['offset'],
+                                      options['limit'])
+        rows = (u"\t({0}, {1})\n".format(record.id, record.itemname)
+                for record in records)
+        self._list(u"* List all (record_id, record) pairs:\n", rows, options)
+
+    def _ls_case_group_id(self, target, options):
+        self._ls_group(self.handler.group_name(target), target, options)
+
+    def _ls_case_group_name(self, target, options):
+        self._ls_group(target, self.handler.records['_gidmap'][target],
+                       options)
+
+    def _ls_group(self, groupname, gid, options):
+        records = self.handler.cursor(gid, options['sort'],
+                                      options['reverse'], options['offset'],
+                                      options['limit'])
+        rows = (u"\t({0}, {1}, {2})\n".format(record.id, record.itemname,
+                                              record.mask())
+                for record in records)
+        self._list((u"* List all infomation of the records in Group - `{0}`:"
+                    u"\n\t(record_id, group, itemname, value)\n"
+                    ).format(groupname), rows, options)
+
+    @staticmethod
+    def _stop(options):
+        if options['limit'] is None:
+            return None
+        return options['offset'] + options['limit']
+
+    def _list_options(self, line, command='ls'):
+        """split the options of a listing from its arguments, only `ls`
+        takes `--sort`.
+
+        :return: the arguments and the dict of the options.
+        """
+        options = {'limit': None, 'offset': 0, 'sort': 'id',
+                   'reverse': False}
+        words = []
+        tokens = iter(line.split())
+        for token in tokens:
+            if token in ('--limit', '--offset'):
+                value = next(tokens, '')
+                if not value.isdigit():
+                    raise PapyrusException(
+                        u"The `{0}` should be followed by a number.".format(
+                            token))
+                options[token[2:]] = int(value)
+            elif token == '--sort' and command == 'ls':
+                value = next(tokens, '')
+                if value not in CURSOR_ORDERS:
+                    raise PapyrusException(
+                        u"The `--sort` should be one of `id`, `name` and "
+                        u"`updated`.")
+                options['sort'] = value
+            elif token == '--reverse':
+                options['reverse'] = True
+            else:
+                words.append(token)
+        return u' '.join(words), options
+
+    def _list(self, header, rows, options):
+        """write a listing in blocks of `list_block` rows instead of a
+        print for every row, through the pager if the listing has no
+        `--limit`.
+        """
+        with self._output(options['limit'] is None) as output:
+            output.write(header.encode('utf-8'))
+            while True:
+                block = list(itertools.islice(rows, self.list_block))
+                if not block:
+                    break
+                output.write(u''.join(block).encode('utf-8'))
+            output.flush()
+
+    @contextmanager
+    def _output(self, paged):
+        """the file that a listing is written to, the standard input of
+        the pager (`PAGER`, ``less -FRX`` by default) in an interactive
+        session. The rows that the pager does not take are not even read.
+        """
+        command = os.environ.get('PAGER', 'less -FRX')
+        if not (paged and command and self.stdin.isatty() and
+                self.stdout.isatty()):
+            yield self.stdout
+            return
+        try:
+            pager = subprocess.Popen(shlex.split(command),
+                                     stdin=subprocess.PIPE)
+        except OSError:
+            yield self.stdout
+            return
+        try:
+            yield pager.stdin
+        except IOError, err:
+            # the pager quit before the end of the listing
+            if err.errno != errno.EPIPE:
+                raise
+        finally:
+            try:
+                pager.stdin.close()
+            except IOError:
+                pass
+            pager.wait()
 
     def do_ls(self, line):
         """Help message:
-        Usage: ls {groups | records | `group_name` | `group_id`}
+        Usage: ls [groups | records | `group_name` | `group_id`] [--limit N]
+                  [--offset N] [--sort id | name | updated] [--reverse]
 
         selected args::
           - single `ls` command: default to show all groups
@@ -377,36 +3970,110 @@ class Papyrus(cmd.Cmd):
           - `records`:  literal key word, show all the records
           - group_name: group name, show all the records in the specific group
           - group_id:  group id, show all the records in the specific group
+          - --limit, --offset:  show at most N rows after skipping N rows
+          - --sort:  order the rows by the id (the default), by the name or
+                     by the update time, `--reverse` turns the order around
 
-        List all the groups or records existing in the current program.
+        List all the groups or records existing in the current program. A
+        long listing without `--limit` is shown by the pager.
         """
+        target, options = self._list_options(line.decode('utf-8'))
         # single `ls` command, default to show all groups
-        if line == '':
-            self._ls_case_groups('groups')
+        if target == '':
+            self._ls_case_groups('groups', options)
             return
 
-        args = self._validate_line(line, lengths=(1, 2), cmd='ls')
-        target = args[0]
         if target.isdigit():
             target = int(target)
 
         # match the `group` keyword
         if target == 'groups':
-            self._ls_case_groups(target)
+            self._ls_case_groups(target, options)
         # match the `record` keyword
         elif target == 'records':
-            self._ls_case_records(target)
+            self._ls_case_records(target, options)
         # match the group_id
         elif target in self.handler.records['_gid']:
-            self._ls_case_group_id(target)
+            self._ls_case_group_id(target, options)
         # match the group_name
         elif target in self.handler.records and \
                              target not in ('_rid', '_gid', '_gidmap'):
-            self._ls_case_group_name(target)
+            self._ls_case_group_name(target, options)
         else:
             print u"Fail to list the '{0}'.".format(target)
             print u"Usage: ls {groups | records | `group_name` | `group_id`}"
 
+    def _list_times(self, header, records, field, options):
+        rows = (u"\t({0}, {1}, {2}, {3})\n".format(
+            record.id, record.group, record.itemname, getattr(record, field))
+                for record in records)
+        self._list(header + u"\t(record_id, group, itemname, {0})\n".format(
+            field), rows, options)
+
+    def do_stale(self, line):
+        """Help message:
+        Usage: stale days [--limit N] [--offset N] [--reverse]
+
+        args::
+          - days:  the number of days.
+          - --limit, --offset:  show at most N rows after skipping N rows
+          - --reverse:  the latest updated first
+
+        Show the records that were not updated in the last `days` days, the
+        longest unchanged first.
+        """
+        text, options = self._list_options(line.decode('utf-8'), 'stale')
+        try:
+            days = float(text)
+        except ValueError:
+            raise PapyrusException(u"The `days` should be a number, please "
+                                   u"type `help stale` get help message!")
+        if days < 0:
+            raise PapyrusException(u"The `days` should not be negative.")
+        try:
+            records = self.handler.stale(days, options['reverse'],
+                                         options['offset'], options['limit'])
+        except ValueError, err:
+            raise PapyrusException(u"Fail to list the stale records - %s"
+                                   % err)
+        self._list_times(u"* List the records not updated in {0} days:\n"
+                         .format(text), records, 'updated', options)
+
+    def do_range(self, line):
+        """Help message:
+        Usage: range {created | updated} start [end] [--limit N]
+                     [--offset N] [--reverse]
+
+        args::
+          - created, updated:  the time to look at.
+          - start:  a date such as `2012-10-19`, or a time such as
+                    `2012-10-19_08:30:00`.
+          - end(optional):  the date or the time the range ends before,
+                            default to no end.
+          - --limit, --offset:  show at most N rows after skipping N rows
+          - --reverse:  the latest first
+
+        Show the records created or updated in a range of time, the oldest
+        first.
+        """
+        text, options = self._list_options(line.decode('utf-8'), 'range')
+        args = text.split()
+        if len(args) not in (2, 3) or args[0] not in TimeIndex.FIELDS:
+            raise PapyrusException(u"The command `range {0}` is incorrect, "
+                                   u"please type `help range` get help "
+                                   u"message!".format(line))
+        end = args[2] if len(args) == 3 else None
+        try:
+            records = self.handler.time_range(args[0], args[1], end,
+                                              options['reverse'],
+                                              options['offset'],
+                                              options['limit'])
+        except ValueError, err:
+            raise PapyrusException(u"Fail to list the range - %s" % err)
+        self._list_times(u"* List the records {0} from {1} until {2}:\n"
+                         .format(args[0], args[1], end or u'now'), records,
+                         args[0], options)
+
     def do_info(self, line):
         """Help message:
         Usage: info record_id
@@ -428,14 +4095,42 @@ class Papyrus(cmd.Cmd):
             print "The `record_id` - {0} - not exist.".format(rid)
             return
         print u"The infomation of record - `{0}`:".format(rid)
-        print u'       id: ', record['id']
-        print u'      gid: ', record['gid']
-        print u'    group: ', record['group']
-        print u'   record: ', record['itemname']
-        print u'    value: ', record['value']
-        print u'     note: ', record['note']
-        print u'  created: ', record['created']
-        print u'   update: ', record['updated']
+        print u'       id: ', record.id
+        print u'      gid: ', record.gid
+        print u'    group: ', record.group
+        print u'   record: ', record.itemname
+        print u'    value: ', record.value
+        print u'     note: ', record.note
+        print u'  created: ', record.created
+        print u'   update: ', record.updated
+
+    def do_search(self, line):
+        """Help message:
+        Usage: search text [itemname | group | note]
+
+        args::
+          - text:  the text to search, case insensitive. A text ends with
+                   `*` matches the beginning of the fields only.
+          - field(optional):  only search in the specific field, default to
+                              search in all of them.
+
+        Search the records by item name, group name and note.
+        """
+        args = self._validate_line(line, lengths=(1, 2), cmd='search')
+        text, field = args[0], args[1] if len(args) == 2 else None
+        if field and field not in SearchIndex.FIELDS:
+            raise PapyrusException(
+                u"The field should be one of `itemname`, `group` or `note`.")
+        prefix = text.endswith('*')
+        text = text.rstrip('*')
+        if not text:
+            raise PapyrusException(u"The search text should not be empty.")
+
+        print u"* Search `{0}`, (record_id, group, itemname) pairs:".format(
+            args[0])
+        for record in self.handler.search(text, field, prefix):
+            print u"\t({0}, {1}, {2})".format(record.id, record.group,
+                                               record.itemname)
 
     def do_add(self, line):
         """Help message:
@@ -499,34 +4194,229 @@ class Papyrus(cmd.Cmd):
         if not self.handler.move_record(*args):
             raise PapyrusException(u"Fail to move record to the program.")
 
-    # def complete_update(self, text, line, begidx, endidx):
-    #     clist = []
-    #     for record in self.handler.records['_rid'].values():
-    #         rid, itemname = record['id'], record['itemname']
-    #         clist.append(u"({0}, {1})".format(rid, itemname))
+    def do_import(self, line):
+        """Help message:
+        Usage: import path [csv | jsonl]
+
+        args::
+          - path:  the file written by `export`, or a file with the same
+                   columns. The `note`, `created` and `updated` may be left
+                   out.
+          - format(optional):  default to `csv` for a `.csv` file and to
+                               `jsonl` (a JSON object per line) otherwise.
+
+        Add all the records of the file with a single write.
+        """
+        args = self._validate_line(line, lengths=(1, 2), cmd='import')
+        fmt = args[1] if len(args) == 2 else guess_format(args[0])
+        if fmt not in ('csv', 'jsonl'):
+            raise PapyrusException(u"The format should be `csv` or `jsonl`.")
+        try:
+            with open(args[0], 'rb') as f:
+                ids = self.handler.add_records(read_rows(f, fmt))
+        except Exception, err:
+            raise PapyrusException(u"Fail to import the records - %s" % err)
+        print u"Import {0} records.".format(len(ids))
+
+    def do_export(self, line):
+        """Help message:
+        Usage: export path [csv | jsonl]
+
+        args::
+          - path:  the file to write, the values are written in plain text,
+                   so only the owner may read it.
+          - format(optional):  default to `csv` for a `.csv` file and to
+                               `jsonl` (a JSON object per line) otherwise.
+
+        Write all the records to a file.
+        """
+        args = self._validate_line(line, lengths=(1, 2), cmd='export')
+        fmt = args[1] if len(args) == 2 else guess_format(args[0])
+        if fmt not in ('csv', 'jsonl'):
+            raise PapyrusException(u"The format should be `csv` or `jsonl`.")
+        try:
+            fd = os.open(args[0], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            with os.fdopen(fd, 'wb') as f:
+                write_rows(f, self.handler.export_records(), fmt)
+        except Exception, err:
+            raise PapyrusException(u"Fail to export the records - %s" % err)
+        print u"Export {0} records.".format(len(self.handler.records['_rid']))
+
+    def do_begin(self, line):
+        """Help message:
+        Usage: begin
+
+        Begin a batch, the following changes are kept in memory until
+        `commit` writes them at once or `rollback` discards them.
+        """
+        if not self.handler.begin():
+            raise PapyrusException(u"A batch is already in progress.")
+
+    def do_commit(self, line):
+        """Help message:
+        Usage: commit
+
+        Write all the changes of the current batch at once.
+        """
+        try:
+            committed = self.handler.commit()
+        except Exception, err:
+            self.handler.rollback()
+            raise PapyrusException(
+                u"Fail to commit the batch, it was rolled back - %s" % err)
+        if not committed:
+            raise PapyrusException(u"There is no batch in progress.")
+
+    def do_rollback(self, line):
+        """Help message:
+        Usage: rollback
+
+        Discard all the changes of the current batch.
+        """
+        if not self.handler.rollback():
+            raise PapyrusException(u"There is no batch in progress.")
+
+    def _complete(self, fields, text, words=()):
+        """the completions of `text` among the `words` and the words of the
+        `fields` of the records, see `AESHandler.complete`.
+        """
+        text = text.decode('utf-8')
+        matched = set(word for word in words if word.startswith(text))
+        for field in fields:
+            matched.update(self.handler.complete(field, text,
+                                                 self.complete_limit))
+        return sorted(word.encode('utf-8') for word in matched)
+
+    @staticmethod
+    def _complete_path(text):
+        """the files and the directories that start with `text`."""
+        paths = glob.glob(os.path.expanduser(text) + '*')
+        return sorted(path + os.sep if os.path.isdir(path) else path
+                      for path in paths)
+
+    @staticmethod
+    def _position(line, begidx):
+        """the position of the argument that is completed, 1 for the first
+        argument of the command.
+        """
+        return len(line[:begidx].split())
+
+    def complete_ls(self, text, line, begidx, endidx):
+        if self._position(line, begidx) == 1:
+            return self._complete(('group', 'gid'), text,
+                                  (u'groups', u'records'))
+        return []
 
-    #     if not text:
-    #         completions = clist[:]
-    #         return completions
+    def complete_info(self, text, line, begidx, endidx):
+        if self._position(line, begidx) == 1:
+            return self._complete(('id',), text)
+        return []
 
-    # def complete_ls(self, text, line, begidx, endidx):
-    #     clist = [u'groups', u'records']
-    #     for group, gid in self.handler.records['_gidmap'].items():
-    #         clist.append(u"({0}, {1})".format(gid, group))
+    complete_update = complete_info
+    complete_delete = complete_info
 
-    #     if not text:
-    #         completions = clist[:]
-    #         return completions
+    def complete_mv(self, text, line, begidx, endidx):
+        position = self._position(line, begidx)
+        if position == 1:
+            return self._complete(('id',), text)
+        if position == 2:
+            return self._complete(('gid',), text)
+        return []
 
-    # def complete_info(self, text, line, begidx, endidx):
-    #     clist = []
-    #     for record in self.handler.records['_rid'].values():
-    #         rid, itemname = record['id'], record['itemname']
-    #         clist.append(u"({0}, {1})".format(rid, itemname))
+    def complete_add(self, text, line, begidx, endidx):
+        position = self._position(line, begidx)
+        if position == 1:
+            return self._complete(('group',), text)
+        if position == 2:
+            return self._complete(('itemname',), text)
+        return []
 
-    #     if not text:
-    #         completions = clist[:]
-    #         return completions
+    def complete_search(self, text, line, begidx, endidx):
+        if self._position(line, begidx) == 1:
+            return self._complete(('itemname', 'group'), text)
+        return []
+
+    def complete_import(self, text, line, begidx, endidx):
+        position = self._position(line, begidx)
+        if position == 1:
+            return self._complete_path(text)
+        if position == 2:
+            return self._complete((), text, (u'csv', u'jsonl'))
+        return []
+
+    complete_export = complete_import
+
+    def complete_range(self, text, line, begidx, endidx):
+        if self._position(line, begidx) == 1:
+            return self._complete((), text, TimeIndex.FIELDS)
+        return []
+
+    def complete_stats(self, text, line, begidx, endidx):
+        if self._position(line, begidx) == 1:
+            return self._complete((), text, (u'reset',))
+        return []
+
+    def do_passwd(self, line):
+        """Help message:
+        Usage: passwd
+
+        Change the cipher of the records, the key is derived from the new
+        cipher with the current key derivation function and a new salt.
+        The backups of the records are removed, since they still open with
+        the former cipher.
+        """
+        if self.handler.in_batch:
+            raise PapyrusException(u"Commit or rollback the batch first.")
+        pw = getpass.getpass(u'Please Enter The New Cipher: ')
+        if pw != getpass.getpass(u'Please Enter It Again: '):
+            raise PapyrusException(u"The ciphers do not match.")
+        try:
+            self.handler.rekey(pw)
+        except Exception, err:
+            raise PapyrusException(u"Fail to change the cipher - %s" % err)
+
+    def do_sync(self, line):
+        """Help message:
+        Usage: sync
+
+        Wait until all the changes are written to the disk.
+        """
+        try:
+            self.handler.sync()
+        except Exception, err:
+            raise PapyrusException(u"Fail to write the changes - %s" % err)
+
+    def do_stats(self, line):
+        """Help message:
+        Usage: stats [reset]
+
+        Show the latencies of the commands and of the operations behind
+        them since the program started (or since `stats reset`), with the
+        bytes read and written and the records touched. The `self` column
+        is the time that was not spent in the other operations.
+        """
+        instruments = self.handler.instruments
+        if instruments is None:
+            print u"The handler measures nothing."
+            return
+        if line.strip() == 'reset':
+            instruments.reset()
+            print u"The statistics are reset."
+            return
+        report = instruments.report()
+        # the commands first, then the operations
+        names = sorted(report['spans'], key=lambda name: (
+            not name.startswith('command.'), name))
+        print u'%-20s %8s %10s %10s %10s %10s' % (
+            'span', 'count', 'total ms', 'mean ms', 'max ms', 'self ms')
+        for name in names:
+            stat = report['spans'][name]
+            print u'%-20s %8d %10.2f %10.3f %10.3f %10.2f' % (
+                name, stat['count'], stat['total'] * 1000,
+                stat['total'] * 1000 / stat['count'], stat['max'] * 1000,
+                stat['self'] * 1000)
+        for name, value in sorted(report['counters'].iteritems()):
+            print u'%-20s %8d' % (name, value)
 
     def do_quit(self, line):
         """Help message:
@@ -534,12 +4424,263 @@ class Papyrus(cmd.Cmd):
         
         Exit the program.
         """
-        return True
+        return self._exit()
 
     def do_EOF(self, line):
         """Exit"""
+        return self._exit()
+
+    def _exit(self):
+        if self.handler.rollback():
+            print u"The uncommitted changes of the batch were discarded."
+        try:
+            self.handler.close()
+        except Exception, err:
+            print 'ERROR: fail to write the changes -', err
+            return False
         return True
 
+    def postloop(self):
+        # the span of the command that ended the loop is written by now
+        instruments = self.handler.instruments
+        if instruments is not None:
+            for sink in instruments.sinks:
+                if isinstance(sink, StatsFile):
+                    sink.close()
 
-if __name__ == '__main__':
+
+def run_agent(argv):
+    """start the agent, by default in the background."""
+    parser = argparse.ArgumentParser(prog='papyrus agent',
+                                     description='Hold the unlocked keys.')
+    parser.add_argument('--socket', default=None,
+                        help='the socket path (default: %s)' % agent_path())
+    parser.add_argument('--timeout', type=float, default=900,
+                        help='exit after this many idle seconds')
+    parser.add_argument('--foreground', action='store_true',
+                        help='do not detach from the terminal')
+    parser.add_argument('--stop', action='store_true',
+                        help='stop the running agent')
+    args = parser.parse_args(argv)
+    if args.stop:
+        return 0 if AgentClient(args.socket).stop() else 1
+
+    try:
+        agent = KeyAgent(args.socket, args.timeout)
+    except (ValueError, OSError, socket.error), err:
+        print 'ERROR:', err
+        return 1
+    print 'PAPYRUS_AGENT_SOCK=%s; export PAPYRUS_AGENT_SOCK;' % agent.path
+    sys.stdout.flush()
+    if not args.foreground:
+        if os.fork():
+            # the child serves the socket that is bound already
+            agent.socket.close()
+            return 0
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+    agent.serve()
+    return 0
+
+
+def handler_class(filepath):
+    """the handler of the vault at `filepath`, a directory holds a sharded
+    vault.
+    """
+    return ShardedAESHandler if os.path.isdir(filepath) else AESHandler
+
+
+def open_handler(filepath, cipher=None, ask=True, **kwargs):
+    """unlock the vault with the key of the agent, or else with `cipher`
+    or the cipher that the user enters.
+
+    :param ask: whether the user may be asked for the cipher.
+    :return: the handler, or None if the vault is not unlocked.
+    """
+    handler = handler_class(filepath)(agent=AgentClient(), **kwargs)
+    if handler.initialize(None, filepath):
+        return handler
+    if cipher is None:
+        if not ask:
+            return None
+        cipher = getpass.getpass(u'Please Enter The Initiali Cipher: ')
+    if handler.initialize(cipher, filepath):
+        return handler
+    return None
+
+
+def has_terminal():
+    """whether the process has a terminal to ask the user on, without it
+    `getpass` reads the standard input.
+    """
+    try:
+        os.close(os.open('/dev/tty', os.O_RDWR))
+        return True
+    except OSError:
+        return False
+
+
+def add_passphrase_argument(parser):
+    """the `--passphrase-file` option of the commands run without a user."""
+    parser.add_argument('--passphrase-file', default=None,
+                        help='read the cipher from the first line of this '
+                        'file when the agent does not hold the key')
+
+
+def open_unattended(args, ask, **kwargs):
+    """open the handler of `args.path` with the cipher of
+    `args.passphrase_file` if given, print the error and return None when it
+    cannot be opened.
+    """
+    cipher = None
+    if args.passphrase_file:
+        try:
+            with open(args.passphrase_file) as f:
+                cipher = f.readline().rstrip('\r\n')
+        except IOError, err:
+            print >>sys.stderr, 'ERROR:', err
+            return None
+    handler = open_handler(args.path, cipher, ask, **kwargs)
+    if handler is None:
+        if cipher is None and not ask:
+            print >>sys.stderr, ('ERROR: no terminal to enter the cipher '
+                                 'on, start the agent or give '
+                                 '--passphrase-file.')
+        else:
+            print >>sys.stderr, 'ERROR: invalid cipher or unknown exception.'
+    return handler
+
+
+def run_exec(argv):
+    """run a script of commands without the shell, see `CommandRunner`."""
+    parser = argparse.ArgumentParser(prog='papyrus exec',
+                                     description='Run the commands of a '
+                                     'script and print a JSON result for '
+                                     'each of them.')
+    parser.add_argument('-f', '--file', default='-',
+                        help='the script, default to the standard input')
+    parser.add_argument('-p', '--path',
+                        default=os.environ.get('PAPYRUS_RECORD_PATH',
+                                               'records.dat'),
+                        help='the record file path')
+    add_passphrase_argument(parser)
+    args = parser.parse_args(argv)
+
+    # a script on the standard input must not be read as the cipher
+    ask = args.file != '-' or has_terminal()
+    handler = open_unattended(args, ask)
+    if handler is None:
+        return 2
+    script = sys.stdin if args.file == '-' else open(args.file)
+    try:
+        failed = CommandRunner(handler).run(script, sys.stdout)
+    finally:
+        if script is not sys.stdin:
+            script.close()
+        handler.close()
+    return 1 if failed else 0
+
+
+def run_serve(argv):
+    """serve the vault to the local clients, see `VaultServer`."""
+    parser = argparse.ArgumentParser(prog='papyrus serve',
+                                     description='Serve the records to the '
+                                     'local clients.')
+    parser.add_argument('-p', '--path',
+                        default=os.environ.get('PAPYRUS_RECORD_PATH',
+                                               'records.dat'),
+                        help='the record file path')
+    parser.add_argument('--socket', default=None,
+                        help='the socket path (default: %s)' % server_path())
+    parser.add_argument('--journal', action='store_true',
+                        help='append the changes to a journal')
+    parser.add_argument('--write-behind', action='store_true',
+                        help='write the changes in the background')
+    add_passphrase_argument(parser)
+    args = parser.parse_args(argv)
+
+    handler = open_unattended(args, has_terminal(), journal=args.journal,
+                              write_behind=args.write_behind)
+    if handler is None:
+        return 2
+    try:
+        server = VaultServer(handler, args.socket)
+    except (ValueError, OSError, socket.error), err:
+        print >>sys.stderr, 'ERROR:', err
+        return 1
+
+    def terminate(signum, frame):
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, terminate)
+    print 'PAPYRUS_SERVER_SOCK=%s; export PAPYRUS_SERVER_SOCK;' % server.path
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        handler.close()
+    return 0
+
+
+def run_convert(argv):
+    """write the vault again in another format, encoding or codec."""
+    parser = argparse.ArgumentParser(prog='papyrus convert',
+                                     description='Write the records again '
+                                     'in another format.')
+    parser.add_argument('-p', '--path',
+                        default=os.environ.get('PAPYRUS_RECORD_PATH',
+                                               'records.dat'),
+                        help='the record file path')
+    parser.add_argument('--format', choices=('indexed', 'legacy'),
+                        default='indexed', help='the vault format')
+    parser.add_argument('--encoding', choices=('binary', 'compact', 'json'),
+                        default='compact',
+                        help='the encoding of the records of the index')
+    parser.add_argument('--compression', choices=sorted(CODECS) + ['none'],
+                        default='zlib', help='the codec of the index')
+    args = parser.parse_args(argv)
+
+    compression = None if args.compression == 'none' else args.compression
+    try:
+        handler = open_handler(args.path, vault_format=args.format,
+                               record_encoding=args.encoding,
+                               compression=compression)
+    except ValueError, err:
+        print >>sys.stderr, 'ERROR:', err
+        return 2
+    if handler is None:
+        print >>sys.stderr, 'ERROR: invalid cipher or unknown exception.'
+        return 2
+    try:
+        if args.format == 'legacy' and handler._kdf['name'] != 'sha256':
+            # the legacy format has no header for the salt, so the key is
+            # derived again with a single SHA-256 pass.
+            handler.rekey(getpass.getpass(u'Please Enter The Cipher Again: '))
+        else:
+            # the journal is folded into the new snapshot as well
+            handler.compact()
+    finally:
+        handler.close()
+    return 0
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['agent']:
+        return run_agent(argv[1:])
+    if argv[:1] == ['exec']:
+        return run_exec(argv[1:])
+    if argv[:1] == ['serve']:
+        return run_serve(argv[1:])
+    if argv[:1] == ['convert']:
+        return run_convert(argv[1:])
     Papyrus().cmdloop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -18,7 +18,9 @@ setup(name='papyrus',
       py_modules=['papyrus'],
       license="BSD",
       install_requires=[
-          'pycrypto',
+          # AES-GCM, scrypt and the CTR counters need pycryptodome, which
+          # installs in place of pycrypto
+          'pycryptodome>=3.6',
       ],
       scripts=[
          'bin/papyrus',
@@ -1,11 +1,37 @@
 # -*- coding:utf-8 -*-
 
+import os
+import sys
+import glob
+import json
+import time
+import shutil
 import unittest
+import random
 import tempfile
+import subprocess
+import threading
+from StringIO import StringIO
 from pprint import pprint
+from datetime import datetime
 import math
 
-from papyrus import AESHandler
+from papyrus import (AESHandler, Record, VAULT_MAGIC, iter_lines,
+                     iter_json_records, read_header, map_file, KeyAgent,
+                     AgentClient, CommandRunner, read_rows, write_rows,
+                     FileLock, RWLock, VaultServer, VaultClient,
+                     PapyrusException, GCMCipher, make_cipher, iter_compress,
+                     iter_decompress, RecordPacker, iter_unpack_records,
+                     ShardedAESHandler, Instruments, StatsFile, Papyrus,
+                     run_exec)
+
+
+def remove_vault(filepath):
+    """remove the vault with its journal, backups and other siblings."""
+    for path in glob.glob(filepath + '.*'):
+        os.remove(path)
+    if os.path.exists(filepath):
+        os.remove(filepath)
 
 
 class TestAESHandler(unittest.TestCase):
@@ -17,6 +43,7 @@ class TestAESHandler(unittest.TestCase):
 
     def tearDown(self):
         self.tmpfile.close()
+        remove_vault(self.tmpfile.name)
 
 
     def test_update_delete(self):
@@ -117,6 +144,52 @@ class TestAESHandler(unittest.TestCase):
         self.assertNotEqual(self.handler.records[u'web'][u'google']['updated'],
                             updated)
 
+    def test_delete_many(self):
+        for i in range(100):
+            self.assertTrue(self.handler.add_record(u'g%d' % (i % 7), str(i), u'v'))
+        for rid in range(0, 100, 3):
+            self.assertTrue(self.handler.delete_record(rid))
+        self.assertFalse(self.handler.delete_record(0))
+
+        records = self.handler.data['records']
+        self.assertEqual(len(records), 66)
+        self.assertEqual(sorted(r['id'] for r in records),
+                         sorted(self.handler.records['_rid']))
+        for rid, i in self.handler._positions.items():
+            self.assertEqual(records[i]['id'], rid)
+        for gid, members in self.handler.records['_gid'].items():
+            for record in members:
+                self.assertEqual(record['gid'], gid)
+                self.assertTrue(record is
+                                self.handler.records['_rid'][record['id']])
+        # a group lists its records in the order they were added
+        members = self.handler.records['_gid'][0]
+        self.assertEqual([r['id'] for r in members], [7, 14, 28, 35, 49, 56,
+                                                      70, 77, 91, 98])
+        self.assertEqual((members[0]['id'], members[-1]['id']), (7, 98))
+        self.assertEqual([r['id'] for r in members[1:3]], [14, 28])
+        self.assertRaises(IndexError, members.__getitem__, 10)
+        # the export keeps the order of the ids
+        self.assertEqual([row['itemname'] for row in
+                          self.handler.export_records()][:3], ['1', '2', '4'])
+
+    def test_move_last_record(self):
+        self.assertTrue(self.handler.add_record(u'bank', u'boa', u'kkk3000'))
+        self.assertTrue(self.handler.add_record(u'web', u'google', u'answer42'))
+        self.assertTrue(self.handler.move_record(0, 1))
+
+        # the emptied group disappears from every index
+        self.assertFalse(self.handler.records.has_key(u'bank'))
+        self.assertFalse(self.handler.records['_gid'].has_key(0))
+        self.assertFalse(self.handler.records['_gidmap'].has_key(u'bank'))
+        self.assertEqual(self.handler.group_name(1), u'web')
+        self.assertEqual(len(self.handler.records['_gid'][1]), 2)
+
+        # so the group name gets a new group id when it is used again
+        self.assertTrue(self.handler.add_record(u'bank', u'citi', u'pw'))
+        self.assertEqual(self.handler.records['_gidmap'][u'bank'], 2)
+        self.assertEqual(self.handler.records[u'bank'][u'citi']['gid'], 2)
+
     def test_data_persistance(self):
         self.assertTrue(self.handler.add_record(u'web', u'facebook', u'lol2012'))
         self.assertTrue(self.handler.add_record(u'web', u'google', u'answer42'))
@@ -153,6 +226,246 @@ class TestAESHandler(unittest.TestCase):
                                  handler2.data['records'][i][key])
 
 
+    def test_record(self):
+        self.assertTrue(self.handler.add_record(u'web', u'google', u'answer42'))
+        self.assertTrue(self.handler.add_record(u'web', u'yahoo', u'pw'))
+        record = self.handler.records['_rid'][0]
+        self.assertTrue(isinstance(record, Record))
+        self.assertEqual(record['value'], record.value)
+        self.assertRaises(KeyError, record.__getitem__, 'unknown')
+        self.assertRaises(KeyError, record.__setitem__, 'unknown', 1)
+        self.assertEqual(sorted(record), sorted(record.to_dict()))
+        self.assertEqual(record, json.loads(json.dumps(record.to_dict())))
+        # the group name is interned among the records
+        self.assertTrue(record.group is self.handler.records['_rid'][1].group)
+
+        handler2 = AESHandler()
+        handler2.initialize('provide a key', self.tmpfile.name)
+        records = handler2.data['records']
+        self.assertTrue(records[0].group is records[1].group)
+        self.assertEqual(records, self.handler.data['records'])
+
+    def test_search(self):
+        self.assertTrue(self.handler.add_record(u'aws', u'prod-key', u'k1'))
+        self.assertTrue(self.handler.add_record(u'web', u'AWS console', u'k2'))
+        self.assertTrue(self.handler.add_record(u'web', u'google', u'k3',
+                                                u'backup of the aws key'))
+        self.assertTrue(self.handler.add_record(u'银行', u'招商银行', u'k4'))
+
+        def ids(*args):
+            return [record.id for record in self.handler.search(*args)]
+
+        self.assertEqual(ids(u'aws'), [0, 1, 2])
+        self.assertEqual(ids(u'aws', 'group'), [0])
+        self.assertEqual(ids(u'aws', None, True), [0, 1])
+        self.assertEqual(ids(u'a', 'itemname', True), [1])
+        self.assertEqual(ids(u'key', 'note'), [2])
+        self.assertEqual(ids(u'银行'), [3])
+        self.assertEqual(ids(u'go'), [2])
+        self.assertEqual(ids(u'nothing'), [])
+
+        # the index follows the changes of the records
+        self.assertTrue(self.handler.update_record(2, u'k3', u'no more key'))
+        self.assertEqual(ids(u'aws'), [0, 1])
+        self.assertTrue(self.handler.move_record(1, 0))
+        self.assertEqual(ids(u'aws', 'group'), [0, 1])
+        self.assertTrue(self.handler.delete_record(0))
+        self.assertEqual(ids(u'aws'), [1])
+        self.assertEqual(ids(u'prod'), [])
+
+    def test_complete(self):
+        for i in range(12):
+            group = u'web' if i % 2 else u'bank'
+            self.assertTrue(self.handler.add_record(group, u'item%d' % i,
+                                                    u'value'))
+        complete = self.handler.complete
+        self.assertEqual(complete('id', u'1'), [u'1', u'10', u'11'])
+        self.assertEqual(complete('id', u'1', 2), [u'1', u'10'])
+        self.assertEqual(complete('group', u''), [u'bank', u'web'])
+        self.assertEqual(complete('gid', u''), [u'0', u'1'])
+        self.assertEqual(complete('itemname', u'item1'),
+                         [u'item1', u'item10', u'item11'])
+
+        # the index follows the changes of the records
+        self.assertTrue(self.handler.add_record(u'mail', u'gmail', u'v'))
+        self.assertEqual(complete('group', u'm'), [u'mail'])
+        self.assertTrue(self.handler.move_record(12, 0))
+        self.assertEqual(complete('group', u'm'), [])
+        self.assertEqual(complete('gid', u'2'), [])
+        self.assertTrue(self.handler.delete_record(10))
+        self.assertEqual(complete('id', u'1'), [u'1', u'11', u'12'])
+        self.assertEqual(complete('itemname', u'item1'), [u'item1', u'item11'])
+        # a group keeps its name while a record of it is left
+        self.assertTrue(self.handler.delete_record(0))
+        self.assertEqual(complete('group', u'b'), [u'bank'])
+
+        shell = Papyrus()
+        shell.handler = self.handler
+        self.assertEqual(shell.complete_ls('', 'ls ', 3, 3),
+                         ['0', '1', 'bank', 'groups', 'records', 'web'])
+        self.assertEqual(shell.complete_mv('1', 'mv 1', 3, 4),
+                         ['1', '11', '12'])
+        self.assertEqual(shell.complete_mv('', 'mv 1 ', 5, 5), ['0', '1'])
+        self.assertEqual(shell.complete_add('it', 'add web it', 8, 10),
+                         shell.complete_search('it', 'search it', 7, 9))
+        self.assertEqual(shell.complete_stats('r', 'stats r', 6, 7),
+                         ['reset'])
+
+    def test_cursor(self):
+        for i in range(10):
+            group = u'web' if i % 2 else u'bank'
+            self.assertTrue(self.handler.add_record(group, u'item%d' % (9 - i),
+                                                    u'value'))
+        self.assertTrue(self.handler.delete_record(4))
+        self.assertTrue(self.handler.update_record(2, u'changed'))
+
+        def ids(*args, **kwargs):
+            return [record.id for record in
+                    self.handler.cursor(*args, **kwargs)]
+
+        self.assertEqual(ids(), [0, 1, 2, 3, 5, 6, 7, 8, 9])
+        self.assertEqual(ids(offset=2, limit=3), [2, 3, 5])
+        self.assertEqual(ids(reverse=True, limit=2), [9, 8])
+        self.assertEqual(ids(0), [0, 2, 6, 8])
+        self.assertEqual(ids(0, 'name'), [8, 6, 2, 0])
+        self.assertEqual(ids(0, 'name', limit=2), [8, 6])
+        self.assertEqual(ids(None, 'name', True, 1, 2), [1, 2])
+        self.assertEqual(ids(None, 'updated', True, limit=1), [2])
+        self.assertRaises(ValueError, ids, order='value')
+
+        # the records by id are looked up as they are iterated
+        cursor = self.handler.cursor()
+        self.assertEqual(next(cursor).id, 0)
+        self.assertTrue(self.handler.delete_record(1))
+        self.assertEqual(next(cursor).id, 2)
+
+        output = StringIO()
+        shell = Papyrus(stdout=output)
+        shell.handler = self.handler
+        shell.onecmd('ls bank --sort name --limit 2 --offset 1')
+        self.assertEqual(output.getvalue().splitlines()[2:],
+                         [u'\t(6, item3, v****e)', u'\t(2, item7, c****d)'])
+        output.truncate(0)
+        shell.onecmd('ls records --reverse --limit 1')
+        self.assertEqual(output.getvalue().splitlines()[1:], [u'\t(9, item0)'])
+        output.truncate(0)
+        shell.onecmd('ls --sort name')
+        self.assertEqual(output.getvalue().splitlines()[1:],
+                         [u'\t(0, bank)', u'\t(1, web)'])
+
+    def test_time_range(self):
+        rows = [{'group': u'web', 'itemname': u'item%d' % i, 'value': u'v',
+                 'created': u'2012-10-%02d_08:00:00' % (i + 1),
+                 'updated': u'2013-01-%02d_08:00:00.500000' % (10 - i)}
+                for i in range(10)]
+        rows.append({'group': u'web', 'itemname': u'imported', 'value': u'v',
+                     'created': u'2012-10-05 12:00', 'updated': u'unknown'})
+        rows.append({'group': u'mail', 'itemname': u'other', 'value': u'v',
+                     'created': u'never', 'updated': u'never'})
+        self.handler.add_records(rows)
+
+        def ids(*args, **kwargs):
+            return [record.id for record in
+                    self.handler.time_range(*args, **kwargs)]
+
+        self.assertEqual(ids('created', u'2012-10-04', u'2012-10-06'),
+                         [3, 4, 10])
+        self.assertEqual(ids('created', datetime(2012, 10, 9)), [8, 9])
+        self.assertEqual(ids('updated', None, u'2013-01-03'), [9, 8])
+        self.assertEqual(ids('updated', reverse=True, limit=2), [0, 1])
+        self.assertEqual(ids('updated', offset=8), [1, 0])
+        self.assertEqual(ids('created', None, None, True, 1, 2), [8, 7])
+        self.assertRaises(ValueError, ids, 'created', u'yesterday')
+        self.assertRaises(ValueError, ids, 'value')
+
+        # the index follows the changes of the records
+        self.assertTrue(self.handler.update_record(9, u'new'))
+        self.assertTrue(self.handler.move_record(8, 1))
+        self.assertTrue(self.handler.delete_record(7))
+        # the moved record is updated now as well
+        self.assertEqual(ids('updated', None, u'2013-01-05'), [6])
+        self.assertEqual(len(self.handler.stale(30)), 7)
+        self.assertEqual(self.handler.stale(30, reverse=True, limit=1)[0].id,
+                         0)
+        self.assertEqual(self.handler.stale(100000), [])
+        for days in (1e6, float('inf'), float('nan')):
+            self.assertRaises(ValueError, self.handler.stale, days)
+
+        output = StringIO()
+        shell = Papyrus(stdout=output)
+        shell.handler = self.handler
+        shell.onecmd('stale 30 --limit 1')
+        self.assertEqual(output.getvalue().splitlines()[2:],
+                         [u'\t(6, web, item6, 2013-01-04_08:00:00.500000)'])
+        output.truncate(0)
+        shell.onecmd('range created 2012-10-02 2012-10-03')
+        self.assertEqual(output.getvalue().splitlines()[2:],
+                         [u'\t(1, web, item1, 2012-10-02_08:00:00)'])
+        # the days that no date goes back to fail as a command
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            for line in ('stale 1000000', 'stale nan', 'stale inf',
+                         'stale -1'):
+                shell.onecmd(line)
+            errors = sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(len(errors), 4)
+
+    def test_add_records(self):
+        self.assertTrue(self.handler.add_record(u'web', u'google', u'answer42'))
+        self.assertEqual(self.handler.search(u'goo')[0].id, 0)
+        rows = [
+            {'group': u'web', 'itemname': u'yahoo', 'value': u'pw'},
+            {'group': u'银行', 'itemname': u'招行', 'value': u'q3',
+             'note': u'a note', 'created': u'2012-10-19_22:24:31.656777'},
+            {'group': u'银行', 'itemname': u'boa', 'value': u'k3'},
+        ]
+        self.assertEqual(self.handler.add_records(iter(rows)), [1, 2, 3])
+        self.assertEqual(self.handler.data['currentGID'], 2)
+        self.assertEqual(len(self.handler.records['_gid'][1]), 2)
+        self.assertEqual(self.handler.records['_rid'][2]['updated'],
+                         u'2012-10-19_22:24:31.656777')
+        self.assertEqual([r.id for r in self.handler.search(u'o', 'itemname')],
+                         [0, 1, 3])
+
+        # a bad row leaves the records as they were
+        self.assertRaises(KeyError, self.handler.add_records,
+                          [{'group': u'web', 'itemname': u'bing', 'value': u'x'},
+                           {'group': u'web'}])
+        self.assertEqual(len(self.handler.records['_rid']), 4)
+
+        handler2 = AESHandler()
+        self.assertTrue(handler2.initialize('provide a key', self.tmpfile.name))
+        self.assertEqual(handler2.data['records'], self.handler.data['records'])
+
+    def test_export_import(self):
+        self.assertTrue(self.handler.add_record(u'web', u'google', u'answer42'))
+        self.assertTrue(self.handler.add_record(u'银行', u'招行', u'q3',
+                                                u'a, "quoted" note'))
+        exported = list(self.handler.export_records())
+        for fmt in ('csv', 'jsonl'):
+            output = StringIO()
+            write_rows(output, self.handler.export_records(), fmt)
+            output.seek(0)
+            self.assertEqual(list(read_rows(output, fmt)), exported)
+        # the export does not keep the decrypted values
+        handler2 = AESHandler()
+        self.assertTrue(handler2.initialize('provide a key', self.tmpfile.name))
+        list(handler2.export_records())
+        self.assertFalse(handler2.records['_rid'][0].loaded)
+
+        handler2.add_records(exported)
+        self.assertEqual([r.id for r in handler2.search(u'招行')], [1, 3])
+
+    def test_value_encrypter(self):
+        key = AESHandler.figure_32Byte_key('a key')
+        encrypt = AESHandler.value_encrypter(key)
+        texts = ['x', 'a longer text than a single block', '', 'y' * 40]
+        blobs = [encrypt(text) for text in texts]
+        self.assertEqual([AESHandler.decrypt(blob, key) for blob in blobs],
+                         texts)
+
     def test_32byte_key_generate(self):
         key1 = AESHandler.figure_32Byte_key('not enough 32 bytes')
         key2 = AESHandler.figure_32Byte_key('exceed 32 bytes' * 3)
@@ -168,6 +481,1184 @@ class TestAESHandler(unittest.TestCase):
         plaintext = AESHandler.decrypt(ciphertext, key)
         self.assertEqual(text, plaintext)
 
+    def test_iter_decrypt(self):
+        key = AESHandler.figure_32Byte_key('provide a key')
+        text = 'first line\nsecond line\n\nlast line' * 10
+        ciphertext = AESHandler.encrypt(text, key)
+        chunks = list(AESHandler.iter_decrypt(ciphertext, key, chunk_size=7))
+        self.assertEqual(''.join(chunks), text)
+        self.assertEqual(list(iter_lines(chunks)), text.split('\n'))
+
+        padded = 'head' + ciphertext + 'tail'
+        chunks = AESHandler.iter_decrypt(padded, key, 4, len(ciphertext), 5)
+        self.assertEqual(''.join(chunks), text)
+
+    def test_iter_json_records(self):
+        data = {
+            'digest': 'digest',
+            'records': [{'id': i, 'note': u'note \u94f6\u884c "%d"' % i}
+                        for i in range(20)],
+            'currentID': 12345,
+            'currentGID': [1, {'nested': None}],
+        }
+        text = json.dumps(data)
+        for size in (1, 2, 3, 7, 64, len(text)):
+            chunks = [text[i:i+size] for i in range(0, len(text), size)]
+            meta = {}
+            records = list(iter_json_records(chunks, meta))
+            self.assertEqual(records, data['records'])
+            self.assertEqual(meta['currentID'], 12345)
+            self.assertEqual(meta['currentGID'], [1, {'nested': None}])
+
+        meta = {}
+        self.assertEqual(list(iter_json_records(['{"records": []}'], meta)), [])
+        self.assertRaises(ValueError, list,
+                          iter_json_records(['{"records": [1, 2'], meta))
+        self.assertRaises(ValueError, list, iter_json_records(['garbage'], meta))
+
+
+    def test_batch(self):
+        writes = []
+        write = self.handler.write
+        self.handler.write = lambda: writes.append(1) or write()
+
+        with self.handler.batch():
+            self.assertTrue(self.handler.add_record(u'bank', u'boa', u'kkk3000'))
+            self.assertTrue(self.handler.add_record(u'web', u'google', u'answer42'))
+            self.assertTrue(self.handler.update_record(1, u'google42'))
+            self.assertEqual(len(writes), 0)
+        self.assertEqual(len(writes), 1)
+        self.assertFalse(self.handler.in_batch)
+
+        try:
+            with self.handler.batch():
+                self.assertTrue(self.handler.delete_record(0))
+                self.assertTrue(self.handler.add_record(u'web', u'yahoo', u'pw'))
+                raise RuntimeError('abort the batch')
+        except RuntimeError:
+            pass
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(len(self.handler.data['records']), 2)
+        self.assertEqual(self.handler.data['currentID'], 2)
+        self.assertTrue(u'boa' in self.handler.records[u'bank'])
+        self.assertFalse(u'yahoo' in self.handler.records[u'web'])
+        self.assertEqual(len(self.handler.records['_gid'][1]), 1)
+
+        handler2 = AESHandler()
+        handler2.initialize('provide a key', self.tmpfile.name)
+        self.assertEqual(handler2.data['records'], self.handler.data['records'])
+
+    def test_begin_commit_rollback(self):
+        self.assertFalse(self.handler.commit())
+        self.assertFalse(self.handler.rollback())
+        self.assertTrue(self.handler.begin())
+        self.assertFalse(self.handler.begin())
+        self.assertTrue(self.handler.add_record(u'web', u'google', u'answer42'))
+        self.assertTrue(self.handler.rollback())
+        self.assertEqual(len(self.handler.records['_rid']), 0)
+        self.assertFalse(self.handler.records.has_key(u'web'))
+
+    def test_write_behind(self):
+        handler = AESHandler(write_behind=True, flush_delay=0.2)
+        handler.initialize('provide a key', self.tmpfile.name)
+        writes = []
+        write = handler.write
+        handler.write = lambda: writes.append(1) or write()
+
+        for i in range(10):
+            self.assertTrue(handler.add_record(u'web', str(i), u'value'))
+        self.assertTrue(handler.delete_record(3))
+        # the burst is still waiting for the writer thread
+        self.assertEqual(len(writes), 0)
+        time.sleep(0.5)
+        self.assertEqual(len(writes), 1)
+
+        self.assertTrue(handler.update_record(0, u'new value'))
+        handler.close()
+        self.assertEqual(len(writes), 2)
+        self.assertTrue(handler._writer is None)
+
+        handler2 = AESHandler()
+        handler2.initialize('provide a key', self.tmpfile.name)
+        self.assertEqual(handler2.data['records'], handler.data['records'])
+        self.assertEqual(handler2.records['_rid'][0].value, u'new value')
+
+
+class TestIndexedFormat(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpfile = tempfile.NamedTemporaryFile()
+
+    def tearDown(self):
+        self.tmpfile.close()
+        remove_vault(self.tmpfile.name)
+
+    def load(self, **kwargs):
+        handler = AESHandler(**kwargs)
+        self.assertTrue(handler.initialize('provide a key', self.tmpfile.name))
+        return handler
+
+    def fill(self, handler):
+        self.assertTrue(handler.add_record(u'web', u'facebook', u'lol2012'))
+        self.assertTrue(handler.add_record(u'web', u'google', u'answer42', u'a note'))
+        self.assertTrue(handler.add_record(u'银行', u'招商银行', u'money888'))
+
+    def test_lazy_values(self):
+        self.fill(self.load())
+        with open(self.tmpfile.name, 'rb') as f:
+            self.assertTrue(f.read().startswith(VAULT_MAGIC))
+
+        handler = self.load()
+        records = handler.records['_rid']
+        self.assertFalse(any(record.loaded for record in records.values()))
+        self.assertEqual(records[1].mask(), u'a****2')
+        self.assertEqual(records[1]['note'], u'a note')
+        self.assertFalse(records[1].loaded)
+        self.assertEqual(records[1]['value'], u'answer42')
+        self.assertTrue(records[1].loaded)
+        self.assertFalse(records[2].loaded)
+
+        # the values are encrypted again once they are written
+        self.assertTrue(handler.update_record(0, u'lol2013'))
+        self.assertFalse(records[0].loaded)
+        self.assertFalse(records[1].loaded)
+        self.assertEqual(records[0].value, u'lol2013')
+        self.assertEqual(records[1].value, u'answer42')
+        self.assertEqual(records[2].value, u'money888')
+
+        handler2 = self.load()
+        self.assertEqual(handler2.data['records'], handler.data['records'])
+
+    def test_migrate_legacy(self):
+        self.fill(self.load(vault_format='legacy'))
+        with open(self.tmpfile.name, 'rb') as f:
+            self.assertFalse(f.read().startswith(VAULT_MAGIC))
+
+        handler = self.load()
+        self.assertTrue(all(record.loaded for record in handler.data['records']))
+        self.assertTrue(handler.delete_record(0))
+        with open(self.tmpfile.name, 'rb') as f:
+            self.assertTrue(f.read().startswith(VAULT_MAGIC))
+
+        handler2 = self.load()
+        self.assertEqual(handler2.data['records'], handler.data['records'])
+        self.assertEqual(handler2.data['currentID'], 3)
+
+        wrong = AESHandler()
+        self.assertFalse(wrong.initialize('wrong key', self.tmpfile.name))
+
+    def test_compression(self):
+        text = ''.join('{"itemname": "item-%d"}\n' % i for i in range(500))
+        pieces = [text[i:i+100] for i in range(0, len(text), 100)]
+        for codec in (None, 'zlib', 'bz2'):
+            stream = list(iter_compress(pieces, codec))
+            self.assertEqual(''.join(iter_decompress(stream, codec)), text)
+            if codec:
+                self.assertTrue(len(''.join(stream)) < len(text) / 5)
+
+        handler = self.load(compression=None, record_encoding='json')
+        self.fill(handler)
+        for compression, encoding in (('zlib', 'compact'), ('bz2', 'json'),
+                                      ('zlib', 'binary'), (None, 'compact')):
+            # a vault is read whatever the handler writes
+            handler2 = self.load(compression=compression,
+                                 record_encoding=encoding)
+            self.assertEqual(handler2.data['records'], handler.data['records'])
+            self.assertEqual(handler2.records['_rid'][1].value,
+                             handler.records['_rid'][1].value)
+            self.assertTrue(handler2.update_record(1, u'%s' % compression))
+            header = read_header(map_file(self.tmpfile.name))[0]
+            self.assertEqual((header['compression'], header['encoding']),
+                             (compression, encoding))
+            handler = handler2
+        self.assertEqual(self.load().records['_rid'][1].value, u'None')
+        self.assertRaises(ValueError, AESHandler, compression='lzma')
+        self.assertRaises(ValueError, AESHandler, record_encoding='xml')
+
+    def test_binary_records(self):
+        now = datetime.today().isoformat('_')
+        rows = [
+            (0, 0, u'web', u'google', None, now, now, 0, 40, u'a****2'),
+            (1, 3, u'银行', u'招商银行', u'a note', u'2012-10-19_08:30:00',
+             u'2013-01-02_03:04:05.123456', 40, 60, u''),
+            # the timestamps that are kept as text
+            (2, 1, u'mail', u'', u'', u'2012-10-19T08:30:00',
+             u'2012-10-19_08:30:00.000000', 100, 0, u'x'),
+            (3, 1, u'mail', u'imap', None, None, u'2012-02-30_00:00:00',
+             100, 1, u'y'),
+        ]
+        packer = RecordPacker()
+        packed = []
+        for row in rows:
+            packer.add(*row)
+            # the records are packed in blocks of two and one
+            if row[0] % 2:
+                packed.append(packer.pack())
+        packed = ''.join(packed)
+        pieces = [packed[i:i+7] for i in range(0, len(packed), 7)]
+        self.assertEqual(list(iter_unpack_records(pieces)), rows)
+        self.assertEqual(packer.stamp(u'1970-01-01_00:00:01.000002'), 1000002)
+        self.assertRaises(ValueError, list, iter_unpack_records([packed[:-1]]))
+        self.assertEqual(packer.pack(), '')
+
+        packer.add(4, float('nan'), u'g', u'i', None, now, now, 0, 1, u'')
+        gid = list(iter_unpack_records([packer.pack()]))[0][1]
+        self.assertNotEqual(gid, gid)
+
+        handler = self.load(record_encoding='binary')
+        self.fill(handler)
+        handler.add_records([{'group': u'web', 'itemname': u'yahoo',
+                              'value': u'pw', 'created': u'yesterday'}])
+        handler2 = self.load()
+        self.assertEqual(handler2.data['records'], handler.data['records'])
+        self.assertEqual(handler2.records['_rid'][3].created, u'yesterday')
+
+
+class TestDurableWrite(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmpdir, 'records.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def load(self, filepath=None, **kwargs):
+        handler = AESHandler(**kwargs)
+        self.assertTrue(handler.initialize('provide a key',
+                                           filepath or self.filepath))
+        return handler
+
+    def test_backups(self):
+        handler = self.load(backups=2)
+        for i in range(4):
+            self.assertTrue(handler.add_record(u'web', str(i), u'value'))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['records.dat', 'records.dat.1', 'records.dat.2'])
+        # the backups are the former generations of the vault
+        self.assertEqual(len(self.load(self.filepath + '.1').data['records']), 3)
+        self.assertEqual(len(self.load(self.filepath + '.2').data['records']), 2)
+
+        # the backups would still open with the former passphrase
+        handler.rekey('new key')
+        self.assertEqual(os.listdir(self.tmpdir), ['records.dat'])
+        handler2 = AESHandler()
+        self.assertTrue(handler2.initialize('new key', self.filepath))
+        self.assertEqual(len(handler2.data['records']), 4)
+
+        self.assertRaises(ValueError, AESHandler, fsync='sometimes')
+
+    def test_recover(self):
+        handler = self.load(fsync='never', backups=0)
+        self.assertTrue(handler.add_record(u'web', u'google', u'answer42'))
+        shutil.copy(self.filepath, self.filepath + '.saved')
+        self.assertTrue(handler.add_record(u'web', u'yahoo', u'pw'))
+        os.rename(self.filepath + '.saved', self.filepath + '.tmp')
+
+        # a temporary file without the marker may be incomplete, so it is
+        # discarded
+        self.assertEqual(len(self.load().data['records']), 2)
+        self.assertFalse(os.path.exists(self.filepath + '.tmp'))
+
+        # with the marker the interrupted rename is finished
+        self.assertTrue(handler.delete_record(0))
+        shutil.copy(self.filepath, self.filepath + '.saved')
+        self.assertTrue(handler.add_record(u'web', u'bing', u'pw'))
+        os.rename(self.filepath + '.saved', self.filepath + '.tmp')
+        open(self.filepath + '.pending', 'wb').close()
+        self.assertEqual(len(self.load().data['records']), 1)
+        self.assertEqual(os.listdir(self.tmpdir), ['records.dat'])
+
+    def test_batched_journal(self):
+        handler = self.load(journal=True, fsync='batched', fsync_interval=60)
+        self.assertTrue(handler.add_record(u'web', u'google', u'answer42'))
+        self.assertFalse(handler._journal_dirty)
+        self.assertTrue(handler.add_record(u'web', u'yahoo', u'pw'))
+        self.assertTrue(handler._journal_dirty)
+        handler.sync()
+        self.assertFalse(handler._journal_dirty)
+        self.assertEqual(len(self.load(journal=True).data['records']), 2)
+
+
+class TestSharedVault(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmpdir, 'records.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def load(self, **kwargs):
+        handler = AESHandler(**kwargs)
+        self.assertTrue(handler.initialize('provide a key', self.filepath))
+        return handler
+
+    def test_no_lost_update(self):
+        handler1, handler2 = self.load(), self.load()
+        self.assertTrue(handler1.add_record(u'web', u'google', u'answer42'))
+        self.assertTrue(handler2.add_record(u'web', u'yahoo', u'pw'))
+        self.assertTrue(handler1.update_record(1, u'new pw'))
+        # the ids are not allocated twice
+        self.assertEqual(sorted(handler2.records['_rid']), [0, 1])
+        self.assertTrue(handler2.refresh())
+        self.assertEqual(handler2.records['_rid'][1].value, u'new pw')
+        self.assertEqual(self.load().data['records'], handler2.data['records'])
+        # the lock file is removed when the lock is released
+        self.assertFalse(os.path.exists(self.filepath + '.lock'))
+
+    def test_refresh(self):
+        handler1 = self.load(journal=True)
+        self.assertTrue(handler1.add_record(u'web', u'google', u'answer42'))
+        handler2 = self.load(journal=True)
+        self.assertFalse(handler2.refresh())
+
+        # only the new journal entries are read
+        reloads = []
+        reload = handler2._reload
+        handler2._reload = lambda: reloads.append(1) or reload()
+        self.assertTrue(handler1.add_record(u'web', u'yahoo', u'pw'))
+        self.assertTrue(handler2.refresh())
+        self.assertEqual(reloads, [])
+        self.assertEqual(sorted(handler2.records['_rid']), [0, 1])
+        self.assertEqual(handler2._journal_entries, 2)
+
+        # a new snapshot is loaded again
+        handler1.compact()
+        self.assertTrue(handler1.delete_record(0))
+        self.assertTrue(handler2.refresh())
+        self.assertEqual(reloads, [1])
+        self.assertEqual(sorted(handler2.records['_rid']), [1])
+        self.assertFalse(handler2.records['_rid'][1].loaded)
+
+    def test_lock(self):
+        handler = self.load()
+        lock = FileLock(self.filepath + '.lock')
+        lock.acquire()
+        thread = threading.Thread(target=handler.add_record,
+                                  args=(u'web', u'google', u'answer42'))
+        thread.start()
+        time.sleep(0.2)
+        # the handler waits for the other holder of the lock
+        self.assertEqual(len(handler.records['_rid']), 0)
+        lock.release()
+        thread.join()
+        self.assertEqual(len(handler.records['_rid']), 1)
+
+        # a batch keeps the vault locked until it ends
+        handler2 = self.load()
+        self.assertTrue(handler.begin())
+        self.assertTrue(handler.add_record(u'web', u'yahoo', u'pw'))
+        thread = threading.Thread(target=handler2.delete_record, args=(0,))
+        thread.start()
+        time.sleep(0.2)
+        self.assertTrue(handler.commit())
+        thread.join()
+        self.assertEqual(sorted(self.load().records['_rid']), [1])
+
+
+class TestVaultServer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmpdir, 'records.dat')
+        self.handler = AESHandler()
+        self.handler.initialize('provide a key', self.filepath)
+        self.server = VaultServer(self.handler,
+                                  os.path.join(self.tmpdir, 'server.sock'))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.client = VaultClient(self.server.path, size=2)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_operations(self):
+        client = self.client
+        self.assertTrue(client.add_record(u'web', u'google', u'answer42'))
+        self.assertEqual(client.add_records([
+            {'group': u'银行', 'itemname': u'招行', 'value': u'q3'}]), [1])
+        self.assertTrue(client.update_record(0, u'google42', u'a note'))
+        self.assertTrue(client.move_record(1, 0))
+        self.assertFalse(client.delete_record(7))
+
+        record = client.records['_rid'][0]
+        self.assertEqual((record.value, record.note), (u'google42', u'a note'))
+        self.assertEqual(record, self.handler.records['_rid'][0])
+        self.assertEqual([r.id for r in client.records['_gid'][0]], [0, 1])
+        self.assertEqual(client.records['_gidmap'], {u'web': 0})
+        self.assertEqual(sorted(client.records[u'web']), [u'google', u'招行'])
+        self.assertEqual([r.id for r in client.search(u'招')], [1])
+        self.assertTrue(u'web' in client.records)
+        self.assertFalse(7 in client.records['_rid'])
+        self.assertRaises(KeyError, client.record, 7)
+        self.assertRaises(KeyError, lambda: client.records[u'银行'])
+        self.assertRaises(PapyrusException, client.call, 'write')
+
+        client.sync()
+        handler2 = AESHandler()
+        self.assertTrue(handler2.initialize('provide a key', self.filepath))
+        self.assertEqual(handler2.data['records'], self.handler.data['records'])
+
+    def test_concurrent_clients(self):
+        def work(n):
+            for i in range(20):
+                self.assertTrue(self.client.add_record(u'g%d' % n, str(i), u'v'))
+                self.assertEqual(len(self.client.records[u'g%d' % n]), i + 1)
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.handler.records['_rid']), 80)
+        # the threads share the pooled connections
+        self.assertTrue(len(self.client._idle) <= 2)
+
+    def test_rwlock(self):
+        lock = RWLock()
+        events = []
+
+        def reader(name):
+            with lock.read():
+                events.append(name)
+                time.sleep(0.1)
+                # a reader takes the lock again while the writer waits
+                with lock.read():
+                    events.append(name)
+
+        def writer():
+            with lock.write():
+                # the writer may read and write again
+                with lock.read():
+                    with lock.write():
+                        events.append('w')
+
+        readers = [threading.Thread(target=reader, args=(n,)) for n in 'ab']
+        for thread in readers:
+            thread.start()
+        time.sleep(0.02)
+        thread = threading.Thread(target=writer)
+        thread.start()
+        for t in readers + [thread]:
+            t.join()
+        # the readers overlap and the writer waits for both of them
+        self.assertEqual(sorted(events[:2]), ['a', 'b'])
+        self.assertEqual(events[-1], 'w')
+
+    def test_serve_passphrase_file(self):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'papyrus.py')
+        passphrase = os.path.join(self.tmpdir, 'passphrase')
+        sock = os.path.join(self.tmpdir, 'serve.sock')
+        log = os.path.join(self.tmpdir, 'serve.log')
+
+        def serve(cipher):
+            with open(passphrase, 'w') as f:
+                f.write(cipher + '\n')
+            with open(os.devnull) as stdin, open(log, 'w') as stdout:
+                return subprocess.Popen(
+                    [sys.executable, script, 'serve', '-p', self.filepath,
+                     '--socket', sock, '--passphrase-file', passphrase],
+                    stdin=stdin, stdout=stdout, stderr=subprocess.STDOUT)
+
+        # a wrong cipher fails at once instead of asking for another
+        proc = serve('a wrong key')
+        self.assertEqual(proc.wait(), 2)
+
+        # started in the background, it prints the socket to its output
+        proc = serve('provide a key')
+        try:
+            for i in range(100):
+                with open(log) as f:
+                    line = f.readline()
+                if line.endswith('\n'):
+                    break
+                time.sleep(0.1)
+            self.assertEqual(line, 'PAPYRUS_SERVER_SOCK=%s; '
+                             'export PAPYRUS_SERVER_SOCK;\n' % sock)
+            client = VaultClient(sock)
+            self.assertTrue(client.add_record(u'web', u'yahoo', u'answer42'))
+            client.close()
+        finally:
+            proc.terminate()
+        self.assertEqual(proc.wait(), 0)
+        self.assertTrue(self.handler.refresh())
+        self.assertEqual(self.handler.records[u'web'][u'yahoo'].value,
+                         u'answer42')
+
+
+class TestConcurrency(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmpdir, 'records.dat')
+        self.handler = AESHandler(journal=True, fsync='never')
+        self.handler.initialize('provide a key', self.filepath)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_structure(self):
+        handler = self.handler
+        records = handler.records
+        self.assertEqual(len(handler.data['records']), len(records['_rid']))
+        self.assertEqual(sum(len(m) for m in records['_gid'].values()),
+                         len(records['_rid']))
+        for i, record in enumerate(handler.data['records']):
+            self.assertEqual(handler._positions[record.id], i)
+            self.assertTrue(records['_rid'][record.id] is record)
+            self.assertTrue(record in records['_gid'][record.gid])
+            self.assertEqual(records['_gidmap'][record.group], record.gid)
+            self.assertTrue(record.itemname in records[record.group])
+
+    def test_stress(self):
+        handler = self.handler
+        errors = []
+        done = threading.Event()
+
+        def writer(seed):
+            rand = random.Random(seed)
+            try:
+                for i in range(150):
+                    with handler.read():
+                        rids = list(handler.records['_rid'])
+                        gids = list(handler.records['_gid'])
+                    op = rand.random()
+                    if op < 0.5 or not rids:
+                        handler.add_record(u'g%d' % rand.randrange(5),
+                                           u'item %d' % i, u'value')
+                    elif op < 0.7:
+                        handler.update_record(rand.choice(rids), u'new', u'note')
+                    elif op < 0.85:
+                        handler.move_record(rand.choice(rids), rand.choice(gids))
+                    else:
+                        handler.delete_record(rand.choice(rids))
+            except Exception, err:
+                errors.append(err)
+
+        def reader():
+            try:
+                while not done.is_set():
+                    with handler.read():
+                        self.check_structure()
+                    handler.search(u'item 1', None, True)
+                    handler.get_record(0)
+            except Exception, err:
+                errors.append(err)
+
+        writers = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+        readers = [threading.Thread(target=reader) for n in range(4)]
+        for thread in writers + readers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        done.set()
+        for thread in readers:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.check_structure()
+
+        handler2 = AESHandler()
+        self.assertTrue(handler2.initialize('provide a key', self.filepath))
+        self.assertEqual(sorted(handler2.records['_rid']),
+                         sorted(handler.records['_rid']))
+
+    def test_batch_owner(self):
+        # a batch keeps the other threads waiting until it ends
+        self.assertTrue(self.handler.begin())
+        self.assertTrue(self.handler.add_record(u'web', u'google', u'answer42'))
+        thread = threading.Thread(target=self.handler.add_record,
+                                  args=(u'web', u'yahoo', u'pw'))
+        thread.start()
+        time.sleep(0.1)
+        self.assertTrue(self.handler.rollback())
+        thread.join()
+        self.assertEqual([r.itemname for r in self.handler.data['records']],
+                         [u'yahoo'])
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpfile = tempfile.NamedTemporaryFile()
+        self.handler = AESHandler(journal=True, compact_threshold=5)
+        self.handler.initialize('provide a key', self.tmpfile.name)
+
+    def tearDown(self):
+        self.tmpfile.close()
+        remove_vault(self.tmpfile.name)
+
+    def reload(self):
+        handler = AESHandler(journal=True, compact_threshold=5)
+        self.assertTrue(handler.initialize('provide a key', self.tmpfile.name))
+        return handler
+
+    def test_replay(self):
+        snapshot = os.path.getsize(self.tmpfile.name)
+        self.assertTrue(self.handler.add_record(u'bank', u'boa', u'kkk3000'))
+        self.assertTrue(self.handler.add_record(u'web', u'google', u'answer42'))
+        self.assertTrue(self.handler.add_record(u'web', u'facebook', u'lol2012'))
+        self.assertTrue(self.handler.update_record(1, u'google42', u'a note'))
+        # the snapshot is still empty, all mutations live in the journal
+        self.assertEqual(os.path.getsize(self.tmpfile.name), snapshot)
+        self.assertEqual(self.handler._journal_entries, 4)
+
+        handler2 = self.reload()
+        self.assertEqual(handler2.data['records'], self.handler.data['records'])
+        self.assertEqual(handler2.data['currentID'], 3)
+        self.assertEqual(handler2.data['currentGID'], 2)
+        self.assertEqual(handler2.records[u'web'][u'google']['note'], u'a note')
+
+        self.assertTrue(handler2.move_record(1, 0))
+        self.assertTrue(handler2.delete_record(2))
+        handler3 = self.reload()
+        self.assertEqual(handler3.data['records'], handler2.data['records'])
+        self.assertEqual(len(handler3.records['_gid'][0]), 2)
+        self.assertFalse(handler3.records.has_key(u'web'))
+
+    def test_compact(self):
+        snapshot = os.path.getsize(self.tmpfile.name)
+        for i in range(6):
+            self.assertTrue(self.handler.add_record(u'web', str(i), u'value'))
+        # the fifth entry folds the journal into the snapshot
+        self.assertNotEqual(os.path.getsize(self.tmpfile.name), snapshot)
+        self.assertEqual(self.handler._journal_entries, 1)
+
+        handler2 = self.reload()
+        self.assertEqual(len(handler2.records['_rid']), 6)
+        self.assertEqual(handler2.data['records'], self.handler.data['records'])
+
+    def test_batch(self):
+        with self.handler.batch():
+            for i in range(4):
+                self.assertTrue(self.handler.add_record(u'web', str(i), u'value'))
+            self.assertTrue(self.handler.delete_record(3))
+            self.assertEqual(self.handler._journal_entries, 0)
+        # the deleted record is folded into a single `del` entry
+        self.assertEqual(self.handler._journal_entries, 4)
+
+        handler2 = self.reload()
+        self.assertEqual(handler2.data['records'], self.handler.data['records'])
+        self.assertEqual(handler2.data['currentID'], 4)
+
+    def test_snapshot_writer(self):
+        self.assertTrue(self.handler.add_record(u'web', u'google', u'answer42'))
+        self.assertTrue(self.handler.add_record(u'web', u'yahoo', u'pw'))
+        # a handler out of journal mode writes the whole vault, the entries
+        # of the journal must not be replayed on top of it
+        handler2 = AESHandler()
+        self.assertTrue(handler2.initialize('provide a key', self.tmpfile.name))
+        self.assertTrue(handler2.delete_record(0))
+        self.assertTrue(handler2.update_record(1, u'changed'))
+        self.assertEqual(os.path.getsize(self.handler.journal_path), 0)
+
+        handler3 = self.reload()
+        self.assertFalse(handler3.records['_rid'].has_key(0))
+        self.assertEqual(handler3.records['_rid'][1].value, u'changed')
+        self.assertTrue(self.handler.add_record(u'web', u'bing', u'pw2'))
+        handler4 = self.reload()
+        self.assertEqual(sorted(handler4.records['_rid']), [1, 2])
+        self.assertEqual(handler4.records['_rid'][1].value, u'changed')
+
+    def test_write_behind_rollback(self):
+        handler = AESHandler(journal=True, write_behind=True, flush_delay=1)
+        self.assertTrue(handler.initialize('provide a key', self.tmpfile.name))
+        self.assertTrue(handler.add_record(u'web', u'google', u'answer42'))
+        self.assertTrue(handler.update_record(0, u'v1'))
+        try:
+            with handler.batch():
+                self.assertTrue(handler.update_record(0, u'rolled back'))
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertEqual(handler.records['_rid'][0].value, u'v1')
+        handler.close()
+        self.assertEqual(self.reload().records['_rid'][0].value, u'v1')
+
+    def test_torn_tail(self):
+        self.assertTrue(self.handler.add_record(u'web', u'google', u'answer42'))
+        with open(self.handler.journal_path, 'ab') as f:
+            f.write('\x00\x00\x01\x00garbage')
+        handler2 = self.reload()
+        self.assertEqual(len(handler2.records['_rid']), 1)
+        # the entries after the torn tail are read back as well
+        for i in range(3):
+            self.assertTrue(handler2.add_record(u'web', str(i), u'value'))
+        handler3 = self.reload()
+        self.assertEqual(len(handler3.records['_rid']), 4)
+
+
+class TestShardedVault(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dirpath = os.path.join(self.tmpdir, 'records.d')
+        self.handler = ShardedAESHandler(shards=4, kdf='pbkdf2',
+                                         kdf_params={'iterations': 1000})
+        self.assertTrue(self.handler.initialize('provide a key',
+                                                self.dirpath))
+        rows = [{'group': u'group%d' % (i % 6), 'itemname': u'item%d' % i,
+                 'value': u'value%d' % i} for i in range(30)]
+        self.handler.add_records(rows)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def shards(self):
+        return sorted(name for name in os.listdir(self.dirpath)
+                      if name.startswith('shard-'))
+
+    def reload(self, **kwargs):
+        handler = ShardedAESHandler(**kwargs)
+        self.assertTrue(handler.initialize('provide a key', self.dirpath))
+        return handler
+
+    def assertSameRecords(self, handler, other):
+        key = lambda record: record.id
+        self.assertEqual(sorted(handler.data['records'], key=key),
+                         sorted(other.data['records'], key=key))
+        for name in ('currentID', 'currentGID'):
+            self.assertEqual(handler.data[name], other.data[name])
+
+    def test_round_trip(self):
+        self.assertEqual(len(self.shards()), 4)
+        handler2 = self.reload()
+        self.assertSameRecords(handler2, self.handler)
+        self.assertEqual(len(handler2.records['_gid']), 6)
+        self.assertEqual(handler2.records[u'group1'][u'item7'].value,
+                         u'value7')
+        # a group lives in a single shard
+        self.assertEqual(handler2.records['_gidmap'][u'group5'], 5)
+
+        self.assertFalse(ShardedAESHandler().initialize('another key',
+                                                        self.dirpath))
+
+    def test_rewrite_shard(self):
+        before = self.shards()
+        self.assertTrue(self.handler.update_record(7, u'changed'))
+        after = self.shards()
+        # only the shard of the group of the record was written again
+        self.assertEqual(len(set(before) - set(after)), 1)
+        self.assertEqual(len(after), 4)
+        # an add rewrites the shard of its group alone, the shard written
+        # by the former change is left as it is
+        self.assertTrue(self.handler.add_record(u'group0', u'new', u'pw'))
+        before = self.shards()
+        self.assertTrue(self.handler.add_record(u'group1', u'new', u'pw'))
+        self.assertEqual(len(set(before) - set(self.shards())), 1)
+
+        # a move rewrites the shard the record leaves as well
+        self.assertTrue(self.handler.move_record(7, 2))
+        self.assertTrue(self.handler.delete_record(8))
+        handler2 = self.reload()
+        self.assertSameRecords(handler2, self.handler)
+        self.assertEqual(handler2.records[u'group2'][u'item7'].value,
+                         u'changed')
+        self.assertFalse(u'item7' in handler2.records[u'group1'])
+
+    def test_journal(self):
+        handler = self.reload(journal=True, compact_threshold=3)
+        before = self.shards()
+        self.assertTrue(handler.update_record(3, u'changed'))
+        self.assertTrue(handler.add_record(u'new', u'item', u'value'))
+        self.assertEqual(self.shards(), before)
+
+        # the replayed entries are written by the next compaction
+        handler2 = self.reload(journal=True, compact_threshold=3)
+        self.assertTrue(handler2.delete_record(4))
+        self.assertNotEqual(self.shards(), before)
+        self.assertEqual(os.path.getsize(handler2.journal_path), 0)
+        self.assertSameRecords(self.reload(), handler2)
+
+    def test_parallel_load(self):
+        handler2 = self.reload(processes=2)
+        self.assertSameRecords(handler2, self.handler)
+        self.assertEqual(handler2.records[u'group4'][u'item10'].value,
+                         u'value10')
+
+    def test_rekey(self):
+        self.handler.rekey('another key')
+        handler2 = ShardedAESHandler()
+        self.assertTrue(handler2.initialize('another key', self.dirpath))
+        self.assertSameRecords(handler2, self.handler)
+        self.assertEqual(handler2.records[u'group0'][u'item0'].value,
+                         u'value0')
+
+        # the shards are all written with the new key, even though a
+        # change of another process is loaded first
+        self.assertTrue(handler2.add_record(u'group1', u'new', u'pw'))
+        self.handler.rekey('third key')
+        handler3 = ShardedAESHandler()
+        self.assertTrue(handler3.initialize('third key', self.dirpath))
+        self.assertSameRecords(handler3, handler2)
+        self.assertEqual(handler3.records[u'group0'][u'item0'].value,
+                         u'value0')
+        self.assertEqual(handler3.records[u'group1'][u'new'].value, u'pw')
+
+
+class TestKeyDerivation(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmpdir, 'records.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def header(self):
+        return read_header(map_file(self.filepath))[0]
+
+    def test_kdf(self):
+        handler = AESHandler(kdf='pbkdf2', kdf_params={'iterations': 1000})
+        self.assertTrue(handler.initialize('provide a key', self.filepath))
+        self.assertTrue(handler.add_record(u'web', u'google', u'answer42'))
+        kdf = self.header()['kdf']
+        self.assertEqual((kdf['name'], kdf['iterations']), ('pbkdf2', 1000))
+        self.assertEqual(len(kdf['salt']), 32)
+
+        # the vault keeps its own function whatever the handler prefers
+        handler2 = AESHandler(kdf='scrypt')
+        self.assertTrue(handler2.initialize('provide a key', self.filepath))
+        self.assertEqual(handler2.records['_rid'][0].value, u'answer42')
+        self.assertFalse(AESHandler().initialize('wrong key', self.filepath))
+
+        self.assertRaises(ValueError, AESHandler, kdf='md5')
+
+    def test_rekey(self):
+        handler = AESHandler(vault_format='legacy', journal=True)
+        self.assertTrue(handler.initialize('provide a key', self.filepath))
+        self.assertTrue(handler.add_record(u'web', u'google', u'answer42'))
+        self.assertTrue(handler.add_record(u'web', u'yahoo', u'pw'))
+
+        handler.vault_format = 'indexed'
+        handler.rekey('new key', 'pbkdf2', iterations=1000)
+        self.assertEqual(self.header()['kdf']['name'], 'pbkdf2')
+        self.assertEqual(os.path.getsize(handler.journal_path), 0)
+        self.assertFalse(AESHandler().initialize('provide a key', self.filepath))
+        handler2 = AESHandler()
+        self.assertTrue(handler2.initialize('new key', self.filepath))
+        self.assertEqual(handler2.data['records'], handler.data['records'])
+        self.assertEqual(handler2.records['_rid'][1].value, u'pw')
+
+        # the salt would be lost, so the key is derived again to go back
+        handler2.vault_format = 'legacy'
+        self.assertRaises(ValueError, handler2.write)
+        handler2.rekey('new key')
+        self.assertFalse(open(self.filepath, 'rb').read().startswith(VAULT_MAGIC))
+        handler3 = AESHandler()
+        self.assertTrue(handler3.initialize('new key', self.filepath))
+        self.assertEqual(handler3.records['_rid'][1].value, u'pw')
+
+    def test_agent(self):
+        agent = KeyAgent(os.path.join(self.tmpdir, 'agent.sock'), timeout=5)
+        thread = threading.Thread(target=agent.serve)
+        thread.start()
+        try:
+            client = AgentClient(agent.path)
+            # no key is handed out before the vault is unlocked
+            handler = AESHandler(agent=client)
+            self.assertTrue(handler.initialize('provide a key', self.filepath))
+            self.assertTrue(handler.add_record(u'web', u'google', u'answer42'))
+            self.assertFalse(AESHandler(agent=client).initialize(
+                None, self.filepath + '.other'))
+
+            handler2 = AESHandler(agent=client)
+            self.assertTrue(handler2.initialize(None, self.filepath))
+            self.assertEqual(handler2.records['_rid'][0].value, u'answer42')
+            self.assertRaises(ValueError, KeyAgent, agent.path)
+
+            client.forget()
+            self.assertFalse(AESHandler(agent=client).initialize(
+                None, self.filepath))
+        finally:
+            AgentClient(agent.path).stop()
+            thread.join()
+        self.assertFalse(os.path.exists(agent.path))
+        self.assertFalse(client.ping())
+
+        # an idle agent exits by itself
+        agent = KeyAgent(os.path.join(self.tmpdir, 'agent.sock'), timeout=0.1)
+        agent.serve()
+        self.assertFalse(os.path.exists(agent.path))
+
+
+class TestCipher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmpdir, 'records.dat')
+        self.key = AESHandler.figure_32Byte_key('provide a key')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def header(self):
+        return read_header(map_file(self.filepath))[0]
+
+    def test_gcm_stream(self):
+        cipher = GCMCipher(self.key, {'chunk': 7})
+        for text in ('', 'x', 'a' * 7, 'line one\nline two\n' * 5):
+            pieces = [text[i:i+3] for i in range(0, len(text), 3)]
+            stream = ''.join(cipher.iter_encrypt(pieces))
+            self.assertEqual(''.join(cipher.iter_decrypt(stream)), text)
+            padded = 'head' + stream + 'tail'
+            chunks = cipher.iter_decrypt(padded, 4, len(stream))
+            self.assertEqual(''.join(chunks), text)
+
+        stream = ''.join(cipher.iter_encrypt(['0123456789' * 3]))
+        # a stream cut off at the end of a chunk
+        cut = stream[:GCMCipher.PREFIX_SIZE + 2 * (7 + 16)]
+        self.assertRaises(ValueError, list, cipher.iter_decrypt(cut))
+        damaged = stream[:-1] + chr(ord(stream[-1]) ^ 1)
+        self.assertRaises(ValueError, list, cipher.iter_decrypt(damaged))
+        other = GCMCipher(AESHandler.figure_32Byte_key('other key'))
+        self.assertRaises(ValueError, other.decrypt, cipher.encrypt('text'))
+
+        cipher = make_cipher(self.key, GCMCipher.new_spec())
+        texts = ['x', 'a longer text than a single block', '', 'y' * 32]
+        ids = [3, 4, 5, 6]
+        blobs = cipher.encrypt_values(ids, texts)
+        self.assertEqual([cipher.decrypt_value(blob, rid)
+                          for rid, blob in zip(ids, blobs)], texts)
+        damaged = blobs[1][:20] + chr(ord(blobs[1][20]) ^ 1) + blobs[1][21:]
+        self.assertRaises(ValueError, cipher.decrypt_value, damaged, 4)
+        self.assertRaises(ValueError, other.decrypt_value, blobs[0], 3)
+        # the blob of a record does not verify as the value of another
+        self.assertRaises(ValueError, cipher.decrypt_value, blobs[0], 4)
+        # the vaults written before keep the MAC of the value alone
+        former = GCMCipher(self.key, {'name': 'gcm', 'chunk': 7})
+        blob = former.encrypt_values([3], ['x'])[0]
+        self.assertEqual(former.decrypt_value(blob, 4), 'x')
+        self.assertRaises(ValueError, cipher.decrypt_value, blob, 3)
+        self.assertRaises(ValueError, make_cipher, self.key, {'name': 'ecb'})
+
+        # the values of a write are sealed at once, as if one by one
+        for spec in ({'name': 'gcm'}, {'name': 'cfb'}):
+            values = make_cipher(self.key, spec)
+            blobs = values.encrypt_values(ids, texts)
+            self.assertEqual([values.decrypt_value(blob, rid)
+                              for rid, blob in zip(ids, blobs)], texts)
+
+    def test_cipher_modes(self):
+        handler = AESHandler(kdf='pbkdf2', kdf_params={'iterations': 1000},
+                             cipher_mode='cfb', journal=True)
+        self.assertTrue(handler.initialize('provide a key', self.filepath))
+        self.assertEqual(self.header()['cipher'], {'name': 'cfb'})
+        self.assertTrue(handler.add_record(u'web', u'google', u'answer42'))
+        handler.compact()
+        self.assertTrue(handler.add_record(u'web', u'yahoo', u'pw'))
+
+        # the vault keeps its cipher whatever the handler prefers
+        handler2 = AESHandler(cipher_mode='gcm', journal=True)
+        self.assertTrue(handler2.initialize('provide a key', self.filepath))
+        self.assertEqual(handler2.records['_rid'][1].value, u'pw')
+
+        handler2.rekey('new key', 'pbkdf2', cipher_mode='gcm',
+                       iterations=1000)
+        self.assertEqual(self.header()['cipher']['name'], 'gcm')
+        self.assertTrue(handler2.add_record(u'mail', u'gmail', u'secret'))
+        handler3 = AESHandler()
+        self.assertTrue(handler3.initialize('new key', self.filepath))
+        self.assertEqual(handler3.data['records'], handler2.data['records'])
+        self.assertEqual(handler3.records['_rid'][2].value, u'secret')
+        self.assertFalse(AESHandler().initialize('wrong key', self.filepath))
+
+        # a damaged index is detected instead of read as garbage
+        start = read_header(map_file(self.filepath))[1]
+        with open(self.filepath, 'r+b') as f:
+            f.seek(start + 20)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(chr(ord(byte) ^ 1))
+        self.assertFalse(AESHandler().initialize('new key', self.filepath))
+
+        # the values of two records swapped in the file are detected
+        handler = AESHandler(kdf='pbkdf2', kdf_params={'iterations': 1000})
+        path = os.path.join(self.tmpdir, 'swapped.dat')
+        self.assertTrue(handler.initialize('provide a key', path))
+        self.assertTrue(handler.add_record(u'web', u'a', u'first'))
+        self.assertTrue(handler.add_record(u'web', u'b', u'other'))
+        one, two = [record._value for record in handler.data['records']]
+        self.assertEqual(one.length, two.length)
+        with open(path, 'r+b') as f:
+            f.seek(one.vault.offset + one.offset)
+            blobs = f.read(one.length + two.length)
+            f.seek(one.vault.offset + one.offset)
+            f.write(blobs[one.length:] + blobs[:one.length])
+        handler2 = AESHandler()
+        self.assertTrue(handler2.initialize('provide a key', path))
+        self.assertRaises(ValueError, getattr, handler2.records['_rid'][0],
+                          'value')
+
+        self.assertRaises(ValueError, AESHandler, cipher_mode='ecb')
+
+
+class TestInstruments(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmpdir, 'records.dat')
+        self.events = []
+        sink = lambda kind, name, value: self.events.append((kind, name))
+        self.instruments = Instruments([sink])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_spans(self):
+        with self.instruments.span('outer'):
+            with self.instruments.span('inner'):
+                time.sleep(0.02)
+            self.assertEqual(list(self.instruments.timed('item', 'ab')),
+                             ['a', 'b'])
+        report = self.instruments.report()
+        outer, inner = report['spans']['outer'], report['spans']['inner']
+        # the nested spans are not in the self time of the outer one
+        self.assertTrue(outer['total'] >= inner['total'] >= 0.02)
+        self.assertTrue(outer['self'] < 0.02)
+        self.assertEqual(report['spans']['item']['count'], 3)
+        self.assertEqual(self.events[0], ('span', 'inner'))
+        self.assertEqual(self.events[-1], ('span', 'outer'))
+
+        self.instruments.reset()
+        self.assertEqual(self.instruments.report(),
+                         {'spans': {}, 'counters': {}})
+
+    def test_handler(self):
+        handler = AESHandler(kdf='pbkdf2', kdf_params={'iterations': 1000},
+                             instruments=self.instruments)
+        self.assertTrue(handler.initialize('provide a key', self.filepath))
+        self.assertTrue(handler.add_record(u'web', u'google', u'answer42'))
+        report = self.instruments.report()
+        for name in ('kdf', 'encode', 'encrypt', 'compress', 'write'):
+            self.assertTrue(name in report['spans'], name)
+        self.assertEqual(report['counters']['records_touched'], 1)
+
+        # the new vault was written once before the record was added
+        self.assertEqual(report['spans']['write']['count'], 2)
+        self.assertTrue(report['counters']['bytes_written'] >
+                        os.path.getsize(self.filepath))
+
+        instruments = Instruments()
+        handler2 = AESHandler(instruments=instruments)
+        self.assertTrue(handler2.initialize('provide a key', self.filepath))
+        self.assertEqual(handler2.records[u'web'][u'google'].value,
+                         u'answer42')
+        report = instruments.report()
+        for name in ('kdf', 'decrypt', 'decompress', 'parse', 'load'):
+            self.assertTrue(name in report['spans'], name)
+        self.assertEqual(report['counters']['records_loaded'], 1)
+
+        # the latencies of the shell commands
+        shell = Papyrus()
+        shell.handler = handler2
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            shell.onecmd('info 0')
+            shell.onecmd('stats')
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertTrue('command.info' in output)
+        self.assertTrue('records_loaded' in output)
+
+    def test_stats_file(self):
+        path = os.path.join(self.tmpdir, 'stats')
+        handler = AESHandler(instruments=Instruments([StatsFile(path)]))
+        self.assertTrue(handler.initialize('provide a key', self.filepath))
+        shell = Papyrus(stdout=StringIO())
+        shell.handler = handler
+        shell.onecmd('')
+        self.assertTrue(shell.onecmd('quit'))
+        shell.postloop()
+        with open(path) as f:
+            names = [json.loads(line)['name'] for line in f]
+        self.assertTrue('command.quit' in names)
+        self.assertFalse('command.None' in names)
+
+
+class TestCommandRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmpdir, 'records.dat')
+        self.handler = AESHandler()
+        self.handler.initialize('provide a key', self.filepath)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_script(self, script):
+        output = StringIO()
+        failed = CommandRunner(self.handler).run(StringIO(script), output)
+        return failed, [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_run(self):
+        writes = []
+        write = self.handler.write
+        self.handler.write = lambda: writes.append(1) or write()
+        failed, results = self.run_script(
+            "add web google answer42 'a note'\n"
+            "# a comment\n"
+            '{"op": "add", "group": "bank", "item": "boa", "value": "kkk3000"}\n'
+            "update 0 google42\n"
+            "add web\n"
+            "info 0\n"
+            '{"op": "search", "text": "bo", "field": "itemname"}\n'
+            "search goo*\n"
+            "delete 7\n")
+        self.assertEqual(failed, 2)
+        self.assertEqual(writes, [1])
+        self.assertEqual([r['line'] for r in results], [1, 3, 4, 5, 6, 7, 8, 9])
+        self.assertEqual([r['ok'] for r in results],
+                         [True, True, True, False, True, True, True, False])
+        self.assertEqual(results[1]['id'], 1)
+        self.assertEqual(results[4]['record']['value'], u'google42')
+        self.assertEqual(results[4]['record']['note'], u'a note')
+        self.assertEqual(results[5]['records'],
+                         [{'id': 1, 'group': u'bank', 'itemname': u'boa'}])
+        self.assertEqual([r['id'] for r in results[6]['records']], [0])
+
+        handler2 = AESHandler()
+        self.assertTrue(handler2.initialize('provide a key', self.filepath))
+        self.assertEqual(handler2.data['records'], self.handler.data['records'])
+
+    def test_unexpected_error(self):
+        def lines():
+            yield "add web google answer42\n"
+            raise RuntimeError('the script broke')
+        runner = CommandRunner(self.handler)
+        self.assertRaises(RuntimeError, runner.run, lines(), StringIO())
+        # the commands before the error are rolled back
+        self.assertFalse(self.handler.in_batch)
+        self.assertEqual(self.handler.data['records'], [])
+        handler2 = AESHandler()
+        self.assertTrue(handler2.initialize('provide a key', self.filepath))
+        self.assertEqual(handler2.data['records'], [])
+
+    def test_passphrase_file(self):
+        script = os.path.join(self.tmpdir, 'commands.txt')
+        with open(script, 'w') as f:
+            f.write("add web google answer42\n")
+        passphrase = os.path.join(self.tmpdir, 'passphrase')
+        with open(passphrase, 'w') as f:
+            f.write('provide a key\n')
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            status = run_exec(['-p', self.filepath, '-f', script,
+                               '--passphrase-file', passphrase])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(status, 0)
+        self.assertEqual(json.loads(output), {'ok': True, 'line': 1, 'id': 0})
+        self.assertTrue(self.handler.refresh())
+        self.assertEqual(self.handler.records['_rid'][0].value, u'answer42')
+
 
 if __name__ == '__main__':
     unittest.main()